@@ -0,0 +1,273 @@
+"""
+Bulk generator of enrollments and users databases of any size.
+
+    python -m benchmarks.datagen --enrollments PATH --users PATH
+        [--classes N] [--students M] [--full-fraction F] [--waitlist-min W]
+        [--seed S] [--batch ROWS] [--hash-iterations I] [--force]
+
+pro_db.py inserts three hand-written classes, enough to try the endpoints
+but not to plan capacity. This fills the same schema with N classes in a
+handful of departments, a fraction of them full with a waitlist behind
+them, students enrolled (and a few dropped) across them, and a login for
+every student and instructor, all with pre-hashed passwords.
+
+Loading favours speed over safety. The databases are written with
+journal_mode=OFF and synchronous=OFF, the rows go in with executemany in
+transactions of ``batch`` rows, and the indexes and triggers of the later
+migrations are only built once the tables are full. A crash half-way
+leaves a broken file, so generate into a new path, not into a LiteFS
+mount, and ``litefs import`` the result. The databases are switched to
+WAL at the end as the services expect.
+
+The same seed always produces the same databases, password salts included.
+"""
+
+import argparse
+import datetime
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import time
+
+from enrollments.engine import MAX_STUDENT_WAITLISTS, MAX_WAITLIST_SIZE
+from enrollments.migrations import migrate
+from users.share.users_db import create_database as create_users_database
+
+DEFAULT_BATCH = 100000
+DEFAULT_PASSWORD = "password"
+DEFAULT_HASHES = 8
+
+LOADING_PRAGMAS = {
+    "journal_mode": "OFF",
+    "synchronous": "OFF",
+    "cache_size": -262144,  # 256 MiB, mostly for the index builds
+    "temp_store": "MEMORY",
+}
+
+DEPARTMENTS = [
+    ("Computer Science", "CPSC"),
+    ("Mathematics", "MATH"),
+    ("Physics", "PHYS"),
+    ("English", "ENGL"),
+    ("History", "HIST"),
+    ("Biology", "BIOL"),
+    ("Business", "BUAD"),
+    ("Art", "ART"),
+]
+CAPACITIES = [20, 30, 40, 60, 120]
+CAPACITY_WEIGHTS = [3, 4, 4, 2, 1]
+TERM_START = int(datetime.datetime(2024, 1, 8, tzinfo=datetime.timezone.utc).timestamp())
+TERM_SECONDS = 90 * 24 * 3600
+
+
+def instructors_for(classes):
+    return max(classes // 4, 1)
+
+
+def usernames(prefix, count):
+    """Return a function mapping 0..count-1 to usernames."""
+    # Zero-padded, so numeric order is index order and the UNIQUE index only ever appends
+    return f"{prefix}{{:0{len(str(count - 1))}d}}".format
+
+
+def student_usernames(students):
+    return usernames("student", students)
+
+
+def instructor_usernames(instructors):
+    return usernames("ins", instructors)
+
+
+def connect_for_loading(path, force=False):
+    if os.path.exists(path):
+        if not force:
+            raise FileExistsError(f"{path} already exists, pass --force to replace it")
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    db = sqlite3.connect(path)
+    for pragma, value in LOADING_PRAGMAS.items():
+        db.execute(f"PRAGMA {pragma} = {value}")
+    return db
+
+
+def finish(db):
+    db.execute("ANALYZE")
+    db.execute("PRAGMA journal_mode = WAL")
+    db.close()
+
+
+def timestamp(rng):
+    # Seconds since the epoch, SQLite formats them faster than strftime
+    return TERM_START + rng.randrange(TERM_SECONDS)
+
+
+# ------------- Enrollments -------------
+
+INSERT_CLASS = """
+    INSERT INTO Classes(ClassId, InstructorUserName, InstructorName, Department, CourseCode, SectionNumber,
+    ClassName, CurrentEnrollment, MaxEnrollment, AutomaticEnrollmentFrozen)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+"""
+INSERT_ENROLLMENT = """
+    INSERT INTO Enrollments(ClassId, StudentUserName, StudentName, EnrollmentDate, Dropped)
+    VALUES(?, ?, ?, datetime(?, 'unixepoch'), ?)
+"""
+INSERT_WAITLIST = """
+    INSERT INTO WaitingLists(ClassId, StudentUserName, StudentName, WaitingListPos, DateAdded)
+    VALUES(?, ?, ?, ?, datetime(?, 'unixepoch'))
+"""
+
+
+def generate_enrollments(path, classes, students, full_fraction=0.3, waitlist_min=0,
+                         seed=0, batch=DEFAULT_BATCH, force=False):
+    """Write the enrollments database and return the row count of each table."""
+    rng = random.Random(seed)
+    instructors = instructors_for(classes)
+    student_username, instructor_username = student_usernames(students), instructor_usernames(instructors)
+    waitlists_of = bytearray(students)
+    counts = {"classes": 0, "enrollments": 0, "waitlists": 0}
+
+    db = connect_for_loading(path, force)
+    # Tables only, the indexes and triggers come after the data
+    migrate(db, target=1)
+    class_rows, enrollment_rows, waitlist_rows = [], [], []
+
+    def flush():
+        db.executemany(INSERT_CLASS, class_rows)
+        db.executemany(INSERT_ENROLLMENT, enrollment_rows)
+        db.executemany(INSERT_WAITLIST, waitlist_rows)
+        db.commit()
+        counts["classes"] += len(class_rows)
+        counts["enrollments"] += len(enrollment_rows)
+        counts["waitlists"] += len(waitlist_rows)
+        class_rows.clear(), enrollment_rows.clear(), waitlist_rows.clear()
+
+    for class_id in range(1, classes + 1):
+        department, prefix = rng.choice(DEPARTMENTS)
+        course = rng.randrange(100, 600)
+        instructor = rng.randrange(instructors)
+        capacity = rng.choices(CAPACITIES, CAPACITY_WEIGHTS)[0]
+        full = rng.random() < full_fraction
+        enrolled = capacity if full else rng.randrange(capacity)
+        dropped = rng.choice((0, 0, 1, 2))
+        members = rng.sample(range(students), min(enrolled + dropped, students))
+        enrolled = min(enrolled, len(members))
+
+        class_rows.append((
+            class_id, instructor_username(instructor), f"Instructor {instructor}", department,
+            f"{prefix}{course}", rng.randint(1, 4), f"{department} {course}", enrolled, capacity,
+        ))
+        for k, student in enumerate(members):
+            enrollment_rows.append((
+                class_id, student_username(student), f"Student {student}", timestamp(rng), int(k >= enrolled),
+            ))
+
+        if full:
+            taken = set(members)
+            for position in range(1, rng.randint(min(waitlist_min, MAX_WAITLIST_SIZE), MAX_WAITLIST_SIZE) + 1):
+                # A few tries for a student who is free to wait, then give the class a shorter list
+                for _ in range(10):
+                    student = rng.randrange(students)
+                    if student not in taken and waitlists_of[student] < MAX_STUDENT_WAITLISTS:
+                        break
+                else:
+                    break
+                taken.add(student)
+                waitlists_of[student] += 1
+                waitlist_rows.append((
+                    class_id, student_username(student), f"Student {student}", position, timestamp(rng),
+                ))
+
+        if len(class_rows) + len(enrollment_rows) + len(waitlist_rows) >= batch:
+            flush()
+    flush()
+
+    migrate(db)
+    finish(db)
+    return counts
+
+
+# ------------- Users -------------
+
+
+def generate_users(path, students, instructors, password=DEFAULT_PASSWORD, hashes=DEFAULT_HASHES,
+                   iterations=None, seed=0, batch=DEFAULT_BATCH, force=False):
+    """Write the users database, every user with ``password``, and return the user count."""
+    from users.users import HASH_ITERATIONS, hash_password
+
+    rng = random.Random(seed)
+    # Hashing millions of passwords would take days, so users share a few precomputed hashes
+    password_hashes = [
+        hash_password(password, f"{rng.getrandbits(128):032x}", iterations or HASH_ITERATIONS)
+        for _ in range(hashes)
+    ]
+
+    db = connect_for_loading(path, force)
+    create_users_database(path)
+    student_username, instructor_username = student_usernames(students), instructor_usernames(instructors)
+
+    def rows():
+        for n in range(instructors):
+            yield instructor_username(n), password_hashes[n % hashes], f"Instructor {n}", "instructor"
+        for n in range(students):
+            yield student_username(n), password_hashes[n % hashes], f"Student {n}", "student"
+
+    count, rows = 0, rows()
+    while chunk := list(itertools.islice(rows, batch)):
+        db.executemany("INSERT INTO Users(Username, Password, FullName, Roles) VALUES(?, ?, ?, ?)", chunk)
+        db.commit()
+        count += len(chunk)
+
+    finish(db)
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.datagen", description="Generate enrollments and users databases.")
+    parser.add_argument("--enrollments", help="path of the enrollments database to create")
+    parser.add_argument("--users", help="path of the users database to create")
+    parser.add_argument("--classes", type=int, default=10000)
+    parser.add_argument("--students", type=int, default=100000)
+    parser.add_argument("--full-fraction", type=float, default=0.3, help="share of classes that are full and have a waitlist")
+    parser.add_argument("--waitlist-min", type=int, default=0, help="shortest waitlist of a full class")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH, help="rows per transaction")
+    parser.add_argument("--password", default=DEFAULT_PASSWORD)
+    parser.add_argument("--hashes", type=int, default=DEFAULT_HASHES, help="distinct password hashes to spread over the users")
+    parser.add_argument("--hash-iterations", type=int, help="PBKDF2 iterations (default: the users service's)")
+    parser.add_argument("--force", action="store_true", help="replace existing databases")
+    args = parser.parse_args(argv)
+    if not args.enrollments and not args.users:
+        parser.error("pass --enrollments and/or --users")
+    if args.classes < 1 or args.students < 1:
+        parser.error("--classes and --students must be positive")
+
+    try:
+        if args.enrollments:
+            start = time.perf_counter()
+            counts = generate_enrollments(
+                args.enrollments, args.classes, args.students, args.full_fraction, args.waitlist_min,
+                args.seed, args.batch, args.force,
+            )
+            elapsed = time.perf_counter() - start
+            rows = sum(counts.values())
+            print(f"{args.enrollments}: {counts['classes']} classes, {counts['enrollments']} enrollments, "
+                  f"{counts['waitlists']} waitlist entries in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s)")
+        if args.users:
+            start = time.perf_counter()
+            count = generate_users(
+                args.users, args.students, instructors_for(args.classes), args.password, args.hashes,
+                args.hash_iterations, args.seed, args.batch, args.force,
+            )
+            elapsed = time.perf_counter() - start
+            print(f"{args.users}: {count} users in {elapsed:.1f}s ({count / elapsed:.0f} rows/s)")
+    except FileExistsError as e:
+        parser.error(str(e))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
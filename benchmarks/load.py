@@ -0,0 +1,447 @@
+"""
+Load test of the enrollment and auth hot paths.
+
+    python -m benchmarks.load seed DIR [--classes N] [--students M] [--seed S]
+    python -m benchmarks.load run DIR [--concurrency C] [--duration S] [--mix NAME=WEIGHT,...]
+                                      [--enrollments-url URL] [--users-url URL]
+                                      [--save FILE] [--compare FILE] [--tolerance T]
+
+``seed`` generates DIR/enrollments.db and DIR/users.db with
+benchmarks.datagen: N classes, half of them full with a waitlist close to
+the 15-entry cap, M students spread over them, and a login for every
+student and instructor. DIR/catalog.json keeps a sample of what was
+generated for ``run`` to pick from.
+
+``run`` drives the endpoints from ``concurrency`` closed-loop clients for
+``duration`` seconds, after ``warmup`` seconds that are not recorded. By
+default the apps are imported against the seeded databases and called
+in-process through httpx's ASGI transport. With the URLs the same requests
+go over HTTP to running services, started on the seeded databases:
+
+    ENROLLMENTS_DATABASE=DIR/enrollments.db uvicorn enrollments.pro:app --port 5100
+    USERS_DATABASE=DIR/users.db USERS_REPLICAS= uvicorn users.users:app --port 5000
+
+Per endpoint it reports throughput and p50/p95/p99 latency. 4xx responses
+are normal outcomes (a full class, a duplicate enrollment), 5xx are errors.
+Lock timeouts are 503s from a saturated pool and "database is locked"
+errors. ``--save`` writes the results as JSON. ``--compare`` checks them
+against a saved run and exits with status 1 when an endpoint's p95 or
+throughput is worse by more than ``tolerance``, or it hit lock timeouts
+the baseline did not.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+
+import httpx
+import jwt
+
+from benchmarks import datagen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIGNING_KEYS = os.path.join(ROOT, "users", "share", "symmetric.json")
+
+PASSWORD = "benchmark"
+CATALOG_SAMPLE = 10000  # rows of each kind kept in catalog.json
+DEFAULT_MIX = {
+    "classes": 20,
+    "classes_page": 10,
+    "enroll_drop": 20,
+    "waitlist_position": 10,
+    "class_waitlist": 5,
+    "instructor_classes": 5,
+    "dropped_students": 5,
+    "login": 10,
+    "refresh": 10,
+    "register": 1,
+}
+
+# ------------- Seeding -------------
+
+
+def seed(directory, classes=1000, students=10000, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    enrollments_db = os.path.join(directory, "enrollments.db")
+    users_db = os.path.join(directory, "users.db")
+    # Waitlists close to the 15-entry cap
+    datagen.generate_enrollments(enrollments_db, classes, students, full_fraction=0.5, waitlist_min=12, seed=seed, force=True)
+    datagen.generate_users(users_db, students, datagen.instructors_for(classes), PASSWORD, seed=seed, force=True)
+
+    db = sqlite3.connect(enrollments_db)
+
+    def sample(sql):
+        return db.execute(f"{sql} LIMIT {CATALOG_SAMPLE}").fetchall()
+    catalog = {
+        "students": students,
+        "classes": [row[0] for row in sample("SELECT ClassId FROM Classes ORDER BY ClassId")],
+        "open": [row[0] for row in sample("SELECT ClassId FROM Classes WHERE CurrentEnrollment < MaxEnrollment ORDER BY ClassId")],
+        "waitlisted": sample("SELECT StudentUserName, ClassId FROM WaitingLists ORDER BY WaitListId"),
+        "instructors": {},
+    }
+    for instructor, class_id in sample("SELECT InstructorUserName, ClassId FROM Classes ORDER BY InstructorUserName"):
+        catalog["instructors"].setdefault(instructor, []).append(class_id)
+    db.close()
+
+    with open(os.path.join(directory, "catalog.json"), "w") as f:
+        json.dump(catalog, f)
+    return catalog
+
+
+# ------------- Requests -------------
+
+
+def signing_key():
+    with open(SIGNING_KEYS) as f:
+        key = json.load(f)["keys"][0]
+    return key["kid"], base64.urlsafe_b64decode(key["k"] + "=" * (-len(key["k"]) % 4))
+
+
+class Clients:
+    """The two services, their test data and signed tokens."""
+
+    def __init__(self, enrollments, users, catalog):
+        self.enrollments = enrollments
+        self.users = users
+        self.catalog = catalog
+        self.kid, self.key = signing_key()
+        self.student_username = datagen.student_usernames(catalog["students"])
+        self._tokens = {}
+
+    def headers(self, username, roles):
+        token = self._tokens.get(username)
+        if token is None:
+            claims = {"sub": username, "name": username, "roles": [roles], "exp": int(time.time()) + 86400}
+            token = self._tokens[username] = jwt.encode(claims, self.key, algorithm="HS256", headers={"kid": self.kid})
+        return {"Authorization": f"Bearer {token}"}
+
+    def sign(self, claims):
+        return {"Authorization": "Bearer " + jwt.encode(claims, self.key, algorithm="HS256", headers={"kid": self.kid})}
+
+
+class Worker:
+    """One closed-loop client. Each scenario yields (label, awaitable response)."""
+
+    def __init__(self, number, clients, rng):
+        self.number = number
+        self.clients = clients
+        self.catalog = clients.catalog
+        self.rng = rng
+        self.refresh_headers = None
+        self.registered = 0
+
+    def student(self):
+        return self.clients.student_username(self.rng.randrange(self.catalog["students"]))
+
+    def instructor(self):
+        return self.rng.choice(list(self.catalog["instructors"]))
+
+    def classes(self):
+        c = self.clients
+        yield "GET /classes", c.enrollments.get("/classes", headers=c.headers(self.student(), "student"))
+
+    def classes_page(self):
+        c = self.clients
+        after = self.rng.choice(self.catalog["classes"])
+        yield "GET /classes?limit", c.enrollments.get(
+            "/classes", params={"limit": 50, "after": after}, headers=c.headers(self.student(), "student")
+        )
+
+    def enroll_drop(self):
+        c = self.clients
+        headers = c.headers(self.student(), "student")
+        class_id = self.rng.choice(self.catalog["open"])
+        yield "POST /enrollments/", c.enrollments.post("/enrollments/", json={"ClassId": class_id}, headers=headers)
+        yield "DELETE /students/enrollments/{ClassId}", c.enrollments.delete(f"/students/enrollments/{class_id}", headers=headers)
+
+    def waitlist_position(self):
+        c = self.clients
+        username, class_id = self.rng.choice(self.catalog["waitlisted"])
+        yield "GET /students/waiting-list/{ClassId}", c.enrollments.get(
+            f"/students/waiting-list/{class_id}", headers=c.headers(username, "student")
+        )
+
+    def class_waitlist(self):
+        c = self.clients
+        instructor = self.instructor()
+        class_id = self.rng.choice(self.catalog["instructors"][instructor])
+        yield "GET /classes/{ClassId}/wait-list", c.enrollments.get(
+            f"/classes/{class_id}/wait-list", headers=c.headers(instructor, "instructor")
+        )
+
+    def instructor_classes(self):
+        c = self.clients
+        yield "GET /instructors/classes", c.enrollments.get(
+            "/instructors/classes", headers=c.headers(self.instructor(), "instructor")
+        )
+
+    def dropped_students(self):
+        c = self.clients
+        instructor = self.instructor()
+        class_id = self.rng.choice(self.catalog["instructors"][instructor])
+        yield "GET /instructors/{ClassId}/dropped-students", c.enrollments.get(
+            f"/instructors/{class_id}/dropped-students", headers=c.headers(instructor, "instructor")
+        )
+
+    def login(self):
+        yield "POST /login", self.clients.users.post("/login", json={"username": self.student(), "password": PASSWORD})
+
+    def refresh(self):
+        c = self.clients
+        if self.refresh_headers is None:
+            # The gateway signs the refresh claims returned by /login
+            response = yield "POST /login", c.users.post("/login", json={"username": self.student(), "password": PASSWORD})
+            if response is None or response.status_code != 200:
+                return
+            self.refresh_headers = c.sign(response.json()["refresh_token"])
+        yield "POST /token/refresh", c.users.post("/token/refresh", headers=self.refresh_headers)
+
+    def register(self):
+        self.registered += 1
+        username = f"bench-{os.getpid()}-{self.number}-{self.registered}-{self.rng.randrange(1 << 30)}"
+        yield "POST /register", self.clients.users.post(
+            "/register", json={"username": username, "password": PASSWORD, "fullname": username, "roles": "student"}
+        )
+
+
+# ------------- Load loop -------------
+
+
+class Recorder:
+    def __init__(self):
+        self.started = None
+        self.endpoints = {}
+
+    def record(self, label, elapsed, status=None, error=None):
+        if self.started is None:
+            return
+        endpoint = self.endpoints.setdefault(label, {"latencies": [], "statuses": {}, "errors": 0, "lock_timeouts": 0})
+        endpoint["latencies"].append(elapsed)
+        key = str(status) if status is not None else type(error).__name__
+        endpoint["statuses"][key] = endpoint["statuses"].get(key, 0) + 1
+        if status == 503 or (error is not None and "database is locked" in str(error)):
+            endpoint["lock_timeouts"] += 1
+        if status is None or status >= 500:
+            endpoint["errors"] += 1
+
+
+async def drive(worker, mix, recorder, deadline):
+    names, weights = list(mix), list(mix.values())
+    while time.perf_counter() < deadline:
+        steps = getattr(worker, worker.rng.choices(names, weights)[0])()
+        response = None
+        while True:
+            try:
+                label, request = steps.send(response)
+            except StopIteration:
+                break
+            start = time.perf_counter()
+            try:
+                response = await request
+            except (httpx.HTTPError, sqlite3.Error) as e:
+                recorder.record(label, time.perf_counter() - start, error=e)
+                response = None
+            else:
+                recorder.record(label, time.perf_counter() - start, status=response.status_code)
+
+
+def percentile(ordered, fraction):
+    # Nearest rank
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for label, endpoint in sorted(recorder.endpoints.items()):
+        ordered = sorted(endpoint["latencies"])
+        endpoints[label] = {
+            "requests": len(ordered),
+            "rps": len(ordered) / elapsed,
+            "p50_ms": percentile(ordered, 0.50) * 1000,
+            "p95_ms": percentile(ordered, 0.95) * 1000,
+            "p99_ms": percentile(ordered, 0.99) * 1000,
+            "max_ms": ordered[-1] * 1000,
+            "errors": endpoint["errors"],
+            "lock_timeouts": endpoint["lock_timeouts"],
+            "statuses": endpoint["statuses"],
+        }
+    requests = sum(e["requests"] for e in endpoints.values())
+    total = {
+        "requests": requests,
+        "rps": requests / elapsed,
+        "errors": sum(e["errors"] for e in endpoints.values()),
+        "lock_timeouts": sum(e["lock_timeouts"] for e in endpoints.values()),
+    }
+    return {"total": total, "endpoints": endpoints}
+
+
+def in_process_apps(directory):
+    # The apps read their configuration at import time
+    os.environ.update({
+        "ENROLLMENTS_DATABASE": os.path.join(directory, "enrollments.db"),
+        "ENROLLMENTS_REPLICAS": "",
+        "USERS_DATABASE": os.path.join(directory, "users.db"),
+        "USERS_REPLICAS": "",
+    })
+    os.environ.setdefault("ENROLLMENTS_LOGGING_CONFIG", "enrollments/etc/logging.production.ini")
+    os.environ.setdefault("USERS_LOGGING_CONFIG", "users/etc/logging.production.ini")
+    from enrollments.pro import app as enrollments_app
+    from users.users import app as users_app
+    return enrollments_app, users_app
+
+
+async def run(directory, concurrency=16, duration=10.0, warmup=1.0, mix=None,
+              enrollments_url=None, users_url=None, seed=0):
+    with open(os.path.join(directory, "catalog.json")) as f:
+        catalog = json.load(f)
+    mix = {name: weight for name, weight in (mix or DEFAULT_MIX).items() if weight > 0}
+    apps = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    if enrollments_url is None or users_url is None:
+        enrollments_app, users_app = in_process_apps(directory)
+    if enrollments_url is None:
+        apps.append(enrollments_app)
+        enrollments = httpx.AsyncClient(transport=httpx.ASGITransport(app=enrollments_app), base_url="http://enrollments")
+    else:
+        enrollments = httpx.AsyncClient(base_url=enrollments_url, limits=limits)
+    if users_url is None:
+        apps.append(users_app)
+        users = httpx.AsyncClient(transport=httpx.ASGITransport(app=users_app), base_url="http://users")
+    else:
+        users = httpx.AsyncClient(base_url=users_url, limits=limits)
+
+    for app in apps:
+        await app.router.startup()
+    try:
+        clients = Clients(enrollments, users, catalog)
+        recorder = Recorder()
+        workers = [Worker(n, clients, random.Random(seed * 1000 + n)) for n in range(concurrency)]
+        start = time.perf_counter()
+        deadline = start + warmup + duration
+
+        async def begin_recording():
+            await asyncio.sleep(warmup)
+            recorder.started = time.perf_counter()
+        await asyncio.gather(begin_recording(), *(drive(worker, mix, recorder, deadline) for worker in workers))
+        elapsed = time.perf_counter() - recorder.started
+    finally:
+        await enrollments.aclose()
+        await users.aclose()
+        for app in apps:
+            await app.router.shutdown()
+
+    results = summarize(recorder, elapsed)
+    results["config"] = {
+        "concurrency": concurrency,
+        "duration": duration,
+        "mix": mix,
+        "mode": "http" if not apps else "in-process" if len(apps) == 2 else "mixed",
+        "classes": len(catalog["classes"]),
+        "students": catalog["students"],
+    }
+    return results
+
+
+# ------------- Reports -------------
+
+
+def report(results):
+    print(f"{'endpoint':<44} {'req':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6} {'locks':>6}")
+    for label, e in results["endpoints"].items():
+        print(f"{label:<44} {e['requests']:>7} {e['rps']:>8.1f} {e['p50_ms']:>8.2f} {e['p95_ms']:>8.2f} "
+              f"{e['p99_ms']:>8.2f} {e['errors']:>6} {e['lock_timeouts']:>6}")
+    t = results["total"]
+    print(f"{'total':<44} {t['requests']:>7} {t['rps']:>8.1f} {'':>8} {'':>8} {'':>8} {t['errors']:>6} {t['lock_timeouts']:>6}")
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Print the change against ``baseline`` and return the regressed endpoints."""
+    regressions = []
+    changed = [key for key, value in results["config"].items() if baseline["config"].get(key) != value]
+    if changed:
+        print(f"\nwarning: the baseline was run with a different {', '.join(changed)}")
+    print(f"\n{'endpoint':<44} {'p95 ms':>19} {'req/s':>19}")
+    for label, e in results["endpoints"].items():
+        base = baseline["endpoints"].get(label)
+        if base is None:
+            continue
+        problems = []
+        if e["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append("p95")
+        if e["rps"] < base["rps"] * (1 - tolerance):
+            problems.append("throughput")
+        if e["lock_timeouts"] > base["lock_timeouts"]:
+            problems.append("lock timeouts")
+        if problems:
+            regressions.append((label, problems))
+        print(f"{label:<44} {base['p95_ms']:>8.2f} -> {e['p95_ms']:>8.2f} {base['rps']:>8.1f} -> {e['rps']:>8.1f}"
+              f"  {'REGRESSED: ' + ', '.join(problems) if problems else ''}")
+    return regressions
+
+
+def parse_mix(value):
+    mix = dict.fromkeys(DEFAULT_MIX, 0)
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in mix:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}, choose from {', '.join(DEFAULT_MIX)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load", description="Load test the enrollments and users services.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seeding = commands.add_parser("seed", help="create the benchmark databases")
+    seeding.add_argument("directory")
+    seeding.add_argument("--classes", type=int, default=1000)
+    seeding.add_argument("--students", type=int, default=10000)
+    seeding.add_argument("--seed", type=int, default=0)
+
+    running = commands.add_parser("run", help="run the load test")
+    running.add_argument("directory")
+    running.add_argument("--concurrency", type=int, default=16)
+    running.add_argument("--duration", type=float, default=10.0)
+    running.add_argument("--warmup", type=float, default=1.0)
+    running.add_argument("--mix", type=parse_mix, help=f"e.g. classes=3,login=1 (default: {DEFAULT_MIX})")
+    running.add_argument("--enrollments-url")
+    running.add_argument("--users-url")
+    running.add_argument("--seed", type=int, default=0)
+    running.add_argument("--save", help="write the results to this JSON file")
+    running.add_argument("--compare", help="a results file saved earlier")
+    running.add_argument("--tolerance", type=float, default=0.2)
+
+    args = parser.parse_args(argv)
+    if args.command == "seed":
+        catalog = seed(args.directory, args.classes, args.students, args.seed)
+        print(f"{args.directory}: {len(catalog['classes'])} classes, {catalog['students']} students, "
+              f"{len(catalog['waitlisted'])} waitlist entries")
+        return 0
+
+    results = asyncio.run(run(
+        args.directory, args.concurrency, args.duration, args.warmup, args.mix,
+        args.enrollments_url, args.users_url, args.seed,
+    ))
+    report(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
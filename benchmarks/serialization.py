@@ -0,0 +1,72 @@
+"""
+Micro-benchmark of the /classes serialization path.
+
+    python -m benchmarks.serialization [rows ...]
+
+"before" is what the endpoints did originally: sqlite3.Row objects through
+FastAPI's jsonable_encoder and the stdlib json module, as JSONResponse does.
+"after" is the current path: plain tuples zipped into dicts and encoded by
+orjson. "cached" is the pre-encoded body served from the classes cache.
+"""
+
+import json
+import sqlite3
+import sys
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+
+from common.serialization import dumps, query_dicts
+from enrollments.migrations import migrate
+
+CLASSES_SQL = """
+    SELECT ClassId, CourseCode, SectionNumber, ClassName, InstructorName, CurrentEnrollment, MaxEnrollment
+    FROM classes
+    WHERE CurrentEnrollment < MaxEnrollment AND AutomaticEnrollmentFrozen = 0
+    ORDER BY ClassId"""
+
+
+def seed(rows):
+    db = sqlite3.connect(":memory:")
+    db.row_factory = sqlite3.Row
+    migrate(db)
+    db.executemany(
+        """
+        INSERT INTO Classes(InstructorUserName, InstructorName, Department, CourseCode, SectionNumber,
+        ClassName, CurrentEnrollment, MaxEnrollment, AutomaticEnrollmentFrozen)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, 0)
+        """,
+        [(f"ins{i % 200}", f"Instructor {i % 200}", "Computer Science", f"CPSC{i % 900}", i % 5 + 1,
+          f"Course number {i}", i % 30, 40) for i in range(rows)],
+    )
+    db.commit()
+    return db
+
+
+def before(db):
+    content = jsonable_encoder({"classes": db.execute(CLASSES_SQL).fetchall()})
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def after(db):
+    return dumps({"classes": query_dicts(db, CLASSES_SQL), "next_cursor": None})
+
+
+def bench(rows, repeat=5):
+    db = seed(rows)
+    body = after(db)
+    assert json.loads(before(db))["classes"] == json.loads(body)["classes"]
+    number = max(1, 20000 // rows)
+    results = {}
+    for name, fn in (("before", lambda: before(db)), ("after", lambda: after(db)), ("cached", lambda: body)):
+        best = min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+        results[name] = best * 1000
+    return results
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    print(f"{'rows':>8} {'before ms':>10} {'after ms':>10} {'cached ms':>10} {'speedup':>8}")
+    for rows in sizes:
+        r = bench(rows)
+        print(f"{rows:>8} {r['before']:>10.3f} {r['after']:>10.3f} {r['cached']:>10.4f} {r['before'] / r['after']:>7.1f}x")
@@ -0,0 +1,334 @@
+"""
+Async access to the pooled SQLite connections.
+
+sqlite3 blocks, so async handlers hand their database work to threads owned
+by AsyncDatabase instead of running it on the event loop or on the shared
+anyio pool that sync endpoints use:
+
+* reads run on a pool of reader threads, each call on a connection of its
+  own, so they fan out across the replicas;
+* writes run on a single writer thread, so within a worker they are
+  serialized and never compete with each other for the SQLite write lock.
+
+Give the writer a connection factory of its own (e.g. a pool of size 1)
+rather than the read pool, so readers and long NDJSON streams can never
+leave it waiting for a connection. ``streams`` caps the streams open at
+once: a stream keeps its connection between chunks, so keep readers plus
+streams within the read pool.
+
+A unit of work is a plain function taking a connection. It runs start to
+finish on one thread with one connection, so transactions never span an
+``await``.
+
+With a ``group_commit`` window the writer coalesces the batchable units that
+arrive within it into one transaction: each unit runs in a SAVEPOINT of its
+own, so a failing unit is rolled back alone, and the whole batch pays for a
+single commit. A unit is only resolved once that commit succeeded. Batchable
+units must not commit themselves (EnrollmentEngine nests in the open
+transaction with a SAVEPOINT instead).
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import logging
+import queue
+import threading
+import time
+
+from common.metrics import Histogram
+from common.pool import PoolTimeout
+from common.serialization import query_dicts
+
+DEFAULT_STREAM_CHUNK = 500
+DEFAULT_MAX_BATCH = 64
+DEFAULT_STREAM_TIMEOUT = 5.0
+
+logger = logging.getLogger(__name__)
+
+QUERY_SECONDS = Histogram("sqlite_query_seconds", "Time to run a unit of database work, by label", ("database", "kind", "label"))
+WRITE_QUEUE_SECONDS = Histogram("sqlite_write_queue_seconds", "Time a write waited for the writer thread", ("database",))
+LOCK_WAIT_SECONDS = Histogram("sqlite_lock_wait_seconds", "Time to take the write lock with BEGIN IMMEDIATE", ("database",))
+TRANSACTION_SECONDS = Histogram("sqlite_transaction_seconds", "Time from BEGIN IMMEDIATE to COMMIT", ("database", "mode"))
+
+_STOP = object()
+
+
+class Writer:
+    """The single writer thread of an AsyncDatabase."""
+
+    COUNTERS = ("units", "batches", "batched_units", "batch_failures")
+
+    def __init__(self, connection, name, group_commit=0.0, max_batch=DEFAULT_MAX_BATCH):
+        self.connection = connection
+        self.name = name
+        self.group_commit = group_commit
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._stats = {"units": 0, "batches": 0, "batched_units": 0, "batch_max": 0, "batch_failures": 0}
+        self._thread = threading.Thread(target=self._run, name=f"{name}-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, args, trace, batch, label):
+        future = concurrent.futures.Future()
+        self._queue.put((fn, args, trace, batch, future, label, time.perf_counter()))
+        return future
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        pending = None
+        while True:
+            item = pending if pending is not None else self._queue.get()
+            pending = None
+            if item is _STOP:
+                return
+            if not (self.group_commit and item[3]):
+                self._run_alone(item)
+                continue
+            # Collect more batchable units until the window closes
+            batch = [item]
+            deadline = time.monotonic() + self.group_commit
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP or not item[3]:
+                    # Runs right after this batch
+                    pending = item
+                    break
+                batch.append(item)
+            self._run_batch(batch)
+
+    def _run_alone(self, item):
+        fn, args, trace, _, future, label, submitted = item
+        if not future.set_running_or_notify_cancel():
+            return
+        start = time.perf_counter()
+        WRITE_QUEUE_SECONDS.observe(start - submitted, self.name)
+        try:
+            with self.connection() as db:
+                db.set_trace_callback(trace)
+                result = fn(db, *args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        QUERY_SECONDS.observe(time.perf_counter() - start, self.name, "write", label)
+        with self._lock:
+            self._stats["units"] += 1
+
+    def _run_batch(self, batch):
+        batch = [item for item in batch if item[4].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        outcomes = []
+        try:
+            with self.connection() as db:
+                begin = time.perf_counter()
+                db.execute("BEGIN IMMEDIATE")
+                LOCK_WAIT_SECONDS.observe(time.perf_counter() - begin, self.name)
+                try:
+                    for fn, args, trace, _, future, label, submitted in batch:
+                        start = time.perf_counter()
+                        WRITE_QUEUE_SECONDS.observe(start - submitted, self.name)
+                        db.set_trace_callback(trace)
+                        db.execute("SAVEPOINT unit")
+                        try:
+                            outcomes.append((future, fn(db, *args), None))
+                        except Exception as e:
+                            db.execute("ROLLBACK TO unit")
+                            outcomes.append((future, None, e))
+                        finally:
+                            db.execute("RELEASE unit")
+                            QUERY_SECONDS.observe(time.perf_counter() - start, self.name, "write", label)
+                    db.set_trace_callback(None)
+                    db.commit()
+                    TRANSACTION_SECONDS.observe(time.perf_counter() - begin, self.name, "batch")
+                except BaseException:
+                    db.rollback()
+                    raise
+        except BaseException as e:
+            # Nothing was committed, every unit of the batch fails
+            logger.warning("group commit of %d units failed: %s", len(batch), e)
+            with self._lock:
+                self._stats["batch_failures"] += 1
+            for item in batch:
+                item[4].set_exception(e)
+            return
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        with self._lock:
+            self._stats["units"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["batched_units"] += len(batch)
+            self._stats["batch_max"] = max(self._stats["batch_max"], len(batch))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["batch_avg"] = stats["batched_units"] / stats["batches"] if stats["batches"] else 0.0
+        stats["group_commit"] = self.group_commit
+        return stats
+
+
+class AsyncDatabase:
+    def __init__(self, write_connection, read_connection=None, readers=5, name="db",
+                 group_commit=0.0, max_batch=DEFAULT_MAX_BATCH, streams=None, stream_timeout=DEFAULT_STREAM_TIMEOUT):
+        """``write_connection`` and ``read_connection`` are context manager
+        factories yielding a connection, e.g. ``pool.connection`` or
+        ``router.connection`` (which also takes a routing key).
+        ``group_commit`` is the batching window in seconds, 0 disables it.
+        ``streams`` is the number of streams open at once, None for no cap; a
+        stream over it waits ``stream_timeout`` seconds, then fails with PoolTimeout."""
+        self.write_connection = write_connection
+        self.read_connection = read_connection or (lambda key=None: write_connection())
+        self.readers = readers
+        self.name = name
+        self.group_commit = group_commit
+        self.max_batch = max_batch
+        self.streams = streams
+        self.stream_timeout = stream_timeout
+        self._writer = None
+        self._reader = None
+        self._stream_slots = None
+        self._open_streams = 0
+
+    def _executors(self):
+        # Created on first use so a forked worker never inherits the threads
+        if self._writer is None:
+            self._writer = Writer(self.write_connection, self.name, self.group_commit, self.max_batch)
+            self._reader = concurrent.futures.ThreadPoolExecutor(self.readers, thread_name_prefix=f"{self.name}-reader")
+        return self._writer, self._reader
+
+    def _unit(self, connection, fn, args, trace, label):
+        with connection as db:
+            db.set_trace_callback(trace)
+            start = time.perf_counter()
+            try:
+                return fn(db, *args)
+            finally:
+                QUERY_SECONDS.observe(time.perf_counter() - start, self.name, "read", label)
+
+    async def _submit(self, executor, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args))
+
+    async def write(self, fn, *args, trace=None, batch=False, label=None):
+        """Run ``fn(db, *args)`` on the writer. ``batch`` units may share a commit.
+
+        ``label`` names the unit in the metrics, by default ``fn.__name__``.
+        """
+        writer, _ = self._executors()
+        return await asyncio.wrap_future(writer.submit(fn, args, trace, batch, label or fn.__name__))
+
+    async def read(self, fn, *args, key=None, trace=None, label=None):
+        _, reader = self._executors()
+        return await self._submit(reader, self._unit, self.read_connection(key), fn, args, trace, label or fn.__name__)
+
+    async def stream(self, sql, params=(), key=None, trace=None, chunk=DEFAULT_STREAM_CHUNK, label="stream", head=None):
+        """Yield rows of ``sql`` as dicts, ``chunk`` rows per trip to a reader thread.
+
+        The connection is held for the whole stream and the rows are never
+        all in memory at once. With ``head``, the first item is ``head(db)``,
+        run on the same connection before ``sql``.
+        """
+        _, reader = self._executors()
+        await self._open_stream()
+        stack = contextlib.ExitStack()
+        try:
+            db = await self._submit(reader, stack.enter_context, self.read_connection(key))
+            db.set_trace_callback(trace)
+            if head is not None:
+                yield await self._submit(reader, head, db)
+
+            def start():
+                begin = time.perf_counter()
+                cur = db.cursor()
+                cur.row_factory = None
+                cur.execute(sql, params)
+                QUERY_SECONDS.observe(time.perf_counter() - begin, self.name, "read", label)
+                return cur, [column[0] for column in cur.description]
+            cur, names = await self._submit(reader, start)
+            while True:
+                rows = await self._submit(reader, cur.fetchmany, chunk)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(names, row))
+        finally:
+            try:
+                await self._submit(reader, stack.close)
+            finally:
+                self._close_stream()
+
+    async def _open_stream(self):
+        if self.streams is None:
+            return
+        if self._stream_slots is None:
+            self._stream_slots = asyncio.Semaphore(self.streams)
+        try:
+            await asyncio.wait_for(self._stream_slots.acquire(), self.stream_timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"timed out after {self.stream_timeout}s waiting for a stream on {self.name}") from None
+        self._open_streams += 1
+
+    def _close_stream(self):
+        if self.streams is not None:
+            self._open_streams -= 1
+            self._stream_slots.release()
+
+    def close(self):
+        writer, reader, self._writer, self._reader = self._writer, self._reader, None, None
+        if writer is not None:
+            writer.close()
+            reader.shutdown(wait=True)
+
+    def stats(self):
+        return {"writer": self._writer.stats() if self._writer else None, "readers": self.readers,
+                "streams": self.streams, "open_streams": self._open_streams}
+
+
+class Session:
+    """Per-request handle on an AsyncDatabase.
+
+    Carries the request's routing key, SQL trace callback and metrics label
+    (usually the endpoint name), and offers the common single-statement
+    reads as coroutines. A ``primary`` session, for
+    handlers that write, also reads through the writer so it sees the
+    latest state.
+    """
+
+    def __init__(self, database, key=None, trace=None, primary=False, label=None):
+        self.database = database
+        self.key = key
+        self.trace = trace
+        self.primary = primary
+        self.label = label
+
+    async def read(self, fn, *args, label=None):
+        if self.primary:
+            return await self.write(fn, *args, label=label)
+        return await self.database.read(fn, *args, key=self.key, trace=self.trace, label=label or self.label)
+
+    async def write(self, fn, *args, batch=False, label=None):
+        return await self.database.write(fn, *args, trace=self.trace, batch=batch, label=label or self.label)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda db: db.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda db: db.execute(sql, params).fetchall())
+
+    async def query_dicts(self, sql, params=()):
+        return await self.read(query_dicts, sql, params)
+
+    def stream(self, sql, params=(), head=None):
+        return self.database.stream(sql, params, key=self.key, trace=self.trace, label=self.label or "stream", head=head)
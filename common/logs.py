@@ -0,0 +1,75 @@
+"""
+Logging helpers for the production logging mode of both services.
+
+QueueFileHandler formats a record on the calling thread and hands it to a
+background QueueListener, so a request never waits on disk I/O. JSONFormatter
+renders records as one JSON object per line, including any ``extra`` fields.
+"""
+
+import logging
+import logging.handlers
+import queue
+import random
+
+import orjson
+
+SQL_TRACE_HEADER = "x-trace-sql"
+
+# Attributes every LogRecord has, anything else was passed through ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode("utf-8")
+
+
+class QueueFileHandler(logging.handlers.QueueHandler):
+    def __init__(self, filename, mode="a", encoding="utf-8", maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.file_handler = logging.FileHandler(filename, mode, encoding)
+        self.listener = logging.handlers.QueueListener(self.queue, self.file_handler)
+        self.listener.start()
+
+    def enqueue(self, record):
+        # Drop instead of blocking the request when the disk cannot keep up
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+    def close(self):
+        # logging.shutdown() closes every handler at exit, which drains the queue
+        if self.listener._thread is not None:
+            self.listener.stop()
+        self.file_handler.close()
+        super().close()
+
+
+def sql_tracer(logger, request, sample_rate):
+    """Return a trace callback for this request's connection, or None.
+
+    Statements go to the ``<logger>.sql`` child at DEBUG, only when the client
+    sends ``X-Trace-SQL: 1`` or the request is picked by ``sample_rate``.
+    """
+    logger = logger.getChild("sql")
+    if not logger.isEnabledFor(logging.DEBUG):
+        return None
+    if request.headers.get(SQL_TRACE_HEADER) != "1" and (sample_rate <= 0 or random.random() >= sample_rate):
+        return None
+    path = request.url.path
+
+    def trace(statement):
+        logger.debug(statement, extra={"path": path})
+    return trace
@@ -0,0 +1,226 @@
+"""
+In-process metrics in the Prometheus text exposition format.
+
+A small subset of prometheus_client: counters, gauges and histograms kept in
+memory, plus StatsCollector, which turns the ``stats()`` dicts the pools and
+caches already maintain into metrics when /metrics is scraped, so they cost
+nothing in between. An update takes one lock and a dict lookup.
+
+Metrics live in the process-wide REGISTRY. Every uvicorn worker has its own,
+so scrape each worker (the Procfile runs one per port) rather than a load
+balanced address.
+"""
+
+import bisect
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._collectors = []
+
+    def register(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+        return collector
+
+    def unregister(self, collector):
+        with self._lock:
+            self._collectors.remove(collector)
+
+    def expose(self):
+        """Render every metric. Collectors may share a metric name, e.g. one per service."""
+        with self._lock:
+            collectors = list(self._collectors)
+        families = {}
+        for collector in collectors:
+            for name, kind, documentation, samples in collector.collect():
+                family = families.setdefault(name, (kind, documentation, []))
+                family[2].extend(samples)
+        lines = []
+        for name, (kind, documentation, samples) in families.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # label values -> value
+        registry.register(self)
+
+    def _labels(self, values):
+        return dict(zip(self.labelnames, values))
+
+    def collect(self):
+        with self._lock:
+            values = list(self._values.items())
+        yield self.name, self.kind, self.documentation, [(self.name, self._labels(k), v) for k, v in values]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, *labelvalues):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labelvalues)
+            if series is None:
+                # One count per bucket plus +Inf, then the sum
+                series = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def collect(self):
+        with self._lock:
+            values = [(k, list(v)) for k, v in self._values.items()]
+        samples = []
+        for labelvalues, series in values:
+            labels = self._labels(labelvalues)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), series):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", dict(labels, le=_number(bound)), cumulative))
+            samples.append((f"{self.name}_sum", labels, series[-1]))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        yield self.name, self.kind, self.documentation, samples
+
+
+class StatsCollector:
+    """Exposes ``stats()`` dicts as ``<name>_<key>`` metrics at scrape time.
+
+    ``source`` returns ``(labels, stats)`` pairs. Keys listed in ``counters``
+    are cumulative and become counters, other numbers become gauges.
+    Anything that is not a number is left out.
+    """
+
+    def __init__(self, name, documentation, source, counters=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.source = source
+        self.counters = frozenset(counters)
+        registry.register(self)
+
+    def collect(self):
+        families = {}
+        for labels, stats in self.source():
+            for key, value in stats.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                elif not isinstance(value, (int, float)):
+                    continue
+                counter = key in self.counters
+                name = f"{self.name}_{key}"
+                if counter and not name.endswith("_total"):
+                    name += "_total"
+                families.setdefault(name, ("counter" if counter else "gauge", []))[1].append((name, labels, value))
+        for name, (kind, samples) in families.items():
+            yield name, kind, f"{self.documentation} ({name[len(self.name) + 1:]})", samples
+
+
+# ------------- HTTP -------------
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time to serve a request, by route template", ("service", "method", "route", "status")
+)
+REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "Requests being served", ("service",))
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware timing every request by its route template.
+
+    The route is only known once FastAPI has matched it, so it is read from
+    the scope after the request. Paths that match no route share one label.
+    """
+
+    def __init__(self, app, service):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_and_record(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        REQUESTS_IN_PROGRESS.inc(self.service)
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            REQUESTS_IN_PROGRESS.dec(self.service)
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                self.service, scope["method"], getattr(route, "path", "unmatched"), str(status),
+            )
+
+
+def endpoint_label(request):
+    """The name of the endpoint serving ``request``, to label its database work."""
+    route = request.scope.get("route")
+    return getattr(route, "name", None)
@@ -0,0 +1,198 @@
+import contextlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+# ------------- Constants -------------
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_TIMEOUT = 5.0
+DEFAULT_BUSY_TIMEOUT = 5.0
+# Idle connections older than this are pinged before being handed out
+DEFAULT_HEALTH_CHECK_INTERVAL = 30.0
+
+# Pragmas applied to every new connection of a read/write pool
+WRITER_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,      # 16 MiB page cache per connection
+    "mmap_size": 268435456,    # 256 MiB
+    "temp_store": "MEMORY",
+}
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections shared by one worker.
+
+    Connections are created lazily up to ``size`` and reused afterwards, so a
+    request no longer pays for connect, schema parse and cache warmup.
+    """
+
+    # Cumulative keys of stats()
+    COUNTERS = ("acquired", "waited", "wait_time_total", "timeouts", "connections_created",
+                "connections_discarded", "health_check_failures")
+
+    def __init__(self, database, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT,
+                 pragmas=None, busy_timeout=DEFAULT_BUSY_TIMEOUT,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL, uri=False, name=None):
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(pragmas or {})
+        self.busy_timeout = busy_timeout
+        self.health_check_interval = health_check_interval
+        self.uri = uri
+        self.name = name or database
+
+        # LIFO keeps the hottest connections (warm page cache) in use
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._last_used = {}
+
+        self._stats = {
+            "acquired": 0,
+            "waited": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "health_check_failures": 0,
+        }
+
+    # ------------- Connection lifecycle -------------
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database,
+            timeout=self.busy_timeout,
+            check_same_thread=False,
+            uri=self.uri,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        return conn
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        with contextlib.suppress(sqlite3.Error):
+            conn.close()
+        with self._lock:
+            self._created -= 1
+            self._last_used.pop(id(conn), None)
+            self._stats["connections_discarded"] += 1
+
+    def _new_connection(self):
+        try:
+            conn = self._connect()
+        except sqlite3.Error:
+            with self._lock:
+                self._created -= 1
+            raise
+        with self._lock:
+            self._stats["connections_created"] += 1
+            self._last_used[id(conn)] = time.monotonic()
+        return conn
+
+    def acquire(self):
+        start = time.perf_counter()
+        waited = False
+        conn = None
+        while conn is None:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    conn = self._new_connection()
+                    break
+                waited = True
+                remaining = self.timeout - (time.perf_counter() - start)
+                try:
+                    conn = self._idle.get(timeout=max(remaining, 0))
+                except queue.Empty:
+                    with self._lock:
+                        self._stats["timeouts"] += 1
+                    raise PoolTimeout(
+                        f"timed out after {self.timeout}s waiting for a connection to {self.name}"
+                    )
+
+            last_used = self._last_used.get(id(conn), 0)
+            if time.monotonic() - last_used > self.health_check_interval and not self._is_healthy(conn):
+                logger.warning("discarding unhealthy connection to %s", self.name)
+                with self._lock:
+                    self._stats["health_check_failures"] += 1
+                self._discard(conn)
+                conn = None
+
+        wait = time.perf_counter() - start
+        with self._lock:
+            self._stats["acquired"] += 1
+            if waited:
+                self._stats["waited"] += 1
+            self._stats["wait_time_total"] += wait
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait)
+        return conn
+
+    def release(self, conn):
+        conn.set_trace_callback(None)
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._last_used[id(conn)] = time.monotonic()
+        self._idle.put_nowait(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        # Closes idle connections, the pool reconnects lazily if used again
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    # ------------- Metrics -------------
+
+    def in_use(self):
+        return self._created - self._idle.qsize()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = self.size
+            stats["open"] = self._created
+        stats["idle"] = self._idle.qsize()
+        stats["in_use"] = stats["open"] - stats["idle"]
+        stats["wait_time_avg"] = stats["wait_time_total"] / stats["acquired"] if stats["acquired"] else 0.0
+        return stats
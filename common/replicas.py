@@ -0,0 +1,260 @@
+"""
+Read routing across a LiteFS primary and its replicas.
+
+LiteFS publishes the replication position of every database next to it in
+the FUSE mount, as ``<database>-pos`` containing ``<txid>/<checksum>`` in
+hex. Comparing a replica's TXID with the primary's gives its lag in
+transactions without touching SQLite.
+
+ReplicaRouter hands out the least busy replica whose lag is within
+``max_lag``, and falls back to the primary when none qualifies. A replica
+whose position cannot be read, or whose connections fail, is ejected for
+``eject_seconds``. Keys pinned with ``pin()`` (e.g. a user who has just
+registered) read from the primary until the pin expires, which gives
+read-your-writes without waiting for replication.
+
+Pins only live in the worker that took the write. ReadPositionMiddleware
+therefore also answers every successful write with the primary's TXID in
+``X-Read-Position``. A client that sends it back reads, through any worker,
+from a replica that has replayed that transaction, or from the primary.
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_LAG = 10            # transactions
+DEFAULT_CHECK_INTERVAL = 1.0    # seconds between position reads
+DEFAULT_EJECT_SECONDS = 10.0
+DEFAULT_PIN_SECONDS = 10.0
+MAX_PINS = 10000
+POSITION_HEADER = "X-Read-Position"
+
+logger = logging.getLogger(__name__)
+
+
+def read_position(database):
+    """Return the LiteFS TXID of ``database``, or None outside LiteFS."""
+    try:
+        with open(f"{database}-pos") as f:
+            txid, _, _ = f.read().strip().partition("/")
+    except FileNotFoundError:
+        # A plain SQLite file has no position, a missing database means the mount is down
+        if os.path.exists(database):
+            return None
+        raise
+    return int(txid, 16)
+
+
+# The routing key of a read: the pinned key (e.g. the user) and the lowest TXID it may see
+ReadKey = collections.namedtuple("ReadKey", ["key", "txid"])
+
+
+def read_key(request, key=None):
+    """The ReadKey of ``request``, with the position it sent in POSITION_HEADER if any."""
+    try:
+        txid = int(request.headers.get(POSITION_HEADER, ""), 16)
+    except ValueError:
+        txid = None
+    return ReadKey(key, txid)
+
+
+class Node:
+    COUNTERS = ("routed", "errors", "ejections", "latency_total")
+
+    def __init__(self, pool, primary=False):
+        self.pool = pool
+        self.primary = primary
+        self.txid = None
+        self.lag = 0
+        self.healthy = True
+        self.ejected_until = 0.0
+        self.stats = {
+            "routed": 0,
+            "errors": 0,
+            "ejections": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+
+    def available(self, now):
+        return self.healthy and now >= self.ejected_until
+
+
+class ReplicaRouter:
+    COUNTERS = ("primary_fallbacks", "pinned_reads")
+
+    def __init__(self, primary, replicas, max_lag=DEFAULT_MAX_LAG,
+                 check_interval=DEFAULT_CHECK_INTERVAL, eject_seconds=DEFAULT_EJECT_SECONDS,
+                 pin_seconds=DEFAULT_PIN_SECONDS):
+        self.primary = Node(primary, primary=True)
+        self.replicas = [Node(pool) for pool in replicas]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.eject_seconds = eject_seconds
+        self.pin_seconds = pin_seconds
+
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._pins = {}  # key -> pinned until
+        self._stats = {"primary_fallbacks": 0, "pinned_reads": 0}
+
+    # ------------- Positions and health -------------
+
+    def _read_position(self, node):
+        try:
+            node.txid = read_position(node.pool.database)
+            node.healthy = True
+        except (OSError, ValueError) as e:
+            if node.healthy:
+                logger.warning("cannot read the position of %s: %s", node.pool.name, e)
+            node.healthy = False
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+        for node in [self.primary, *self.replicas]:
+            self._read_position(node)
+        primary_txid = self.primary.txid
+        for node in self.replicas:
+            # Without LiteFS positions there is nothing to compare, assume in sync
+            if primary_txid is None or node.txid is None:
+                node.lag = 0
+            else:
+                node.lag = max(primary_txid - node.txid, 0)
+
+    def _eject(self, node, error):
+        with self._lock:
+            node.stats["errors"] += 1
+            if node.primary:
+                return
+            node.ejected_until = time.monotonic() + self.eject_seconds
+            node.stats["ejections"] += 1
+        logger.warning("ejecting replica %s for %ss: %s", node.pool.name, self.eject_seconds, error)
+
+    # ------------- Routing -------------
+
+    def pin(self, key, seconds=None):
+        """Send reads for ``key`` to the primary for a while."""
+        until = time.monotonic() + (self.pin_seconds if seconds is None else seconds)
+        with self._lock:
+            if len(self._pins) >= MAX_PINS:
+                now = time.monotonic()
+                self._pins = {k: t for k, t in self._pins.items() if t > now}
+            self._pins[key] = until
+
+    def _pinned(self, key):
+        with self._lock:
+            until = self._pins.get(key)
+            if until is None:
+                return False
+            if until > time.monotonic():
+                return True
+            del self._pins[key]
+            return False
+
+    def position(self):
+        """The primary's current TXID, or None outside LiteFS."""
+        try:
+            return read_position(self.primary.pool.database)
+        except (OSError, ValueError):
+            return None
+
+    def choose(self, key=None):
+        if not self.replicas:
+            return self.primary
+        key, txid = key if isinstance(key, ReadKey) else (key, None)
+        if key is not None and self._pinned(key):
+            with self._lock:
+                self._stats["pinned_reads"] += 1
+            return self.primary
+        self.refresh()
+        now = time.monotonic()
+        candidates = [node for node in self.replicas if node.available(now) and node.lag <= self.max_lag]
+        if txid is not None:
+            # Without LiteFS positions there is nothing to compare, as for the lag
+            caught_up = [node for node in candidates if node.txid is None or node.txid >= txid]
+            if candidates and not caught_up:
+                with self._lock:
+                    self._stats["pinned_reads"] += 1
+                return self.primary
+            candidates = caught_up
+        if not candidates:
+            with self._lock:
+                self._stats["primary_fallbacks"] += 1
+            return self.primary
+        return min(candidates, key=lambda node: (node.pool.in_use(), node.lag))
+
+    @contextlib.contextmanager
+    def connection(self, key=None):
+        node = self.choose(key)
+        start = time.perf_counter()
+        try:
+            with node.pool.connection() as conn:
+                yield conn
+        except sqlite3.DatabaseError as e:
+            # Constraint violations and bad SQL are the caller's problem, not the node's
+            if not isinstance(e, (sqlite3.IntegrityError, sqlite3.ProgrammingError)):
+                self._eject(node, e)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                node.stats["routed"] += 1
+                node.stats["latency_total"] += elapsed
+                node.stats["latency_max"] = max(node.stats["latency_max"], elapsed)
+
+    # ------------- Metrics -------------
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pins"] = len(self._pins)
+            stats["nodes"] = [
+                dict(
+                    node.stats,
+                    name=node.pool.name,
+                    primary=node.primary,
+                    txid=node.txid,
+                    lag=node.lag,
+                    healthy=node.healthy,
+                    ejected=not node.primary and now < node.ejected_until,
+                    latency_avg=node.stats["latency_total"] / node.stats["routed"] if node.stats["routed"] else 0.0,
+                )
+                for node in [self.primary, *self.replicas]
+            ]
+        return stats
+
+
+class ReadPositionMiddleware:
+    """Pure ASGI middleware adding the primary's position to the responses of writes.
+
+    The position is read when the response starts, after the handler's
+    transaction has committed.
+    """
+
+    def __init__(self, app, router):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD") or not self.router.replicas:
+            return await self.app(scope, receive, send)
+
+        async def send_with_position(message):
+            # Failed requests may have written too, e.g. an enrollment answered with a waitlist position
+            if message["type"] == "http.response.start":
+                txid = self.router.position()
+                if txid is not None:
+                    message["headers"] = [*message.get("headers", []), (POSITION_HEADER.lower().encode(), f"{txid:x}".encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_position)
@@ -0,0 +1,59 @@
+"""
+Fast JSON path for list responses.
+
+sqlite3.Row objects have to go through FastAPI's jsonable_encoder before
+they can be dumped. Fetching plain tuples and zipping them with the column
+names once per query gives dicts that orjson encodes directly, and returning
+an ORJSONResponse skips the generic encoder altogether.
+"""
+
+import orjson
+from fastapi.responses import ORJSONResponse, Response
+
+JSON = "application/json"
+
+
+def _dict_cursor(db, sql, params):
+    cur = db.cursor()
+    cur.row_factory = None
+    cur.execute(sql, params)
+    return cur, [column[0] for column in cur.description]
+
+
+def query_dicts(db, sql, params=()):
+    cur, names = _dict_cursor(db, sql, params)
+    return [dict(zip(names, row)) for row in cur.fetchall()]
+
+
+def iter_dicts(db, sql, params=()):
+    cur, names = _dict_cursor(db, sql, params)
+    for row in cur:
+        yield dict(zip(names, row))
+
+
+def dumps(content):
+    return orjson.dumps(content)
+
+
+def json_response(content, status_code=200, headers=None):
+    return ORJSONResponse(content, status_code=status_code, headers=headers)
+
+
+def raw_json_response(body, status_code=200, headers=None):
+    # For bodies that were encoded once and cached
+    return Response(body, status_code=status_code, headers=headers, media_type=JSON)
+
+
+def etag_matches(request, etag):
+    """Whether the client's ``If-None-Match`` names ``etag``, so its copy is current."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def not_modified(headers):
+    return Response(status_code=304, headers=headers)
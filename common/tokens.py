@@ -0,0 +1,182 @@
+"""
+Local verification of the JWTs KrakenD issues.
+
+The backends used to decode tokens without checking them and relied on the
+gateway, so anything that reached their ports directly could claim to be
+anyone. TokenVerifier checks the signature against the same JWK set the
+gateway uses (users/share/symmetric.json), cheaply:
+
+* KeySet parses the file once and keeps the keys by ``kid``. The file is
+  stat()ed at most once per ``check_interval`` and reloaded when it
+  changes, so a key rotation needs no restart.
+* Verified claims are remembered per token string until the token expires,
+  in an LRU of ``maxsize`` entries. A token seen before costs a dict lookup
+  and a clock read. A key reload empties it.
+
+Tokens without ``exp`` are rejected, so nothing stays valid forever.
+"""
+
+import base64
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import jwt
+
+DEFAULT_ALGORITHMS = ("HS256",)
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CHECK_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class KeySet:
+    COUNTERS = ("reloads",)
+
+    def __init__(self, path, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._signature = None  # (mtime, size) of the loaded file
+        self._checked_at = None
+        self._stats = {"reloads": 0}
+        self.generation = 0
+        # Fail at startup rather than on the first request
+        self.refresh(force=True)
+
+    @staticmethod
+    def _parse(jwk):
+        if jwk.get("kty") != "oct":
+            raise ValueError(f"unsupported key type {jwk.get('kty')!r}")
+        k = jwk["k"]
+        return base64.urlsafe_b64decode(k + "=" * (-len(k) % 4))
+
+    def _load(self, signature):
+        with open(self.path) as f:
+            document = json.load(f)
+        keys = {jwk.get("kid"): self._parse(jwk) for jwk in document.get("keys", [])}
+        self._keys, self._signature = keys, signature
+        self.generation += 1
+        self._stats["reloads"] += 1
+
+    def refresh(self, force=False):
+        """Reload the file if it changed. Returns True when it was reloaded."""
+        now = time.monotonic()
+        with self._lock:
+            if not force and self._checked_at is not None and now - self._checked_at < self.check_interval:
+                return False
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if signature == self._signature and not force:
+                    return False
+                self._load(signature)
+            except (OSError, ValueError, KeyError) as e:
+                if self._signature is None:
+                    raise
+                # Half-written or missing while it is being replaced, keep the keys we have
+                logger.warning("cannot reload %s, keeping the previous keys: %s", self.path, e)
+                return False
+            return True
+
+    def get(self, kid):
+        keys = self._keys
+        if kid is None and len(keys) == 1:
+            # A single key needs no kid
+            return next(iter(keys.values()))
+        try:
+            return keys[kid]
+        except KeyError:
+            raise jwt.InvalidKeyError(f"unknown key id {kid!r}") from None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["keys"] = len(self._keys)
+        return stats
+
+
+class TokenVerifier:
+    COUNTERS = ("hits", "misses", "rejected", "expired", "evicted")
+
+    def __init__(self, keys, algorithms=DEFAULT_ALGORITHMS, audience=None, maxsize=DEFAULT_CACHE_SIZE):
+        self.keys = keys
+        self.algorithms = list(algorithms)
+        self.audience = audience
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._claims = collections.OrderedDict()  # token -> (exp, claims)
+        self._generation = None
+        self._stats = {"hits": 0, "misses": 0, "rejected": 0, "expired": 0, "evicted": 0}
+
+    def verify(self, token):
+        """Return the claims of ``token``, or raise a jwt.PyJWTError."""
+        self.keys.refresh()
+        now = time.time()
+        with self._lock:
+            if self._generation != self.keys.generation:
+                # The keys changed, tokens verified with the old ones must be checked again
+                self._claims.clear()
+                self._generation = self.keys.generation
+            entry = self._claims.get(token)
+            if entry is not None:
+                if entry[0] > now:
+                    self._claims.move_to_end(token)
+                    self._stats["hits"] += 1
+                    return entry[1]
+                del self._claims[token]
+                self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            generation = self._generation
+
+        try:
+            key = self.keys.get(jwt.get_unverified_header(token).get("kid"))
+            claims = jwt.decode(
+                token, key, algorithms=self.algorithms, audience=self.audience,
+                options={"require": ["exp"], "verify_aud": self.audience is not None},
+            )
+        except jwt.PyJWTError:
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise
+
+        if self.maxsize > 0:
+            with self._lock:
+                if generation != self._generation:
+                    # Verified with keys that were replaced in the meantime
+                    return claims
+                self._claims[token] = (claims["exp"], claims)
+                while len(self._claims) > self.maxsize:
+                    self._claims.popitem(last=False)
+                    self._stats["evicted"] += 1
+        return claims
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._claims)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+def bearer_token(request):
+    """The token of an ``Authorization: Bearer`` header, or None."""
+    scheme, _, token = (request.headers.get("Authorization") or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return token.strip()
+
+
+def role_list(roles):
+    """The roles of a ``roles`` claim or Roles column, a list or a comma/space separated string."""
+    if not roles:
+        return []
+    if isinstance(roles, str):
+        return roles.replace(",", " ").split()
+    return list(roles)
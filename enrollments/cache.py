@@ -0,0 +1,60 @@
+"""
+Per-worker read cache invalidated through generation counters in SQLite.
+
+Triggers bump CacheGenerations.Generation whenever the underlying table
+changes, so a cached value is reused only while the generation it was loaded
+under is still current. Checking costs one primary-key lookup instead of
+re-running the query, and works across every worker sharing the database.
+"""
+
+import threading
+import time
+
+DEFAULT_TTL = 30.0
+GENERATION = "SELECT Generation FROM CacheGenerations WHERE Name = ?"
+
+
+class GenerationCache:
+    COUNTERS = ("hits", "misses", "expired", "invalidated")
+
+    def __init__(self, name, ttl=DEFAULT_TTL):
+        self.name = name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entry = None  # (generation, loaded_at, value)
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "invalidated": 0}
+
+    def generation(self, db):
+        row = db.execute(GENERATION, [self.name]).fetchone()
+        return row[0] if row else None
+
+    def get(self, db, loader):
+        # Read the generation before the data, so a concurrent write can only make the entry stale early
+        generation = self.generation(db)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry
+            if entry is not None and generation is not None:
+                cached_generation, loaded_at, value = entry
+                if cached_generation == generation and now - loaded_at < self.ttl:
+                    self._stats["hits"] += 1
+                    return value
+                self._stats["expired" if cached_generation == generation else "invalidated"] += 1
+            self._stats["misses"] += 1
+
+        value = loader()
+        with self._lock:
+            self._entry = (generation, now, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entry = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["generation"] = self._entry[0] if self._entry else None
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
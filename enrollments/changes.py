@@ -0,0 +1,171 @@
+"""
+Seat and waitlist changes pushed to the clients watching a class.
+
+The ClassGenerations counters of migration 6 are bumped by every change to a
+section or its waitlist, whichever worker makes it. ChangeBus polls the
+counters of the classes its subscribers watch, one query for all of them,
+and when one moved it reads the section's seats and waitlist and hands the
+snapshot to every subscriber of that class. The write endpoints of this
+worker call ``publish`` so their own changes go out without waiting for the
+next poll. Nothing is polled while no one is watching.
+
+A subscriber keeps only the latest snapshot of each class, so a slow client
+skips intermediate states instead of queueing them.
+"""
+
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+
+DEFAULT_INTERVAL = 0.2
+
+logger = logging.getLogger(__name__)
+
+WATCHED_GENERATIONS = """
+    SELECT ClassId, Generation FROM ClassGenerations
+    WHERE ClassId IN (SELECT value FROM json_each(?))
+"""
+CLASS_SNAPSHOTS = """
+    SELECT
+    ClassId, CurrentEnrollment, MaxEnrollment, AutomaticEnrollmentFrozen,
+    (SELECT Generation FROM ClassGenerations WHERE ClassId = Classes.ClassId) AS Generation,
+    -- json_group_array keeps no order, read_snapshots sorts the entries by position
+    (SELECT json_group_array(json_array(WaitingListPos, StudentUserName)) FROM WaitingLists
+     WHERE ClassId = Classes.ClassId) AS Waitlist
+    FROM Classes
+    WHERE ClassId IN (SELECT value FROM json_each(?))
+"""
+
+
+def read_snapshots(db, class_ids, generations=None):
+    """Snapshots of the sections in ``class_ids`` whose counter differs from ``generations``.
+
+    A section that no longer exists gets a snapshot with ``removed`` set.
+    """
+    if generations is not None:
+        current = dict(db.execute(WATCHED_GENERATIONS, [json.dumps(sorted(class_ids))]).fetchall())
+        class_ids = [class_id for class_id in class_ids if current.get(class_id, 0) != generations.get(class_id)]
+        if not class_ids:
+            return {}
+    snapshots = {class_id: {"ClassId": class_id, "removed": True, "Generation": None} for class_id in class_ids}
+    for row in db.execute(CLASS_SNAPSHOTS, [json.dumps(sorted(class_ids))]):
+        snapshot = dict(row)
+        snapshot["Generation"] = snapshot["Generation"] or 0
+        snapshot["Waitlist"] = [username for _, username in sorted(json.loads(snapshot["Waitlist"]))]
+        snapshots[row["ClassId"]] = snapshot
+    if generations is not None:
+        for class_id, snapshot in snapshots.items():
+            if snapshot["Generation"] is None:
+                snapshot["Generation"] = current.get(class_id, 0)
+    return snapshots
+
+
+class Subscription:
+    def __init__(self, class_ids):
+        self.class_ids = frozenset(class_ids)
+        self._pending = {}
+        self._ready = asyncio.Event()
+        self._sent = {}  # ClassId -> generation of the last snapshot handed out
+
+    def offer(self, snapshot):
+        if snapshot["Generation"] is not None and self._sent.get(snapshot["ClassId"], -1) >= snapshot["Generation"]:
+            return
+        # Latest wins, a subscriber that has not caught up skips the states in between
+        self._pending[snapshot["ClassId"]] = snapshot
+        self._ready.set()
+
+    async def get(self, timeout=None):
+        """Wait for changed snapshots, an empty list after ``timeout`` seconds without any."""
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        self._ready.clear()
+        snapshots, self._pending = list(self._pending.values()), {}
+        for snapshot in snapshots:
+            self._sent[snapshot["ClassId"]] = snapshot["Generation"]
+        return snapshots
+
+
+class ChangeBus:
+    COUNTERS = ("polls", "changes", "deliveries", "subscriptions")
+
+    def __init__(self, database, interval=DEFAULT_INTERVAL):
+        self.database = database
+        self.interval = interval
+        self._subscribers = collections.defaultdict(set)  # ClassId -> subscriptions
+        self._generations = {}  # ClassId -> last generation seen
+        self._wakeup = None
+        self._task = None
+        self._stats = {"polls": 0, "changes": 0, "deliveries": 0, "subscriptions": 0}
+
+    # ------------- Lifecycle -------------
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            self._wakeup.clear()
+            if not self._subscribers:
+                continue
+            try:
+                await self.poll()
+            except Exception:
+                # A replica going away must not end the feed, the next poll tries again
+                logger.exception("polling class changes failed")
+
+    async def poll(self):
+        class_ids = list(self._subscribers)
+        generations = {class_id: self._generations.get(class_id) for class_id in class_ids}
+        snapshots = await self.database.read(read_snapshots, class_ids, generations, label="watch_classes")
+        self._stats["polls"] += 1
+        for class_id, snapshot in snapshots.items():
+            self._generations[class_id] = snapshot["Generation"]
+            self._stats["changes"] += 1
+            for subscription in self._subscribers.get(class_id, ()):
+                subscription.offer(snapshot)
+                self._stats["deliveries"] += 1
+
+    # ------------- Publishing -------------
+
+    def publish(self, *class_ids):
+        """Poll now rather than at the next interval, if anyone watches ``class_ids``."""
+        if self._wakeup is not None and any(class_id in self._subscribers for class_id in class_ids):
+            self._wakeup.set()
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, class_ids):
+        """Register a Subscription to ``class_ids``, primed with their current snapshots."""
+        subscription = Subscription(class_ids)
+        for class_id in subscription.class_ids:
+            self._subscribers[class_id].add(subscription)
+        self._stats["subscriptions"] += 1
+        try:
+            # Read after registering, so a change from now on is either in this snapshot or polled later
+            for snapshot in (await self.database.read(read_snapshots, sorted(subscription.class_ids), label="watch_classes")).values():
+                subscription.offer(snapshot)
+            yield subscription
+        finally:
+            for class_id in subscription.class_ids:
+                subscribers = self._subscribers[class_id]
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[class_id]
+                    self._generations.pop(class_id, None)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["subscribers"] = len({s for subscribers in self._subscribers.values() for s in subscribers})
+        stats["watched_classes"] = len(self._subscribers)
+        return stats
@@ -0,0 +1,424 @@
+"""
+Seat accounting and waitlist promotion for the enrollments service.
+
+Every mutation runs as one short BEGIN IMMEDIATE transaction. When an
+EnrollmentEngine call is made inside a transaction that is already open it
+uses a SAVEPOINT instead, so callers can group several operations under a
+single commit and still roll back one failed item.
+"""
+
+import collections
+import contextlib
+import json
+import sqlite3
+import time
+
+from common.aio import LOCK_WAIT_SECONDS, TRANSACTION_SECONDS
+
+MAX_WAITLIST_SIZE = 15
+MAX_STUDENT_WAITLISTS = 3
+# WaitingLists.WaitingListPos is a per-class sequence number that only grows.
+# A student's position is its rank among the remaining entries, computed on read.
+
+EnrollResult = collections.namedtuple("EnrollResult", ["status", "id", "position"])
+Promotion = collections.namedtuple("Promotion", ["StudentUserName", "StudentName"])
+
+ENROLLED = "enrolled"
+REENROLLED = "reenrolled"
+WAITLISTED = "waitlisted"
+
+# The state enroll_many needs for a whole batch, one query each. The batch is
+# passed as a single JSON parameter, so its size is not bound by SQLite's
+# variable limit.
+BATCH_CLASSES = """
+    SELECT
+    ClassId, CurrentEnrollment, MaxEnrollment, AutomaticEnrollmentFrozen,
+    (SELECT COUNT(*) FROM WaitingLists WHERE ClassId = Classes.ClassId) AS ClassWaitlist,
+    (SELECT IFNULL(MAX(WaitingListPos), 0) FROM WaitingLists WHERE ClassId = Classes.ClassId) AS LastWaitingListSeq
+    FROM Classes
+    WHERE ClassId IN (SELECT value FROM json_each(?))
+"""
+# Dropped is NULL without an enrollment, 0 for an active one and 1 when only dropped ones exist
+BATCH_PAIRS = """
+    SELECT
+    Pairs.ClassId, Pairs.StudentUserName,
+    (SELECT MIN(Dropped) FROM Enrollments
+     WHERE ClassId = Pairs.ClassId AND StudentUserName = Pairs.StudentUserName) AS Dropped,
+    EXISTS (SELECT 1 FROM WaitingLists
+            WHERE ClassId = Pairs.ClassId AND StudentUserName = Pairs.StudentUserName) AS Waitlisted
+    FROM (SELECT json_extract(value, '$[0]') AS ClassId, json_extract(value, '$[1]') AS StudentUserName FROM json_each(?)) AS Pairs
+"""
+BATCH_STUDENT_WAITLISTS = """
+    SELECT StudentUserName, COUNT(*) AS Waitlists FROM WaitingLists
+    WHERE StudentUserName IN (SELECT value FROM json_each(?))
+    GROUP BY StudentUserName
+"""
+BATCH_INSERT_ENROLLMENTS = """
+    INSERT INTO Enrollments(StudentUserName,StudentName,ClassId,EnrollmentDate)
+    SELECT json_extract(value, '$[1]'), json_extract(value, '$[2]'), json_extract(value, '$[0]'), datetime('now') FROM json_each(?)
+    RETURNING EnrollmentId, ClassId, StudentUserName
+"""
+BATCH_INSERT_WAITLISTS = """
+    INSERT INTO WaitingLists(StudentUserName,StudentName,ClassId,WaitingListPos,DateAdded)
+    SELECT json_extract(value, '$[1]'), json_extract(value, '$[2]'), json_extract(value, '$[0]'), json_extract(value, '$[3]'), datetime('now') FROM json_each(?)
+    RETURNING WaitListId, ClassId, StudentUserName
+"""
+
+# Claim a seat only if the section is open, has room and the student is not already in it
+CLAIM_SEAT = """
+    UPDATE Classes SET CurrentEnrollment = CurrentEnrollment + 1
+    WHERE ClassId = ?
+    AND CurrentEnrollment < MaxEnrollment
+    AND AutomaticEnrollmentFrozen = 0
+    AND NOT EXISTS (
+        SELECT 1 FROM Enrollments
+        WHERE ClassId = Classes.ClassId AND StudentUserName = ? AND Dropped = 0
+    )
+    RETURNING CurrentEnrollment
+"""
+REENROLL = "UPDATE Enrollments SET Dropped = 0 WHERE ClassId = ? AND StudentUserName = ? AND Dropped = 1"
+INSERT_ENROLLMENT = """
+    INSERT INTO Enrollments(StudentUserName,StudentName,ClassId,EnrollmentDate)
+    VALUES(?,?,?, datetime('now'))
+"""
+# Why no seat was claimed, in a single round trip
+ENROLL_DIAGNOSIS = """
+    SELECT
+    AutomaticEnrollmentFrozen,
+    EXISTS (SELECT 1 FROM Enrollments WHERE ClassId = Classes.ClassId AND StudentUserName = ? AND Dropped = 0) AS Enrolled,
+    EXISTS (SELECT 1 FROM WaitingLists WHERE ClassId = Classes.ClassId AND StudentUserName = ?) AS Waitlisted,
+    (SELECT COUNT(*) FROM WaitingLists WHERE StudentUserName = ?) AS StudentWaitlists,
+    (SELECT COUNT(*) FROM WaitingLists WHERE ClassId = Classes.ClassId) AS ClassWaitlist,
+    (SELECT IFNULL(MAX(WaitingListPos), 0) FROM WaitingLists WHERE ClassId = Classes.ClassId) AS LastWaitingListSeq
+    FROM Classes
+    WHERE ClassId = ?
+"""
+INSERT_WAITLIST = """
+    INSERT INTO WaitingLists(StudentUserName,StudentName,ClassId,WaitingListPos,DateAdded)
+    VALUES(?,?, ?, ? , datetime('now'))
+"""
+ADD_SEATS = "UPDATE Classes SET CurrentEnrollment = CurrentEnrollment + ? WHERE ClassId = ?"
+
+CLASS_INSTRUCTOR = "SELECT InstructorUserName FROM Classes WHERE ClassId = ?"
+DROP_ENROLLMENT = "UPDATE Enrollments SET Dropped = 1 WHERE ClassId = ? AND StudentUserName = ? AND Dropped = 0"
+RELEASE_SEAT = "UPDATE Classes SET CurrentEnrollment = CurrentEnrollment - 1 WHERE ClassId = ?"
+# Positions are ranked on read, so leaving the waitlist is a single DELETE
+LEAVE_WAITLIST = "DELETE FROM WaitingLists WHERE StudentUserName = ? AND ClassId = ?"
+
+CLASS_ENROLLMENT = "SELECT CurrentEnrollment FROM Classes WHERE ClassId = ?"
+SET_CAPACITY = "UPDATE Classes SET MaxEnrollment = ? WHERE ClassId = ?"
+CLASS_FROZEN = "SELECT AutomaticEnrollmentFrozen FROM Classes WHERE ClassId = ?"
+UNFREEZE_CLASS = "UPDATE Classes SET AutomaticEnrollmentFrozen = 0 WHERE ClassId = ?"
+
+# Up to ? waitlisted students at the head of a class' queue
+WAITLIST_HEAD = """
+    SELECT WaitListId FROM WaitingLists
+    WHERE ClassId = ?
+    ORDER BY WaitingListPos
+    LIMIT ?
+"""
+OPEN_SEATS = "SELECT MaxEnrollment - CurrentEnrollment AS OpenSeats, AutomaticEnrollmentFrozen FROM Classes WHERE ClassId = ?"
+# enroll never waitlists an enrolled student, but inconsistent data can. Such
+# entries leave the waitlist before the head is picked, so they take no seat.
+DEQUEUE_ENROLLED = """
+    DELETE FROM WaitingLists
+    WHERE ClassId = ?
+    AND EXISTS (
+        SELECT 1 FROM Enrollments
+        WHERE Enrollments.ClassId = WaitingLists.ClassId
+        AND Enrollments.StudentUserName = WaitingLists.StudentUserName
+        AND Enrollments.Dropped = 0
+    )
+"""
+# Students who dropped this class earlier get their old row back
+PROMOTE_REENROLL = f"""
+    UPDATE Enrollments SET Dropped = 0
+    WHERE ClassId = ? AND Dropped = 1
+    AND StudentUserName IN (
+        SELECT StudentUserName FROM WaitingLists WHERE WaitListId IN ({WAITLIST_HEAD})
+    )
+"""
+PROMOTE_INSERT = f"""
+    INSERT INTO Enrollments(StudentUserName,StudentName,ClassId,EnrollmentDate)
+    SELECT StudentUserName, StudentName, ClassId, datetime('now')
+    FROM WaitingLists
+    WHERE WaitListId IN ({WAITLIST_HEAD})
+    AND NOT EXISTS (
+        SELECT 1 FROM Enrollments
+        WHERE Enrollments.ClassId = WaitingLists.ClassId
+        AND Enrollments.StudentUserName = WaitingLists.StudentUserName
+    )
+    ORDER BY WaitingListPos
+"""
+PROMOTE_DEQUEUE = f"""
+    DELETE FROM WaitingLists
+    WHERE WaitListId IN ({WAITLIST_HEAD})
+    RETURNING StudentUserName, StudentName
+"""
+
+
+class EnrollmentError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class EnrollmentEngine:
+    def __init__(self, db: sqlite3.Connection, name="enrollments"):
+        self.db = db
+        self.name = name  # database label of the metrics
+
+    @contextlib.contextmanager
+    def transaction(self):
+        db = self.db
+        nested = db.in_transaction
+        if nested:
+            db.execute("SAVEPOINT engine")
+        else:
+            # Take the write lock up front so the reads inside cannot go stale
+            begin = time.perf_counter()
+            db.execute("BEGIN IMMEDIATE")
+            LOCK_WAIT_SECONDS.observe(time.perf_counter() - begin, self.name)
+        try:
+            yield db
+        except BaseException as e:
+            if nested:
+                db.execute("ROLLBACK TO engine")
+                db.execute("RELEASE engine")
+            else:
+                db.rollback()
+            if isinstance(e, sqlite3.IntegrityError):
+                raise EnrollmentError(409, {"type": type(e).__name__, "msg": str(e)}) from e
+            raise
+        else:
+            if nested:
+                db.execute("RELEASE engine")
+            else:
+                db.commit()
+                TRANSACTION_SECONDS.observe(time.perf_counter() - begin, self.name, "single")
+
+    # ------------- Students -------------
+
+    def enroll(self, class_id, username, full_name):
+        db = self.db
+        with self.transaction():
+            seat = db.execute(CLAIM_SEAT, [class_id, username]).fetchone()
+
+            if seat:
+                # Re-enroll a student who dropped earlier, otherwise add a new enrollment
+                cur = db.execute(REENROLL, [class_id, username])
+                if cur.rowcount > 0:
+                    return EnrollResult(REENROLLED, None, None)
+                cur = db.execute(INSERT_ENROLLMENT, [username, full_name, class_id])
+                return EnrollResult(ENROLLED, cur.lastrowid, None)
+
+            # No seat was claimed, find out why in a single round trip
+            entry = db.execute(ENROLL_DIAGNOSIS, [username, username, username, class_id]).fetchone()
+            if not entry:
+                raise EnrollmentError(404, "Class Does Not Exist")
+            if entry["AutomaticEnrollmentFrozen"] == 1:
+                raise EnrollmentError(409, "Enrollment is closed")
+            if entry["Enrolled"]:
+                raise EnrollmentError(409, "You are already enrolled")
+
+            # Class is full, adding student to the waitlist
+            if entry["Waitlisted"]:
+                raise EnrollmentError(409, "You are already on waitlist")
+            if entry["StudentWaitlists"] >= MAX_STUDENT_WAITLISTS:
+                raise EnrollmentError(409, "Class is full and You are already on three waitlists so, you can't be placed on a waitlist")
+            if entry["ClassWaitlist"] >= MAX_WAITLIST_SIZE:
+                raise EnrollmentError(403, "Waiting List if full for this class")
+            cur = db.execute(INSERT_WAITLIST, [username, full_name, class_id, entry["LastWaitingListSeq"] + 1])
+            return EnrollResult(WAITLISTED, cur.lastrowid, entry["ClassWaitlist"] + 1)
+
+    def enroll_many(self, items, atomic=False):
+        """Enroll many (class_id, username, full_name) items in one transaction.
+
+        Each item gets the outcome ``enroll`` would have given it had the
+        items been sent one after another: an EnrollResult, or the
+        EnrollmentError it would have raised. The state of every class,
+        enrollment and waitlist involved is read with three queries and the
+        outcomes are written with a handful of statements, however many
+        items there are. With ``atomic`` nothing is written unless every item
+        succeeds.
+        """
+        db = self.db
+        with self.transaction():
+            classes = {
+                row["ClassId"]: dict(row)
+                for row in db.execute(BATCH_CLASSES, [json.dumps(sorted({item[0] for item in items}))])
+            }
+            pairs = {
+                (row["ClassId"], row["StudentUserName"]): {"Dropped": row["Dropped"], "Waitlisted": row["Waitlisted"]}
+                for row in db.execute(BATCH_PAIRS, [json.dumps(sorted({item[:2] for item in items}))])
+            }
+            student_waitlists = collections.Counter(dict(
+                db.execute(BATCH_STUDENT_WAITLISTS, [json.dumps(sorted({item[1] for item in items}))]).fetchall()
+            ))
+
+            results, reenrolled, enrolled, waitlisted = [], [], [], []
+            for class_id, username, full_name in items:
+                entry, pair = classes.get(class_id), pairs[class_id, username]
+                if not entry:
+                    results.append(EnrollmentError(404, "Class Does Not Exist"))
+                elif (entry["CurrentEnrollment"] < entry["MaxEnrollment"] and entry["AutomaticEnrollmentFrozen"] == 0
+                      and pair["Dropped"] != 0):
+                    entry["CurrentEnrollment"] += 1
+                    if pair["Dropped"] == 1:
+                        reenrolled.append((class_id, username))
+                        results.append(EnrollResult(REENROLLED, None, None))
+                    else:
+                        enrolled.append((class_id, username, full_name))
+                        results.append(EnrollResult(ENROLLED, None, None))
+                    pair["Dropped"] = 0
+                elif entry["AutomaticEnrollmentFrozen"] == 1:
+                    results.append(EnrollmentError(409, "Enrollment is closed"))
+                elif pair["Dropped"] == 0:
+                    results.append(EnrollmentError(409, "You are already enrolled"))
+                elif pair["Waitlisted"]:
+                    results.append(EnrollmentError(409, "You are already on waitlist"))
+                elif student_waitlists[username] >= MAX_STUDENT_WAITLISTS:
+                    results.append(EnrollmentError(409, "Class is full and You are already on three waitlists so, you can't be placed on a waitlist"))
+                elif entry["ClassWaitlist"] >= MAX_WAITLIST_SIZE:
+                    results.append(EnrollmentError(403, "Waiting List if full for this class"))
+                else:
+                    entry["ClassWaitlist"] += 1
+                    entry["LastWaitingListSeq"] += 1
+                    student_waitlists[username] += 1
+                    pair["Waitlisted"] = 1
+                    waitlisted.append((class_id, username, full_name, entry["LastWaitingListSeq"]))
+                    results.append(EnrollResult(WAITLISTED, None, entry["ClassWaitlist"]))
+
+            if atomic and any(isinstance(result, EnrollmentError) for result in results):
+                return results
+
+            db.executemany(REENROLL, reenrolled)
+            ids = {}
+            if enrolled:
+                ids.update(((row[1], row[2]), row[0]) for row in db.execute(BATCH_INSERT_ENROLLMENTS, [json.dumps(enrolled)]))
+            if waitlisted:
+                ids.update(((row[1], row[2]), row[0]) for row in db.execute(BATCH_INSERT_WAITLISTS, [json.dumps(waitlisted)]))
+            seats = collections.Counter(item[0] for item in (*reenrolled, *enrolled))
+            db.executemany(ADD_SEATS, [(count, class_id) for class_id, count in seats.items()])
+            # A (class, student) pair is enrolled or waitlisted at most once per batch
+            return [
+                result._replace(id=ids[class_id, username]) if isinstance(result, EnrollResult) and result.status != REENROLLED else result
+                for result, (class_id, username, _) in zip(results, items)
+            ]
+
+    def drop(self, class_id, username, instructor=None):
+        """Drop an active enrollment and refill the freed seat from the waitlist.
+
+        When ``instructor`` is given the drop is administrative and only the
+        instructor of the section may make it.
+        """
+        db = self.db
+        with self.transaction():
+            entry = db.execute(CLASS_INSTRUCTOR, [class_id]).fetchone()
+            if not entry:
+                raise EnrollmentError(404, "Class does not exist")
+            if instructor is not None and entry["InstructorUserName"] != instructor:
+                raise EnrollmentError(403, "You are not the instructor of this class")
+
+            cur = db.execute(DROP_ENROLLMENT, [class_id, username])
+            if cur.rowcount == 0:
+                if instructor is not None:
+                    raise EnrollmentError(404, "Student is not enrolled in this class")
+                raise EnrollmentError(404, "You are not enrolled in this course")
+            db.execute(RELEASE_SEAT, [class_id])
+            return self.promote(class_id)
+
+    def leave_waitlist(self, class_id, username):
+        with self.transaction():
+            cur = self.db.execute(LEAVE_WAITLIST, [username, class_id])
+            if cur.rowcount == 0:
+                raise EnrollmentError(404, "Not in Waitlist")
+
+    # ------------- Registrar -------------
+
+    def set_capacity(self, class_id, max_enrollment):
+        db = self.db
+        with self.transaction():
+            entry = db.execute(CLASS_ENROLLMENT, [class_id]).fetchone()
+            if not entry:
+                raise EnrollmentError(404, "Class Does Not Exist")
+            if max_enrollment < entry["CurrentEnrollment"]:
+                raise EnrollmentError(409, f"{entry['CurrentEnrollment']} students are already enrolled in this class")
+            db.execute(SET_CAPACITY, [max_enrollment, class_id])
+            return self.promote(class_id)
+
+    def unfreeze(self, class_id):
+        db = self.db
+        with self.transaction():
+            entry = db.execute(CLASS_FROZEN, [class_id]).fetchone()
+            if not entry:
+                raise EnrollmentError(404, "Class Does Not Exist")
+            if entry["AutomaticEnrollmentFrozen"] == 0:
+                raise EnrollmentError(409, "Automatic Enrollment Frozen is already OFF")
+            db.execute(UNFREEZE_CLASS, [class_id])
+            return self.promote(class_id)
+
+    # ------------- Waitlist promotion -------------
+
+    def promote(self, class_id, limit=None):
+        """Move students from the head of the waitlist into free seats.
+
+        Fills at most ``limit`` seats (all free seats by default) with a fixed
+        number of set-based statements, however many students move. Returns
+        the promoted students. Frozen sections are left alone.
+        """
+        db = self.db
+        with self.transaction():
+            entry = db.execute(OPEN_SEATS, [class_id]).fetchone()
+            if not entry or entry["AutomaticEnrollmentFrozen"] == 1:
+                return []
+            seats = entry["OpenSeats"] if limit is None else min(limit, entry["OpenSeats"])
+            if seats <= 0:
+                return []
+
+            db.execute(DEQUEUE_ENROLLED, [class_id])
+            reenrolled = db.execute(PROMOTE_REENROLL, [class_id, class_id, seats]).rowcount
+            inserted = db.execute(PROMOTE_INSERT, [class_id, seats]).rowcount
+            promoted = db.execute(PROMOTE_DEQUEUE, [class_id, seats]).fetchall()
+            db.execute(ADD_SEATS, [reenrolled + inserted, class_id])
+            return [Promotion(*row) for row in promoted]
+
+
+class AsyncEnrollmentEngine:
+    """EnrollmentEngine for async handlers.
+
+    Each call runs as one unit of work on the writer thread of an
+    ``common.aio.Session``, so its transaction never spans an ``await``.
+    The engine never commits inside an open transaction, so its calls can
+    share a group commit.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    async def _run(self, method, *args, **kwargs):
+        return await self.session.write(
+            lambda db: method(EnrollmentEngine(db), *args, **kwargs), batch=True, label=method.__name__
+        )
+
+    async def enroll(self, class_id, username, full_name):
+        return await self._run(EnrollmentEngine.enroll, class_id, username, full_name)
+
+    async def enroll_many(self, items, atomic=False):
+        return await self._run(EnrollmentEngine.enroll_many, items, atomic=atomic)
+
+    async def drop(self, class_id, username, instructor=None):
+        return await self._run(EnrollmentEngine.drop, class_id, username, instructor=instructor)
+
+    async def leave_waitlist(self, class_id, username):
+        return await self._run(EnrollmentEngine.leave_waitlist, class_id, username)
+
+    async def set_capacity(self, class_id, max_enrollment):
+        return await self._run(EnrollmentEngine.set_capacity, class_id, max_enrollment)
+
+    async def unfreeze(self, class_id):
+        return await self._run(EnrollmentEngine.unfreeze, class_id)
+
+    async def promote(self, class_id, limit=None):
+        return await self._run(EnrollmentEngine.promote, class_id, limit=limit)
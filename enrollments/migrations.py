@@ -0,0 +1,293 @@
+"""
+Versioned schema migrations for the enrollments database.
+
+The applied version is stored in PRAGMA user_version. Each migration runs in
+its own BEGIN IMMEDIATE transaction, so several workers starting at once apply
+it exactly once.
+"""
+
+import logging
+import sqlite3
+import sys
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = [
+    (1, "baseline schema", """
+        CREATE TABLE IF NOT EXISTS Classes (
+            ClassId INTEGER PRIMARY KEY,
+            InstructorName Text,
+            InstructorUserName ,
+            Department TEXT,
+            CourseCode TEXT,
+            SectionNumber INTEGER,
+            ClassName TEXT,
+            CurrentEnrollment INTEGER,
+            MaxEnrollment INTEGER,
+            AutomaticEnrollmentFrozen INTEGER DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS Enrollments (
+            EnrollmentId INTEGER PRIMARY KEY,
+            ClassId INT REFERENCES Classes(ClassId),
+            StudentName TEXT,
+            StudentUserName TEXT,
+            EnrollmentDate TEXT,
+            Dropped INT DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS WaitingLists (
+            WaitListId INTEGER PRIMARY KEY,
+            ClassId INT REFERENCES Classes(ClassId),
+            StudentName TEXT,
+            StudentUserName TEXT,
+            WaitingListPos INT,
+            DateAdded TEXT
+        );
+    """),
+    (2, "indexes for the enrollment and waitlist hot queries", """
+        -- Replace the ad-hoc indexes some databases were given by hand
+        DROP INDEX IF EXISTS Classes_idx_cd2de4cb;
+        DROP INDEX IF EXISTS Classes_idx_68585735;
+        DROP INDEX IF EXISTS Enrollments_idx_019274e8;
+        DROP INDEX IF EXISTS Enrollments_idx_962fea3d;
+        DROP INDEX IF EXISTS WaitingLists_idx_8ec6b486;
+
+        -- GET /classes only ever reads open, unfrozen sections
+        CREATE INDEX IF NOT EXISTS classes_available_idx
+            ON Classes(ClassId)
+            WHERE CurrentEnrollment < MaxEnrollment AND AutomaticEnrollmentFrozen = 0;
+        CREATE INDEX IF NOT EXISTS classes_instructor_idx
+            ON Classes(InstructorUserName);
+        CREATE INDEX IF NOT EXISTS classes_name_section_idx
+            ON Classes(ClassName, SectionNumber);
+
+        CREATE INDEX IF NOT EXISTS enrollments_class_student_idx
+            ON Enrollments(ClassId, StudentUserName, Dropped);
+        CREATE INDEX IF NOT EXISTS enrollments_dropped_idx
+            ON Enrollments(ClassId)
+            WHERE Dropped = 1;
+
+        CREATE INDEX IF NOT EXISTS waitinglists_class_pos_idx
+            ON WaitingLists(ClassId, WaitingListPos);
+        CREATE INDEX IF NOT EXISTS waitinglists_student_idx
+            ON WaitingLists(StudentUserName, ClassId);
+    """),
+    (3, "generation counters for cross-worker cache invalidation", """
+        CREATE TABLE IF NOT EXISTS CacheGenerations (
+            Name TEXT PRIMARY KEY,
+            Generation INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+
+        INSERT OR IGNORE INTO CacheGenerations(Name, Generation) VALUES ('classes', 0);
+
+        -- Any change to a section, whoever makes it, invalidates every worker's copy
+        CREATE TRIGGER IF NOT EXISTS classes_generation_insert AFTER INSERT ON Classes
+        BEGIN
+            UPDATE CacheGenerations SET Generation = Generation + 1 WHERE Name = 'classes';
+        END;
+        CREATE TRIGGER IF NOT EXISTS classes_generation_update AFTER UPDATE ON Classes
+        BEGIN
+            UPDATE CacheGenerations SET Generation = Generation + 1 WHERE Name = 'classes';
+        END;
+        CREATE TRIGGER IF NOT EXISTS classes_generation_delete AFTER DELETE ON Classes
+        BEGIN
+            UPDATE CacheGenerations SET Generation = Generation + 1 WHERE Name = 'classes';
+        END;
+    """),
+    (4, "indexes for the /classes filters", """
+        -- Secondary indexes end with the rowid, so each of these also yields ClassId order for keyset paging
+        CREATE INDEX IF NOT EXISTS classes_available_department_idx
+            ON Classes(Department)
+            WHERE CurrentEnrollment < MaxEnrollment AND AutomaticEnrollmentFrozen = 0;
+        CREATE INDEX IF NOT EXISTS classes_available_course_idx
+            ON Classes(CourseCode)
+            WHERE CurrentEnrollment < MaxEnrollment AND AutomaticEnrollmentFrozen = 0;
+    """),
+    (5, "per-student schedule summary", """
+        -- One row per section a student is enrolled in, dropped or waits for, with the class
+        -- columns copied in, so a schedule is one primary-key range. WaitingListPos is the
+        -- sequence number, the position is still ranked on read.
+        CREATE TABLE IF NOT EXISTS StudentSchedules (
+            StudentUserName TEXT NOT NULL,
+            ClassId INTEGER NOT NULL,
+            Status TEXT NOT NULL,
+            WaitingListPos INTEGER,
+            Department TEXT,
+            CourseCode TEXT,
+            SectionNumber INTEGER,
+            ClassName TEXT,
+            InstructorName TEXT,
+            PRIMARY KEY (StudentUserName, ClassId, Status)
+        ) WITHOUT ROWID;
+
+        -- Bumped whenever anything in a student's schedule changes, the ETag of /students/me/schedule
+        CREATE TABLE IF NOT EXISTS StudentScheduleVersions (
+            StudentUserName TEXT PRIMARY KEY,
+            Version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+
+        INSERT OR REPLACE INTO StudentSchedules
+        SELECT Enrollments.StudentUserName, Enrollments.ClassId,
+        CASE WHEN Enrollments.Dropped = 1 THEN 'dropped' ELSE 'enrolled' END, NULL,
+        Department, CourseCode, SectionNumber, ClassName, InstructorName
+        FROM Enrollments JOIN Classes ON Classes.ClassId = Enrollments.ClassId;
+        INSERT OR REPLACE INTO StudentSchedules
+        SELECT WaitingLists.StudentUserName, WaitingLists.ClassId, 'waitlisted', WaitingListPos,
+        Department, CourseCode, SectionNumber, ClassName, InstructorName
+        FROM WaitingLists JOIN Classes ON Classes.ClassId = WaitingLists.ClassId;
+        -- Built after the backfill, which is faster than maintaining it row by row
+        CREATE INDEX IF NOT EXISTS student_schedules_class_idx
+            ON StudentSchedules(ClassId);
+
+        -- Kept up to date by triggers, so every write path, the registrar's included, maintains it
+        CREATE TRIGGER IF NOT EXISTS enrollments_schedule_insert AFTER INSERT ON Enrollments
+        BEGIN
+            INSERT OR REPLACE INTO StudentSchedules
+            SELECT NEW.StudentUserName, NEW.ClassId, CASE WHEN NEW.Dropped = 1 THEN 'dropped' ELSE 'enrolled' END, NULL,
+            Department, CourseCode, SectionNumber, ClassName, InstructorName
+            FROM Classes WHERE ClassId = NEW.ClassId;
+            INSERT INTO StudentScheduleVersions(StudentUserName, Version) VALUES (NEW.StudentUserName, 1)
+            ON CONFLICT(StudentUserName) DO UPDATE SET Version = Version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS enrollments_schedule_update AFTER UPDATE OF Dropped ON Enrollments
+        WHEN OLD.Dropped IS NOT NEW.Dropped
+        BEGIN
+            UPDATE OR REPLACE StudentSchedules SET Status = CASE WHEN NEW.Dropped = 1 THEN 'dropped' ELSE 'enrolled' END
+            WHERE StudentUserName = NEW.StudentUserName AND ClassId = NEW.ClassId
+            AND Status = CASE WHEN OLD.Dropped = 1 THEN 'dropped' ELSE 'enrolled' END;
+            INSERT INTO StudentScheduleVersions(StudentUserName, Version) VALUES (NEW.StudentUserName, 1)
+            ON CONFLICT(StudentUserName) DO UPDATE SET Version = Version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS enrollments_schedule_delete AFTER DELETE ON Enrollments
+        BEGIN
+            DELETE FROM StudentSchedules
+            WHERE StudentUserName = OLD.StudentUserName AND ClassId = OLD.ClassId
+            AND Status = CASE WHEN OLD.Dropped = 1 THEN 'dropped' ELSE 'enrolled' END;
+            INSERT INTO StudentScheduleVersions(StudentUserName, Version) VALUES (OLD.StudentUserName, 1)
+            ON CONFLICT(StudentUserName) DO UPDATE SET Version = Version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS waitinglists_schedule_insert AFTER INSERT ON WaitingLists
+        BEGIN
+            INSERT OR REPLACE INTO StudentSchedules
+            SELECT NEW.StudentUserName, NEW.ClassId, 'waitlisted', NEW.WaitingListPos,
+            Department, CourseCode, SectionNumber, ClassName, InstructorName
+            FROM Classes WHERE ClassId = NEW.ClassId;
+            INSERT INTO StudentScheduleVersions(StudentUserName, Version) VALUES (NEW.StudentUserName, 1)
+            ON CONFLICT(StudentUserName) DO UPDATE SET Version = Version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS waitinglists_schedule_delete AFTER DELETE ON WaitingLists
+        BEGIN
+            DELETE FROM StudentSchedules
+            WHERE StudentUserName = OLD.StudentUserName AND ClassId = OLD.ClassId AND Status = 'waitlisted';
+            -- Everyone behind the student moves up one position
+            INSERT INTO StudentScheduleVersions(StudentUserName, Version)
+            SELECT StudentUserName, 1 FROM WaitingLists
+            WHERE ClassId = OLD.ClassId AND WaitingListPos > OLD.WaitingListPos
+            UNION SELECT OLD.StudentUserName, 1 WHERE true
+            ON CONFLICT(StudentUserName) DO UPDATE SET Version = Version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS classes_schedule_update
+        AFTER UPDATE OF Department, CourseCode, SectionNumber, ClassName, InstructorName ON Classes
+        BEGIN
+            UPDATE StudentSchedules SET Department = NEW.Department, CourseCode = NEW.CourseCode,
+            SectionNumber = NEW.SectionNumber, ClassName = NEW.ClassName, InstructorName = NEW.InstructorName
+            WHERE ClassId = NEW.ClassId;
+            INSERT INTO StudentScheduleVersions(StudentUserName, Version)
+            SELECT DISTINCT StudentUserName, 1 FROM StudentSchedules WHERE ClassId = NEW.ClassId
+            ON CONFLICT(StudentUserName) DO UPDATE SET Version = Version + 1;
+        END;
+    """),
+    (6, "per-class change counters for conditional GETs", """
+        -- Bumped by any change to a section or its waitlist, the ETag of the per-class views
+        CREATE TABLE IF NOT EXISTS ClassGenerations (
+            ClassId INTEGER PRIMARY KEY,
+            Generation INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE TRIGGER IF NOT EXISTS classes_class_generation_insert AFTER INSERT ON Classes
+        BEGIN
+            INSERT INTO ClassGenerations(ClassId, Generation) VALUES (NEW.ClassId, 1)
+            ON CONFLICT(ClassId) DO UPDATE SET Generation = Generation + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS classes_class_generation_update AFTER UPDATE ON Classes
+        BEGIN
+            INSERT INTO ClassGenerations(ClassId, Generation) VALUES (NEW.ClassId, 1)
+            ON CONFLICT(ClassId) DO UPDATE SET Generation = Generation + 1;
+        END;
+        -- The row is kept, so a section created again under the same ClassId does not reuse an ETag
+        CREATE TRIGGER IF NOT EXISTS classes_class_generation_delete AFTER DELETE ON Classes
+        BEGIN
+            INSERT INTO ClassGenerations(ClassId, Generation) VALUES (OLD.ClassId, 1)
+            ON CONFLICT(ClassId) DO UPDATE SET Generation = Generation + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS waitinglists_class_generation_insert AFTER INSERT ON WaitingLists
+        BEGIN
+            INSERT INTO ClassGenerations(ClassId, Generation) VALUES (NEW.ClassId, 1)
+            ON CONFLICT(ClassId) DO UPDATE SET Generation = Generation + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS waitinglists_class_generation_update AFTER UPDATE ON WaitingLists
+        BEGIN
+            INSERT INTO ClassGenerations(ClassId, Generation) VALUES (NEW.ClassId, 1)
+            ON CONFLICT(ClassId) DO UPDATE SET Generation = Generation + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS waitinglists_class_generation_delete AFTER DELETE ON WaitingLists
+        BEGIN
+            INSERT INTO ClassGenerations(ClassId, Generation) VALUES (OLD.ClassId, 1)
+            ON CONFLICT(ClassId) DO UPDATE SET Generation = Generation + 1;
+        END;
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def split_statements(script):
+    # sqlite3.complete_statement understands trigger bodies, a plain split(';') does not
+    statements, buffer = [], ""
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            if buffer.strip():
+                statements.append(buffer.strip())
+            buffer = ""
+    if buffer.strip() and not buffer.strip().startswith("--"):
+        statements.append(buffer.strip())
+    return statements
+
+
+def current_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db, target=LATEST_VERSION):
+    applied = []
+    for version, description, script in MIGRATIONS:
+        if version > target or version <= current_version(db):
+            continue
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Another worker may have applied it while we waited for the lock
+            if version <= current_version(db):
+                db.rollback()
+                continue
+            for statement in split_statements(script):
+                db.execute(statement)
+            db.execute(f"PRAGMA user_version = {version}")
+            db.commit()
+        except sqlite3.Error:
+            db.rollback()
+            raise
+        logger.info("applied migration %d: %s", version, description)
+        applied.append(version)
+    return applied
+
+
+if __name__ == "__main__":
+    database = sys.argv[1] if len(sys.argv) > 1 else "enrollments/pro1.db"
+    conn = sqlite3.connect(database)
+    try:
+        applied = migrate(conn)
+        print(f"{database}: schema version {current_version(conn)} (applied {applied or 'nothing'})")
+    finally:
+        conn.close()
@@ -1,17 +1,60 @@
-import collections
-import contextlib
 import logging.config
+import os
 import sqlite3
 import datetime
+import time
 from typing import Optional
-from fastapi import FastAPI, Depends, Response, HTTPException, status, Request
-from fastapi.responses import RedirectResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, Depends, Response, HTTPException, status, Request, Query
+from fastapi.responses import JSONResponse, ORJSONResponse, RedirectResponse, StreamingResponse
+from pydantic import BaseModel, Field
 import jwt
+from common.aio import AsyncDatabase, Session, Writer
+from common.logs import sql_tracer
+from common.metrics import CONTENT_TYPE, REGISTRY, MetricsMiddleware, StatsCollector, endpoint_label
+from common.pool import ConnectionPool, PoolTimeout, WRITER_PRAGMAS
+from common.replicas import DEFAULT_MAX_LAG, DEFAULT_PIN_SECONDS, Node, ReadPositionMiddleware, ReplicaRouter, read_key
+from common.serialization import dumps, etag_matches, json_response, not_modified, query_dicts, raw_json_response
+from common.tokens import DEFAULT_CACHE_SIZE as DEFAULT_TOKEN_CACHE_SIZE, KeySet, TokenVerifier, bearer_token, role_list
+from enrollments.cache import GenerationCache
+from enrollments.changes import ChangeBus
+from enrollments.engine import AsyncEnrollmentEngine, EnrollmentError, ENROLLED, REENROLLED, WAITLISTED
+from enrollments.migrations import migrate
+from enrollments.queries import (
+    CLASS_BY_ID, CLASS_BY_NAME_SECTION, CLASS_GENERATION, CLASS_WAITLIST, CLASS_WAITLIST_SIZE, CLASSES_GENERATION,
+    DELETE_CLASS, DELETE_CLASS_ENROLLMENTS, DELETE_CLASS_WAITLIST, DROPPED_STUDENTS, FREEZE_CLASS, INSERT_CLASS,
+    INSTRUCTOR_CLASSES, STUDENT_SCHEDULE, STUDENT_SCHEDULE_VERSION, UPDATE_INSTRUCTOR, WAITLIST_POSITION, available_classes,
+)
 
 # ------------- Constants -------------
-DATABASE='enrollments/pro1.db'
-LOGGING_CONFIG='enrollments/etc/logging.ini'
+DATABASE=os.environ.get('ENROLLMENTS_DATABASE', 'enrollments/pro1.db')
+# Comma-separated LiteFS replicas of DATABASE for the read-only endpoints
+REPLICA_DATABASES=[path for path in os.environ.get('ENROLLMENTS_REPLICAS', '').split(',') if path]
+REPLICA_MAX_LAG=int(os.environ.get('ENROLLMENTS_REPLICA_MAX_LAG', DEFAULT_MAX_LAG))
+READ_YOUR_WRITES_SECONDS=float(os.environ.get('ENROLLMENTS_READ_YOUR_WRITES_SECONDS', DEFAULT_PIN_SECONDS))
+LOGGING_CONFIG=os.environ.get('ENROLLMENTS_LOGGING_CONFIG', 'enrollments/etc/logging.ini')
+SQL_TRACE_SAMPLE_RATE=float(os.environ.get('ENROLLMENTS_SQL_TRACE_SAMPLE_RATE', 0.0))
+POOL_SIZE=int(os.environ.get('ENROLLMENTS_POOL_SIZE', 5))
+POOL_TIMEOUT=float(os.environ.get('ENROLLMENTS_POOL_TIMEOUT', 5.0))
+# Coalesce enrollment writes arriving within this many milliseconds into one commit, 0 disables
+GROUP_COMMIT_MS=float(os.environ.get('ENROLLMENTS_GROUP_COMMIT_MS', 0))
+GROUP_COMMIT_MAX=int(os.environ.get('ENROLLMENTS_GROUP_COMMIT_MAX', 64))
+# NDJSON streams open at once per worker, each keeps a read connection until its client has read it all
+MAX_STREAMS=int(os.environ.get('ENROLLMENTS_MAX_STREAMS', 2))
+# Reader threads per worker, by default one per read connection the streams leave free
+READ_THREADS=int(os.environ.get('ENROLLMENTS_READ_THREADS', max(POOL_SIZE - MAX_STREAMS, 1) * max(len(REPLICA_DATABASES), 1)))
+CLASSES_CACHE_TTL=float(os.environ.get('ENROLLMENTS_CLASSES_CACHE_TTL', 30.0))
+# The JWK set KrakenD signs and validates with
+JWK_PATH=os.environ.get('ENROLLMENTS_JWK_PATH', 'users/share/symmetric.json')
+TOKEN_CACHE_SIZE=int(os.environ.get('ENROLLMENTS_TOKEN_CACHE_SIZE', DEFAULT_TOKEN_CACHE_SIZE))
+# How long KrakenD may serve the shared list responses before revalidating them with their ETag
+HTTP_CACHE_MAX_AGE=int(os.environ.get('ENROLLMENTS_HTTP_CACHE_MAX_AGE', 1))
+MAX_PAGE_SIZE=500
+MAX_BATCH_SIZE=int(os.environ.get('ENROLLMENTS_MAX_BATCH_SIZE', 500))
+# How often each worker checks the watched sections for changes made by the other workers
+WATCH_POLL_MS=float(os.environ.get('ENROLLMENTS_WATCH_POLL_MS', 200))
+MAX_WATCHED_CLASSES=int(os.environ.get('ENROLLMENTS_MAX_WATCHED_CLASSES', 50))
+WATCH_HEARTBEAT_SECONDS=15
+NDJSON='application/x-ndjson'
 
 
 
@@ -19,16 +62,21 @@ LOGGING_CONFIG='enrollments/etc/logging.ini'
 Helper Functions
 """
 
-def decode_jwt(request: Request):
-    token_from_header = request.headers.get('Authorization')
-    token = token_from_header[7:] # Removing Bearer
+# Tokens are checked here as well as by the gateway, so the workers can be called directly
+token_verifier = TokenVerifier(KeySet(JWK_PATH), maxsize=TOKEN_CACHE_SIZE)
+
+async def decode_jwt(request: Request):
+    token = bearer_token(request)
+    if token is None:
+        return None
     try:
-        payload = jwt.decode(token, options={"verify_signature": False})
-        return payload
-    except jwt.ExpiredSignatureError:
+        payload = token_verifier.verify(token)
+    except jwt.PyJWTError:
         return None
-    except jwt.DecodeError:
+    # A refresh token is only good for getting a new access token from the users service
+    if payload.get("typ") == "refresh":
         return None
+    return payload
 
 async def get_current_user(request: Request, token: str = Depends(decode_jwt)):
     if token is None:
@@ -36,9 +84,93 @@ async def get_current_user(request: Request, token: str = Depends(decode_jwt)):
     return token
 
 
+class Page:
+    """Keyset pagination and NDJSON streaming options shared by the list endpoints.
+
+    ``after`` is the sort key of the last row of the previous page, as returned
+    in ``next_cursor``. Without ``limit`` the whole list is returned.
+    """
+    def __init__(
+        self,
+        request: Request,
+        after: Optional[int] = None,
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+        format: Optional[str] = Query(None, pattern="^(json|ndjson)$"),
+    ):
+        self.after = after
+        self.limit = limit
+        self.stream = format == "ndjson" or (format is None and NDJSON in request.headers.get("accept", ""))
+
+    @property
+    def is_default(self):
+        return self.after is None and self.limit is None and not self.stream
+
+    def fetch(self, conn, sql, params, key):
+        """This page of ``sql`` and the cursor of the next one, run inside a read unit."""
+        # One extra row tells us whether there is a next page without a COUNT(*)
+        if self.limit is None:
+            return query_dicts(conn, sql, params), None
+        rows = query_dicts(conn, f"{sql} LIMIT ?", [*params, self.limit + 1])
+        if len(rows) > self.limit:
+            return rows[:self.limit], rows[self.limit - 1][key]
+        return rows, None
+
+    async def open_stream(self, db, sql, params, head=None):
+        """``head(conn)`` and the rows of ``sql``, both read on the stream's connection."""
+        if self.limit is not None:
+            sql, params = f"{sql} LIMIT ?", [*params, self.limit]
+        rows = db.stream(sql, params, head=head)
+        return (await rows.__anext__() if head else None), rows
+
+    def stream_rows(self, rows, headers=None):
+        # Rows go out as they are read from the cursor, the list is never materialized
+        async def lines():
+            async for row in rows:
+                yield dumps(row) + b"\n"
+        return StreamingResponse(lines(), media_type=NDJSON, headers=headers)
+
+def seat_event(snapshot, username):
+    """A server-sent event with a section's seats and ``username``'s place on its waitlist."""
+    if snapshot.get("removed"):
+        data = {"ClassId": snapshot["ClassId"], "removed": True}
+    else:
+        waitlist = snapshot["Waitlist"]
+        data = {
+            "ClassId": snapshot["ClassId"],
+            "CurrentEnrollment": snapshot["CurrentEnrollment"],
+            "MaxEnrollment": snapshot["MaxEnrollment"],
+            "AvailableSeats": max(snapshot["MaxEnrollment"] - snapshot["CurrentEnrollment"], 0),
+            "AutomaticEnrollmentFrozen": snapshot["AutomaticEnrollmentFrozen"],
+            "WaitlistSize": len(waitlist),
+            # Only the caller's own position, the other names never leave the worker
+            "WaitingListPosition": waitlist.index(username) + 1 if username in waitlist else None,
+        }
+    return b"event: seats\ndata: " + dumps(data) + b"\n\n"
+
+def make_etag(view, generation, page=None):
+    # Strong: every write that could change the body bumps the counter first
+    suffix = "-ndjson" if page is not None and page.stream else ""
+    return f'"{view}-{generation or 0}{suffix}"'
+
+def cache_headers(etag, public=False):
+    if public:
+        # The same body for every caller, so KrakenD may cache it and revalidate it with the ETag
+        return {"ETag": etag, "Cache-Control": f"public, max-age={HTTP_CACHE_MAX_AGE}", "Vary": "Accept"}
+    return {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization, Accept"}
+
 class Enrollment(BaseModel):
     ClassId: int
 
+class BatchEnrollmentItem(BaseModel):
+    ClassId: int
+    # Only the registrar may name another student, students enroll themselves
+    StudentUserName: Optional[str] = None
+    StudentName: Optional[str] = None
+
+class BatchEnrollment(BaseModel):
+    Enrollments: list[BatchEnrollmentItem] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+    AllOrNothing: bool = False
+
 class Class(BaseModel):
     InstructorUserName: str
     InstructorName: str
@@ -53,16 +185,97 @@ class UpdateInstructor(BaseModel):
     InstructorUserName: str
     InstructorName: str
 
+class UpdateCapacity(BaseModel):
+    MaxEnrollment: int
+
 def get_logger():
     return logging.getLogger(__name__)
 
-def get_db(logger: logging.Logger = Depends(get_logger)):
-    with contextlib.closing(sqlite3.connect(DATABASE)) as db:
-        db.row_factory = sqlite3.Row
-        db.set_trace_callback(logger.debug)
-        yield db
-
-app = FastAPI()
+# LiteFS manages the journal itself and its FUSE mount does not support mmap
+LITEFS_PRAGMAS = {"cache_size": -16000, "temp_store": "MEMORY"}
+REPLICA_PRAGMAS = dict(LITEFS_PRAGMAS, query_only=1)
+
+# One pool per worker process, connections are reused across requests
+db_pool = ConnectionPool(DATABASE, size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                         pragmas=LITEFS_PRAGMAS if REPLICA_DATABASES else WRITER_PRAGMAS, name="enrollments")
+# The writer thread's own connection, so busy readers and streams never hold up a write
+writer_pool = ConnectionPool(DATABASE, size=1, timeout=POOL_TIMEOUT,
+                             pragmas=LITEFS_PRAGMAS if REPLICA_DATABASES else WRITER_PRAGMAS, name="enrollments-writer")
+replica_pools = [
+    ConnectionPool(path, size=POOL_SIZE, timeout=POOL_TIMEOUT, pragmas=REPLICA_PRAGMAS, name=path)
+    for path in REPLICA_DATABASES
+]
+# Without replicas every read goes to the primary
+replica_router = ReplicaRouter(db_pool, replica_pools, max_lag=REPLICA_MAX_LAG, pin_seconds=READ_YOUR_WRITES_SECONDS)
+
+# Writes are serialized on one thread, reads fan out over the replicas
+database = AsyncDatabase(writer_pool.connection, replica_router.connection, readers=READ_THREADS, name="enrollments",
+                         group_commit=GROUP_COMMIT_MS / 1000, max_batch=GROUP_COMMIT_MAX,
+                         streams=MAX_STREAMS, stream_timeout=POOL_TIMEOUT)
+
+def get_db(request: Request, logger: logging.Logger = Depends(get_logger), token=Depends(decode_jwt)):
+    if token and request.method != "GET":
+        # Read-your-writes: this user's next reads skip the replicas for a while
+        replica_router.pin(token.get("sub"))
+    return Session(database, trace=sql_tracer(logger, request, SQL_TRACE_SAMPLE_RATE), primary=True, label=endpoint_label(request))
+
+def get_read_db(request: Request, logger: logging.Logger = Depends(get_logger), token=Depends(decode_jwt)):
+    return Session(database, key=read_key(request, token.get("sub") if token else None), trace=sql_tracer(logger, request, SQL_TRACE_SAMPLE_RATE),
+                   label=endpoint_label(request))
+
+classes_cache = GenerationCache("classes", ttl=CLASSES_CACHE_TTL)
+# Seat changes of the sections watched through this worker, whichever worker made them
+change_bus = ChangeBus(database, interval=WATCH_POLL_MS / 1000)
+
+def get_engine(db: Session = Depends(get_db)):
+    return AsyncEnrollmentEngine(db)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(MetricsMiddleware, service="enrollments")
+# Read-your-writes across workers: writes answer with the primary position to send back
+app.add_middleware(ReadPositionMiddleware, router=replica_router)
+
+# The same numbers as /stats, read when /metrics is scraped
+StatsCollector("sqlite_pool", "Connection pool usage",
+               lambda: [({"pool": pool.name}, pool.stats()) for pool in (db_pool, writer_pool, *replica_pools)], ConnectionPool.COUNTERS)
+StatsCollector("sqlite_replica", "Replica routing",
+               lambda: [({"node": node["name"]}, node) for node in replica_router.stats()["nodes"]], Node.COUNTERS)
+StatsCollector("sqlite_writer", "Writer thread and group commits",
+               lambda: [({"database": database.name}, stats) for stats in [database.stats()["writer"]] if stats], Writer.COUNTERS)
+StatsCollector("response_cache", "Cached responses",
+               lambda: [({"cache": classes_cache.name}, classes_cache.stats())], GenerationCache.COUNTERS)
+StatsCollector("token_cache", "Verified token cache", lambda: [({"service": "enrollments"}, token_verifier.stats())], TokenVerifier.COUNTERS)
+StatsCollector("seat_push", "Seat change notifications", lambda: [({}, change_bus.stats())], ChangeBus.COUNTERS)
+StatsCollector("token_keys", "JWK set", lambda: [({"service": "enrollments"}, token_verifier.keys.stats())], KeySet.COUNTERS)
+
+@app.exception_handler(EnrollmentError)
+def enrollment_error_handler(request, exc):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+@app.exception_handler(PoolTimeout)
+def pool_timeout_handler(request, exc):
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+@app.on_event("startup")
+def apply_migrations():
+    with db_pool.connection() as db:
+        migrate(db)
+
+@app.on_event("startup")
+def start_change_bus():
+    change_bus.start()
+
+@app.on_event("shutdown")
+async def stop_change_bus():
+    await change_bus.stop()
+
+@app.on_event("shutdown")
+def close_db_pool():
+    database.close()
+    writer_pool.close()
+    db_pool.close()
+    for pool in replica_pools:
+        pool.close()
 
 logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
 
@@ -73,290 +286,253 @@ def default():
     return {"routes" : url_list, "message" : f'{len(url_list)} routes found'}
     # return RedirectResponse("/docs")
 
+# Per-worker connection pool and cache statistics
+@app.get("/stats",status_code=status.HTTP_200_OK)
+def stats():
+    return {
+        "db_pool": db_pool.stats(),
+        "writer_pool": writer_pool.stats(),
+        "replica_pools": [pool.stats() for pool in replica_pools],
+        "replicas": replica_router.stats(),
+        "database": database.stats(),
+        "classes_cache": classes_cache.stats(),
+        "token_cache": token_verifier.stats(),
+        "seat_push": change_bus.stats(),
+    }
+
+# Prometheus metrics of this worker
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(REGISTRY.expose(), media_type=CONTENT_TYPE)
+
 """
 STUDENTS API ENDPOINTS
 """
 
 # List available classses to students
 @app.get("/classes", status_code=status.HTTP_200_OK)
-def list_available_classes(db: sqlite3.Connection = Depends(get_db), current_user=Depends(get_current_user)):
-    classes = db.execute("""
-                         SELECT 
-                         ClassId,
-                         CourseCode,
-                         SectionNumber,
-                         ClassName,                         
-                         InstructorName,
-                         CurrentEnrollment,
-                         MaxEnrollment
-                         FROM classes 
-                         WHERE CurrentEnrollment < MaxEnrollment 
-                         AND AutomaticEnrollmentFrozen = 0""")
-    # print({"user_info": current_user})
-    username, fullName, roles = current_user.get("sub"), current_user.get("name"), current_user.get("roles")
-    print(username)
-    print(fullName)
-    print(roles)
-    if not classes:
+async def list_available_classes(
+    request: Request,
+    department: Optional[str] = None,
+    course_code: Optional[str] = None,
+    instructor: Optional[str] = None,
+    page: Page = Depends(),
+    db: Session = Depends(get_read_db),
+    current_user=Depends(get_current_user),
+):
+    sql, params = available_classes(page.after, department=department, course_code=course_code, instructor=instructor)
+
+    if page.is_default and not params:
+        # The encoded body is cached until a write to Classes bumps its generation
+        def load(conn):
+            etag = make_etag("classes", classes_cache.generation(conn))
+            if etag_matches(request, etag):
+                return etag, None
+            return etag, classes_cache.get(conn, lambda: dumps({"classes": query_dicts(conn, sql), "next_cursor": None}))
+        etag, body = await db.read(load)
+        headers = cache_headers(etag, public=True)
+        if body is None:
+            return not_modified(headers)
+        return raw_json_response(body, headers=headers)
+
+    # The generation and the rows come from one connection, so a lagging replica cannot pair old rows with a new ETag
+    def generation(conn):
+        entry = conn.execute(CLASSES_GENERATION).fetchone()
+        return make_etag("classes", entry and entry[0], page)
+
+    if page.stream:
+        etag, rows = await page.open_stream(db, sql, params, generation)
+        headers = cache_headers(etag, public=True)
+        if etag_matches(request, etag):
+            await rows.aclose()
+            return not_modified(headers)
+        return page.stream_rows(rows, headers)
+
+    def load(conn):
+        etag = generation(conn)
+        if etag_matches(request, etag):
+            return etag, None
+        return etag, page.fetch(conn, sql, params, "ClassId")
+    etag, result = await db.read(load)
+    headers = cache_headers(etag, public=True)
+    if result is None:
+        return not_modified(headers)
+    classes, next_cursor = result
+    return json_response({"classes": classes, "next_cursor": next_cursor}, headers=headers)
+
+
+# Stream the seats of the watched sections and the caller's waitlist positions, instead of polling
+@app.get("/classes/watch", status_code=status.HTTP_200_OK)
+async def watch_classes(
+    ClassId: list[int] = Query(...), current_user=Depends(get_current_user)
+):
+    class_ids = set(ClassId)
+    if len(class_ids) > MAX_WATCHED_CLASSES:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Classes not found"
-        )
-    return {"classes": classes.fetchall()}
-
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f'At most {MAX_WATCHED_CLASSES} classes can be watched',
+            )
+    username, expires = current_user.get("sub"), current_user["exp"]
+
+    async def events():
+        # The first event of each section is its current state
+        yield b"retry: 2000\n\n"
+        async with change_bus.subscribe(class_ids) as subscription:
+            # The stream ends with the token, the client reconnects with a fresh one
+            while (remaining := expires - time.time()) > 0:
+                snapshots = await subscription.get(timeout=min(WATCH_HEARTBEAT_SECONDS, remaining))
+                if not snapshots:
+                    # Keeps proxies from closing an idle connection
+                    yield b": keep-alive\n\n"
+                for snapshot in snapshots:
+                    yield seat_event(snapshot, username)
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-store"})
 
 # Attempt to enroll in a class
 @app.post("/enrollments/", status_code=status.HTTP_201_CREATED)
-def create_enrollment(
-    enrollment: Enrollment, response: Response, db: sqlite3.Connection = Depends(get_db), current_user=Depends(get_current_user)
+async def create_enrollment(
+    enrollment: Enrollment, response: Response, engine: AsyncEnrollmentEngine = Depends(get_engine), current_user=Depends(get_current_user)
 ):
     # Current User Info
     username, fullName = current_user.get("sub"), current_user.get("name")
-    print(username)
-    cur = db.execute("select CurrentEnrollment, MaxEnrollment, AutomaticEnrollmentFrozen from Classes where ClassId = ?",[enrollment.ClassId])
-    # checking if class exists
-    entry = cur.fetchone()
-    if(not entry):
-        raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail= 'Class Does Not Exist',
-            )
-    currentEnrollment, maxEnrollment, automaticEnrollmentFrozen = entry
-    # # checking if student exist
-    # cur = db.execute("Select * from Students where StudentId = ?",[enrollment.StudentId])
-    # entry = cur.fetchone()
-    # if(not entry):
-    #     raise HTTPException(
-    #             status_code=status.HTTP_404_NOT_FOUND,
-    #             detail= 'Student Does Not Exist',
-    #         )
-
-    # Checking if enrollment frozen is on
-    if(automaticEnrollmentFrozen==1):
-        raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail= 'Enrollment is closed',
-            )
-
-    # Checking if student is Already enrolled to the course
-    cur = db.execute("Select * from Enrollments where ClassId = ? and  StudentUsername = ? and dropped = 0",[enrollment.ClassId, username])
-    sameClasses = cur.fetchall()
-    if(sameClasses):
-        raise HTTPException(status_code=409, detail="You are already enrolled") #HTTP status code 409, which stands for "Conflict." 
-    
-    # Checking if Class is full then adding student to waitlist
-    if(currentEnrollment >= maxEnrollment):
-
-        # Checking if student is already on waitList
-        cur = db.execute("Select * from WaitingLists where ClassId = ? and  StudentUsername = ?",[enrollment.ClassId, username])
-        alreadyOnWaitlist = cur.fetchall()
-        if(alreadyOnWaitlist):
-            raise HTTPException(status_code=409, detail="You are already on waitlist") #HTTP status code 409, which stands for "Conflict." 
-
-        # Checking that student is not on more than 3 waitlist (not checked)
-        cur = db.execute("Select * from Waitinglists where StudentUsername = ?",[username])
-        moreThanThree = cur.fetchall()
-        if(len(moreThanThree)>3):
-            raise HTTPException(status_code=409, detail="Class is full and You are already on three waitlists so, you can't be placed on a waitlist") #HTTP status code 409, which stands for "Conflict." 
-        
-        # Adding to the waitlist if waitlist is not full
-        cur = db.execute("Select * from Waitinglists where ClassId = ?",[enrollment.ClassId])
-        entries = cur.fetchall()
-        if(len(entries)>=15):
-            raise HTTPException(status_code=403, detail="Waiting List if full for this class") # Forbidden
-        waitListPosition = len(entries)+1
-        e = dict(enrollment)
-        try:
-            cur = db.execute(
-                """
-                INSERT INTO WaitingLists(StudentUserName,StudentName,ClassID,WaitingListPos,DateAdded)
-                VALUES(?,?, ?, ? , datetime('now')) 
-                """,
-                [username,fullName,enrollment.ClassId,waitListPosition]
-            )
-            db.commit()
-        except sqlite3.IntegrityError as e:
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail={"type": type(e).__name__, "msg": str(e)},
-            )
-        e["id"] = cur.lastrowid
-        response.headers["Location"] = f"/WaitingLists/{e['id']}"
-        message = f"Class is full you have been placed on waitlist position {waitListPosition}"
-        # Sagar: new function Checking if student was enrolled earlier
+    result = await engine.enroll(enrollment.ClassId, username, fullName)
+    change_bus.publish(enrollment.ClassId)
+    if result.status == WAITLISTED:
+        response.headers["Location"] = f"/WaitingLists/{result.id}"
+        message = f"Class is full you have been placed on waitlist position {result.position}"
         raise HTTPException(status_code=400, detail=message)
-    
-    # Checking if student was enrolled earlier
-    cur = db.execute("Select * from Enrollments where ClassId = ? and  StudentUserName = ?",[enrollment.ClassId, username])
-    entry = cur.fetchone()
-    if(entry):
-        try:
-            db.execute("""
-                    UPDATE Enrollments SET dropped = 0 where ClassId = ? and StudentUserName = ?
-                    """,
-                    [enrollment.ClassId,username]) 
-            db.execute("""
-                    UPDATE Classes SET CurrentEnrollment = ? where ClassId = ? 
-                    """,
-                    [(currentEnrollment+1),enrollment.ClassId])
-            db.commit()
-        except sqlite3.IntegrityError as e:
-            raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail={"type": type(e).__name__, "msg": str(e)},
-        )
+    if result.status == REENROLLED:
         return {"success":"Enrolled"}
-        
-    else:
-    # Registering Students if class is not full
-        e = dict(enrollment)
-        try:
-            cur = db.execute(
-                """
-                INSERT INTO enrollments(StudentUserName,StudentName,ClassID,EnrollmentDate)
-                VALUES(?,?,?, datetime('now')) 
-                """,
-                [username,fullName,enrollment.ClassId],
-            )
-            # Updating currentEnrollment
-            cur = db.execute("UPDATE Classes SET currentEnrollment = ? where ClassId = ?",[(currentEnrollment+1),enrollment.ClassId])
-            db.commit()
-        except sqlite3.IntegrityError as e:
+    e = dict(enrollment)
+    e["id"] = result.id
+    response.headers["Location"] = f"/enrollments/{e['id']}"
+    return {"success":e}
+
+# Enroll in many classes, or many students, with a single commit
+@app.post("/enrollments/batch", status_code=status.HTTP_200_OK)
+async def create_enrollments(
+    batch: BatchEnrollment, engine: AsyncEnrollmentEngine = Depends(get_engine), current_user=Depends(get_current_user)
+):
+    # Current User Info
+    username, fullName, roles = current_user.get("sub"), current_user.get("name"), role_list(current_user.get("roles"))
+    items = []
+    for item in batch.Enrollments:
+        student = item.StudentUserName or username
+        if student != username and "registrar" not in roles:
             raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail={"type": type(e).__name__, "msg": str(e)},
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Only the registrar can enroll other students",
             )
-        e["id"] = cur.lastrowid
-        response.headers["Location"] = f"/enrollments/{e['id']}"
-        return {"success":e}
+        items.append((item.ClassId, student, item.StudentName or (fullName if student == username else student)))
+
+    results = await engine.enroll_many(items, atomic=batch.AllOrNothing)
+    failed = sum(isinstance(result, EnrollmentError) for result in results)
+    applied = not (batch.AllOrNothing and failed)
+    body = []
+    for (class_id, student, _), result in zip(items, results):
+        entry = {"ClassId": class_id, "StudentUserName": student}
+        if isinstance(result, EnrollmentError):
+            entry.update(status="failed", status_code=result.status_code, detail=result.detail)
+        elif not applied:
+            entry["status"] = "not_applied"
+        elif result.status == WAITLISTED:
+            entry.update(status=WAITLISTED, Location=f"/WaitingLists/{result.id}", position=result.position)
+        elif result.status == ENROLLED:
+            entry.update(status=ENROLLED, Location=f"/enrollments/{result.id}")
+        else:
+            entry["status"] = REENROLLED
+        body.append(entry)
+
+    if not applied:
+        return JSONResponse(
+            status_code=status.HTTP_409_CONFLICT,
+            content={"detail": f"{failed} of {len(items)} enrollments failed, none were made", "results": body},
+        )
+    change_bus.publish(*{item[0] for item in items})
+    # Read-your-writes for every student of a registrar import, not only the caller
+    for student in {item[1] for item in items}:
+        replica_router.pin(student)
+    return {
+        "enrolled": sum(entry["status"] in (ENROLLED, REENROLLED) for entry in body),
+        "waitlisted": sum(entry["status"] == WAITLISTED for entry in body),
+        "failed": failed,
+        "results": body,
+    }
 
 # Delete enrollment of student
 @app.delete("/students/enrollments/{ClassId}",status_code=status.HTTP_200_OK)
-def drop_enrollment(
-    ClassId:int , db: sqlite3.Connection = Depends(get_db), current_user=Depends(get_current_user)
+async def drop_enrollment(
+    ClassId:int , engine: AsyncEnrollmentEngine = Depends(get_engine), current_user=Depends(get_current_user)
 ):
     # Current User Info
-    username, fullName = current_user.get("sub"), current_user.get("name")
-    print(username)
-    cur = db.execute("select CurrentEnrollment, MaxEnrollment, AutomaticEnrollmentFrozen from Classes where ClassId = ?",[ClassId])
-    entries = cur.fetchone()
-    # check if class exists
-    if(not entries):
-        raise HTTPException(status_code=404, detail="Class does not exist")
-    currentEnrollment, maxEnrollment, automaticEnrollmentFrozen = entries
-    
-    # Checking if student was enrolled to the course
-    cur = db.execute("Select * from Enrollments where ClassId = ? and  StudentUserName = ? and dropped = 0",[ClassId, username])
-    entries = cur.fetchone()
-    if(not entries):
-        raise HTTPException(status_code=404, detail="You are not enrolled in this course") #student enrollement not found
-    # student_dropped = entries['dropped']
-     
-    # dropping the course
-    try:
-        db.execute("""
-                    UPDATE Enrollments SET dropped = 1 where ClassId = ? and StudentUserName = ?
-                    """,
-                    [ClassId,username]) 
-        db.execute("""
-                    UPDATE Classes SET CurrentEnrollment = ? where ClassId = ? 
-                    """,
-                    [(currentEnrollment-1),ClassId])
-        db.commit()
-    except sqlite3.IntegrityError as e:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail={"type": type(e).__name__, "msg": str(e)},
-        )
-    db.commit()
-    cur = db.execute("Select * from WaitingLists where ClassId = ? ORDER BY WaitingListPos ASC",[ClassId])
-    entry = cur.fetchone()
-    if (not automaticEnrollmentFrozen and (currentEnrollment-1)<maxEnrollment and entry):
-
-        # Enrolling student who is on top of the waitlist
-                # Checking if student was enrolled to that course earlier
-        cur = db.execute("Select * from Enrollments where ClassId = ? and  StudentUserName = ?",[ClassId, entry['StudentUserName']])
-        enrollment_entry = cur.fetchone()
-        if(enrollment_entry):
-            try:
-                cur = db.execute("UPDATE Enrollments SET dropped = 0 where ClassId = ? and StudentUserName = ?",[ClassId, entry['StudentUserName']])
-                db.execute("""
-                        UPDATE Classes SET CurrentEnrollment = ? where ClassId = ? 
-                        """,
-                        [(currentEnrollment),ClassId])
-                db.execute("""
-                            DELETE FROM WaitingLists WHERE StudentUserName = ? and ClassId= ? 
-                            """,
-                            [entry['StudentUserName'],ClassId])
-                
-                db.commit()
-            except sqlite3.IntegrityError as e:
-                raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail={"type": type(e).__name__, "msg": str(e)},
-            )
-        else:
-            try:
-                cur = db.execute(
-                """
-                INSERT INTO enrollments(StudentUserName, StudentName,ClassID,EnrollmentDate)
-                VALUES(?,?, ?, datetime('now')) 
-                """,
-                [entry['StudentUserName'], fullName, ClassId],
-            )
-                db.execute("""
-                            DELETE FROM WaitingLists WHERE StudentUserName = ? and ClassId= ? 
-                            """,
-                            [entry['StudentUserName'],ClassId])
-                db.execute("""
-                        UPDATE Classes SET CurrentEnrollment = ? where ClassId = ? 
-                        """,
-                        [(currentEnrollment),ClassId])
-                db.commit()
-            except sqlite3.IntegrityError as e:
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail={"type": type(e).__name__, "msg": str(e)},
-                )
-        # updating waitlist positions
-        cur = db.execute("Select * from WaitingLists where ClassId = ? ORDER BY DateAdded ASC",[ClassId])
-        entries = cur.fetchall()
-        for entry in entries:
-            try:
-                db.execute("""
-                            UPDATE WaitingLists SET WaitingListPos = ? where ClassId = ? and WaitListId = ?
-                            """,
-                            [(entry['WaitingListPos']-1),ClassId,entry['WaitListId']])
-                db.commit()
-            except sqlite3.IntegrityError as e:
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail={"type": type(e).__name__, "msg": str(e)},
-                )
-        
-        db.commit()
-        return  {
-                "Message": "successfully dropped"
-            }
-    db.commit()
+    username = current_user.get("sub")
+    # Dropping frees a seat which the head of the waitlist takes, all in one transaction
+    await engine.drop(ClassId, username)
+    change_bus.publish(ClassId)
     return  {
                 "Message": "successfully dropped"
             }
 
+# A student's enrolled, waitlisted and dropped sections in one request
+@app.get("/students/me/schedule", status_code=status.HTTP_200_OK)
+async def retrieve_schedule(
+    request: Request, db: Session = Depends(get_read_db), current_user=Depends(get_current_user)
+):
+    # Current User Info
+    username = current_user.get("sub")
+
+    def load(conn):
+        # The version is read before the rows, so a concurrent write can only make the ETag older than the body
+        entry = conn.execute(STUDENT_SCHEDULE_VERSION, [username]).fetchone()
+        etag = make_etag("schedule", entry and entry[0])
+        if etag_matches(request, etag):
+            return etag, None
+        return etag, query_dicts(conn, STUDENT_SCHEDULE, [username])
+
+    etag, rows = await db.read(load)
+    # The same URL serves every student, so only the client may keep a copy
+    headers = cache_headers(etag)
+    if rows is None:
+        return not_modified(headers)
+    schedule = {"enrolled": [], "waitlisted": [], "dropped": []}
+    for row in rows:
+        entry_status = row.pop("Status")
+        if entry_status != WAITLISTED:
+            del row["waiting_list_position"]
+        schedule[entry_status].append(row)
+    return json_response(schedule, headers=headers)
+
 # View Waiting List Position
 @app.get("/students/waiting-list/{ClassId}",status_code=status.HTTP_200_OK)
-def retrieve_waitinglist_position(
-    ClassId: int, db: sqlite3.Connection = Depends(get_db), current_user=Depends(get_current_user)
+async def retrieve_waitinglist_position(
+    ClassId: int, request: Request, db: Session = Depends(get_read_db), current_user=Depends(get_current_user)
 ):
     # Current User Info
-    username, fullName = current_user.get("sub"), current_user.get("name")
-    # checking if class exist
-    cur = db.execute("Select * from classes where ClassId = ?",[ClassId])
-    entry = cur.fetchone()
-    if(not entry):
-        raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail= 'Class Does Not Exist',
+    username = current_user.get("sub")
+
+    def load(conn):
+        # checking if class exist
+        entry = conn.execute(CLASS_GENERATION,[ClassId]).fetchone()
+        if(not entry):
+            raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail= 'Class Does Not Exist',
+                )
+        # Positions only move when the class' waitlist changes
+        etag = make_etag("position", entry["Generation"])
+        if etag_matches(request, etag):
+            return etag, None
+        waitingList = conn.execute(WAITLIST_POSITION, [username, ClassId]).fetchone()
+        if not waitingList:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Position not found"
             )
+        return etag, dict(waitingList)
+
+    etag, waitingList = await db.read(load)
+    headers = cache_headers(etag)
+    if waitingList is None:
+        return not_modified(headers)
     # cur = db.execute("SELECT * FROM WaitingLists WHERE StudentUserName = ? and ClassId= ?", [StudentUserName,ClassId])
     # cur = db.execute("""SELECT
     #                  Students.StudentId as student_username,
@@ -376,72 +552,28 @@ def retrieve_waitinglist_position(
     #                  WHERE WaitingLists.StudentId = ? 
     #                  and WaitingLists.ClassId= ?""", [StudentId, ClassId])
 
-    cur = db.execute("""SELECT
-                     WaitingLists.StudentName as student_name,
-                     Classes.CourseCode || ' - ' || Classes.SectionNumber as class_section,
-                     Classes.ClassName as class_name,
-                     WaitingLists.WaitingListPos as waiting_list_position
-
-                     FROM WaitingLists
-
-                     JOIN Classes
-                     ON WaitingLists.ClassId = Classes.ClassId
-
-                     WHERE WaitingLists.StudentUserName = ? 
-                     and WaitingLists.ClassId= ?""", [username, ClassId])
-    waitingList = cur.fetchone()
-    if not waitingList:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Position not found"
-        )
-    return  {
+    return  json_response({
             "data": waitingList,
-            }
+            }, headers=headers)
     
 
 # Remove from Waiting List
 @app.delete("/students/waiting-list/{ClassId}",status_code=status.HTTP_200_OK)
-def delete_waitinglist(
-    ClassId: int, db: sqlite3.Connection = Depends(get_db), current_user=Depends(get_current_user)
+async def delete_waitinglist(
+    ClassId: int, db: Session = Depends(get_db), engine: AsyncEnrollmentEngine = Depends(get_engine), current_user=Depends(get_current_user)
 ):
     # Current User Info
-    username, fullName = current_user.get("sub"), current_user.get("name")
+    username = current_user.get("sub")
 
     # checking if class exist
-    cur = db.execute("Select * from classes where ClassId = ?",[ClassId])
-    entry = cur.fetchone()
+    entry = await db.fetchone(CLASS_BY_ID,[ClassId])
     if(not entry):
         raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail= 'Class Does Not Exist',
             )
-    
-    # checking if student exist in the waitlist
-    cur = db.execute("SELECT WaitListId FROM WaitingLists WHERE StudentUserName = ? and ClassId= ?", [username,ClassId])
-    waitingList = cur.fetchone()
-    if not waitingList:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Not in Waitlist"
-        )
-     # updating waitlist positions
-    try:
-        # 
-        cur = db.execute("Select * from WaitingLists where ClassId = ? and WaitListId > ?",[ClassId, waitingList['WaitListId']])
-        entries = cur.fetchall()
-        for entry in entries:
-            db.execute("""
-                        UPDATE WaitingLists SET WaitingListPos = ? where ClassId = ? and WaitListId = ?
-                        """,
-                        [(entry['WaitingListPos']-1),ClassId,entry['WaitListId']])
-        db.execute("DELETE FROM WaitingLists WHERE StudentUserName = ? and ClassId= ?", [username,ClassId])
-        db.commit()
-    except sqlite3.IntegrityError as e:
-        db.rollback()
-        raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail={"type": type(e).__name__, "msg": str(e)},
-            )
-    db.commit()
+    await engine.leave_waitlist(ClassId, username)
+    change_bus.publish(ClassId)
     return  {
                 "Message": "successfully removed from the waiting list"
             }
@@ -452,201 +584,129 @@ Instructors API ENDPOINTS
 
 # View Current Enrollment for Their Classes
 @app.get("/instructors/classes",status_code=status.HTTP_200_OK)
-def retrieve_Instructors_Classes(
-    db: sqlite3.Connection = Depends(get_db), current_user=Depends(get_current_user)
+async def retrieve_Instructors_Classes(
+    request: Request, page: Page = Depends(), db: Session = Depends(get_read_db), current_user=Depends(get_current_user)
 ):
      # Current User Info
-    username, fullName = current_user.get("sub"), current_user.get("name")
-    cur = db.execute("SELECT classname,currentenrollment FROM Classes WHERE InstructorUserName = ?", [username])
-    instructorClasses = cur.fetchall()
-    if not instructorClasses:
+    username = current_user.get("sub")
+    sql, params = INSTRUCTOR_CLASSES, [username, page.after if page.after is not None else -1]
+
+    def generation(conn):
+        entry = conn.execute(CLASSES_GENERATION).fetchone()
+        return make_etag("classes", entry and entry[0], page)
+
+    if page.stream:
+        etag, rows = await page.open_stream(db, sql, params, generation)
+        headers = cache_headers(etag)
+        if etag_matches(request, etag):
+            await rows.aclose()
+            return not_modified(headers)
+        return page.stream_rows(rows, headers)
+
+    def load(conn):
+        etag = generation(conn)
+        if etag_matches(request, etag):
+            return etag, None
+        return etag, page.fetch(conn, sql, params, "ClassId")
+    etag, result = await db.read(load)
+    headers = cache_headers(etag)
+    if result is None:
+        return not_modified(headers)
+    instructorClasses, next_cursor = result
+    if not instructorClasses and page.after is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Instructor does not have any classes"
         )
-    return  {
-            "instructorClasses": instructorClasses
-            }
+    return  json_response({
+            "instructorClasses": instructorClasses,
+            "next_cursor": next_cursor
+            }, headers=headers)
 
 # View the current waiting list for the course
 @app.get("/classes/{ClassId}/wait-list",status_code=status.HTTP_200_OK)
-def retrieve_Classes_WaitingList(
-    ClassId: int, db: sqlite3.Connection = Depends(get_db)
+async def retrieve_Classes_WaitingList(
+    ClassId: int, request: Request, page: Page = Depends(), db: Session = Depends(get_read_db)
 ):
-    # checking if class exist
-    cur = db.execute("Select * from classes where ClassId = ?",[ClassId])
-    entry = cur.fetchone()
-    if(not entry):
-        raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail= 'Class Does Not Exist',
-            )
-    
-    cur = db.execute("""SELECT 
-                     WaitListId,
-                     StudentName as student_name,
-                     ClassId,
-                     WaitingListPos,
-                     DateAdded
-                     FROM WaitingLists 
-                     WHERE ClassId = ?""", [ClassId])
-    classesWaitingList = cur.fetchall()
-    if not classesWaitingList:
+    sql = CLASS_WAITLIST
+    params = [ClassId, page.after if page.after is not None else -1]
+
+    def generation(conn):
+        # checking if class exist
+        entry = conn.execute(CLASS_GENERATION,[ClassId]).fetchone()
+        if(not entry):
+            raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail= 'Class Does Not Exist',
+                )
+        return make_etag("waitlist", entry["Generation"], page)
+
+    if page.stream:
+        etag, rows = await page.open_stream(db, sql, params, generation)
+        headers = cache_headers(etag, public=True)
+        if etag_matches(request, etag):
+            await rows.aclose()
+            return not_modified(headers)
+        return page.stream_rows(rows, headers)
+
+    def load(conn):
+        etag = generation(conn)
+        if etag_matches(request, etag):
+            return etag, None
+        rows, next_cursor = page.fetch(conn, sql, params, "WaitingListSeq")
+        total = len(rows) if page.is_default else conn.execute(CLASS_WAITLIST_SIZE, [ClassId]).fetchone()[0]
+        return etag, (rows, next_cursor, total)
+    etag, result = await db.read(load)
+    headers = cache_headers(etag, public=True)
+    if result is None:
+        return not_modified(headers)
+    classesWaitingList, next_cursor, total = result
+    if not classesWaitingList and page.after is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Waiting List doest not exist for this class"
         )
-    return  {
-            "Total Waitlisted Students": len(classesWaitingList),
-            "instructorClassesWaitingList": classesWaitingList
-            }
+    return  json_response({
+            "Total Waitlisted Students": total,
+            "instructorClassesWaitingList": classesWaitingList,
+            "next_cursor": next_cursor
+            }, headers=headers)
 
 # View Students Who Have Dropped the Class
 @app.get("/instructors/{ClassId}/dropped-students",status_code=status.HTTP_200_OK)
-def retrieve_instructors_dropped_students(
-    ClassId:int, db: sqlite3.Connection = Depends(get_db)
+async def retrieve_instructors_dropped_students(
+    ClassId:int, page: Page = Depends(), db: Session = Depends(get_read_db)
 ):
     # checking if class exist
-    cur = db.execute("Select * from classes where ClassId = ?",[ClassId])
-    entry = cur.fetchone()
+    entry = await db.fetchone(CLASS_BY_ID,[ClassId])
     if(not entry):
         raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail= 'Class Does Not Exist',
             )
     # cur = db.execute("SELECT * FROM Students WHERE StudentId in (SELECT StudentId FROM Enrollments WHERE  ClassId = ? and Dropped = 1)", [ClassId])
-    cur = db.execute("""
-                     SELECT
-                     StudentName as student_name
-                     FROM Enrollments
-                     WHERE ClassId = ?
-                     AND Dropped = 1
-                     """, [ClassId])
-    studentsWhoDropped = cur.fetchall()
-    if not studentsWhoDropped:
+    sql = DROPPED_STUDENTS
+    params = [ClassId, page.after if page.after is not None else -1]
+    if page.stream:
+        _, rows = await page.open_stream(db, sql, params)
+        return page.stream_rows(rows)
+    studentsWhoDropped, next_cursor = await db.read(page.fetch, sql, params, "EnrollmentId")
+    if not studentsWhoDropped and page.after is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="No students have dropped this class"
         )
-    return  {
-            "Dropped Students": studentsWhoDropped
-            }
+    return  json_response({
+            "Dropped Students": studentsWhoDropped,
+            "next_cursor": next_cursor
+            })
 
 # Drop students administratively
 @app.delete("/instructors/drop-student/{StudentUserName}/{ClassId}")
-def drop_students_administratively(
-    StudentUserName:str, ClassId:int, db: sqlite3.Connection = Depends(get_db),current_user=Depends(get_current_user)
+async def drop_students_administratively(
+    StudentUserName:str, ClassId:int, engine: AsyncEnrollmentEngine = Depends(get_engine),current_user=Depends(get_current_user)
 ):    
     # Current User Info
-    username, fullName = current_user.get("sub"), current_user.get("name")
-    # check if class exists
-    cur = db.execute("select CurrentEnrollment, MaxEnrollment, AutomaticEnrollmentFrozen, InstructorUserName from Classes where ClassId = ?",[ClassId])
-    entries = cur.fetchone()
-    if(not entries):
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Class does not exist")
-    currentEnrollment, maxEnrollment, automaticEnrollmentFrozen, instructorId = entries
-
-    # checking if Instructor is valid
-    if(entries["InstructorUserName"] != username):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You are not the instructor of this class") # Forbidden srtatus code
-
-    # Checking if student was enrolled to the course
-    cur = db.execute(
-        """
-        Select * from Enrollments where ClassId = ? and  StudentUserName = ? and dropped = 0
-        """,
-        [ClassId, StudentUserName])
-    entries = cur.fetchone()
-    if(not entries):
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Student is not enrolled in this class") #Not Found 
-     
-    # dropping the course
-    try:
-        db.execute("""
-                    UPDATE Enrollments SET dropped = 1 where ClassId = ? and StudentUserName = ?
-                    """,
-                    [ClassId,StudentUserName]) 
-        db.execute("""
-                    UPDATE Classes SET CurrentEnrollment = ? where ClassId = ? 
-                    """,
-                    [(currentEnrollment-1),ClassId])
-        db.commit()
-    except sqlite3.IntegrityError as e:
-        db.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail={"type": type(e).__name__, "msg": str(e)},
-        )
-    
-    cur = db.execute("Select * from WaitingLists where ClassId = ? ORDER BY WaitingListPos ASC",[ClassId])
-    entry = cur.fetchone()
-    if (not automaticEnrollmentFrozen and (currentEnrollment-1)<maxEnrollment and entry):
-
-        # Enrolling student who is on top of the waitlist
-                # Checking if student was enrolled to that course earlier
-        cur = db.execute("Select * from Enrollments where ClassId = ? and  StudentUserName = ?",[ClassId, entry['StudentUserName']])
-        enrollment_entry = cur.fetchone()
-        if(enrollment_entry):
-            try:
-                cur = db.execute("UPDATE Enrollments SET dropped = 0 where ClassId = ? and StudentUserName = ?",[ClassId, entry['StudentUserName']])
-                db.execute("""
-                        UPDATE Classes SET CurrentEnrollment = ? where ClassId = ? 
-                        """,
-                        [(currentEnrollment),ClassId])
-                db.execute("""
-                            DELETE FROM WaitingLists WHERE StudentUserName = ? and ClassId= ? 
-                            """,
-                            [entry['StudentUserName'],ClassId])
-                
-                db.commit()
-            except sqlite3.IntegrityError as e:
-                raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail={"type": type(e).__name__, "msg": str(e)},
-            )
-        else: # adding him to the enrollments
-            try:
-                cur = db.execute(
-                """
-                INSERT INTO enrollments(StudentUserName,StudentName,ClassID,EnrollmentDate)
-                VALUES(?, ?, ?, datetime('now')) 
-                """,
-                [entry['StudentUserName'],entry['StudentName'], ClassId],
-            )
-                db.execute("""
-                            DELETE FROM WaitingLists WHERE StudentUserName = ? and ClassId= ? 
-                            """,
-                            [entry['StudentUserName'],ClassId])
-                db.execute("""
-                        UPDATE Classes SET CurrentEnrollment = ? where ClassId = ? 
-                        """,
-                        [(currentEnrollment),ClassId])
-                db.commit()
-            except sqlite3.IntegrityError as e:
-                db.rollback()
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail={"type": type(e).__name__, "msg": str(e)},
-                )
-        # updating waitlist positions
-        cur = db.execute("Select * from WaitingLists where ClassId = ? ORDER BY DateAdded ASC",[ClassId])
-        entries = cur.fetchall()
-        for entry in entries:
-            try:
-                db.execute("""
-                            UPDATE WaitingLists SET WaitingListPos = ? where ClassId = ? and WaitListId = ?
-                            """,
-                            [(entry['WaitingListPos']-1),ClassId,entry['WaitListId']])
-                db.commit()
-            except sqlite3.IntegrityError as e:
-                db.rollback()
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail={"type": type(e).__name__, "msg": str(e)},
-                )
-        db.commit()
-        return  {
-                "Message": "Student Dropped Successfully"
-            }
-    
-    db.commit()
+    username = current_user.get("sub")
+    await engine.drop(ClassId, StudentUserName, instructor=username)
+    change_bus.publish(ClassId)
     return  {
                 "Message": "Student Dropped Successfully"
             }
@@ -656,133 +716,154 @@ def drop_students_administratively(
 
 # Add New Classes and Sections
 @app.post("/classes/", status_code=status.HTTP_201_CREATED)
-def create_class(
-    class_: Class, response: Response, db: sqlite3.Connection = Depends(get_db)
+async def create_class(
+    class_: Class, response: Response, db: Session = Depends(get_db)
 ):
-    
-    # checking if same class and section exist
-    cur = db.execute("Select * from classes where ClassName = ? and SectionNumber = ?",[class_.ClassName, class_.SectionNumber])
-    entry = cur.fetchone()
-    newClassId = 0
-    if(entry):
-        raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail= 'Class Already Exist',
-            )
-    try:
-        cur = db.execute(
-            """
-            INSERT INTO Classes(InstructorUserName, InstructorName,Department,CourseCode,SectionNumber,
-            ClassName,CurrentEnrollment,MaxEnrollment,AutomaticEnrollmentFrozen)
-            VALUES(?,?, ?, ? , ?, ?, 0, ?, ?) 
-            """,
-                [class_.InstructorUserName, class_.InstructorName,class_.Department,class_.CourseCode,class_.SectionNumber,
-                class_.ClassName,class_.MaxEnrollment,class_.AutomaticEnrollmentFrozen]
+    def insert(db):
+        # checking if same class and section exist
+        cur = db.execute(CLASS_BY_NAME_SECTION,[class_.ClassName, class_.SectionNumber])
+        entry = cur.fetchone()
+        newClassId = 0
+        if(entry):
+            raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail= 'Class Already Exist',
+                )
+        try:
+            cur = db.execute(
+                INSERT_CLASS,
+                    [class_.InstructorUserName, class_.InstructorName,class_.Department,class_.CourseCode,class_.SectionNumber,
+                    class_.ClassName,class_.MaxEnrollment,class_.AutomaticEnrollmentFrozen]
+                )
+            newClassId = cur.lastrowid
+            db.commit()
+        except sqlite3.IntegrityError as e:
+            db.rollback()
+            raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"type": type(e).__name__, "msg": str(e)},
             )
-        newClassId = cur.lastrowid
-        db.commit()
-    except sqlite3.IntegrityError as e:
-        db.rollback()
-        raise HTTPException(
-        status_code=status.HTTP_40, 
-        detail={"type": type(e).__name__, "msg": str(e)},
-        )
+        return newClassId
+    newClassId = await db.write(insert)
     response.headers["Location"] = f"/classes/{newClassId}"
     return {'status':"Class created successfully"}
 
 # Remove Existing Sections
 @app.delete("/classes/{classId}",status_code=status.HTTP_200_OK)
-def remove_section(
-    classId:int , db: sqlite3.Connection = Depends(get_db)
+async def remove_section(
+    classId:int , db: Session = Depends(get_db)
 ):
-    # checking if class exist
-    cur = db.execute("Select ClassId from classes where ClassId = ?",[classId])
-    entry = cur.fetchone()
-    if(not entry):
-        raise HTTPException(
+    def delete(db):
+        # checking if class exist
+        cur = db.execute(CLASS_BY_ID,[classId])
+        entry = cur.fetchone()
+        if(not entry):
+            raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail= 'Class Does Not Exist'
+                )
+        try:
+            db.execute(DELETE_CLASS, [classId])
+            db.execute(DELETE_CLASS_ENROLLMENTS, [classId])
+            db.execute(DELETE_CLASS_WAITLIST, [classId])
+            db.commit()
+        except sqlite3.IntegrityError as e:
+            db.rollback()
+            raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
-                detail= 'Class Does Not Exist'
+                detail={"type": type(e).__name__, "msg": str(e)},
             )
-    try:
-        db.executescript(f'''
-                         DELETE FROM Classes WHERE ClassId= {classId};
-                         DELETE FROM Enrollments WHERE ClassId={classId};
-                         DELETE FROM WaitingLists WHERE ClassId= {classId};
-                         ''')
-        db.commit()
-    except sqlite3.IntegrityError as e:
-        db.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_40, 
-            detail={"type": type(e).__name__, "msg": str(e)},
-        )
+    await db.write(delete)
+    change_bus.publish(classId)
     return {'status':"Class Deleted Successfully"}
 
 # Change Instructor for a Section
 @app.put("/classes/{ClassId}/instructor",status_code=status.HTTP_200_OK)
-def change_instructor(
-    ClassId:int, Instructor:UpdateInstructor , db: sqlite3.Connection = Depends(get_db)
+async def change_instructor(
+    ClassId:int, Instructor:UpdateInstructor , db: Session = Depends(get_db)
 ):
-    # checking if class exist
-    cur = db.execute("Select * from classes where ClassId = ?",[ClassId])
-    entry = cur.fetchone()
-    if(not entry):
-        raise HTTPException(
+    def update(db):
+        # checking if class exist
+        cur = db.execute(CLASS_BY_ID,[ClassId])
+        entry = cur.fetchone()
+        if(not entry):
+            raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail= 'Class Does Not Exist',
+                )
+        # checking if instructor exist
+        # cur = db.execute("Select * from instructors where InstructorId = ?",[Instructor.InstructorId])
+        # entry = cur.fetchone()
+        # if(not entry):
+        #     raise HTTPException(
+        #             status_code=status.HTTP_404_NOT_FOUND,
+        #             detail= 'Instructor Does Not Exist',
+        #         )
+        try:
+            db.execute(
+                UPDATE_INSTRUCTOR,
+                [Instructor.InstructorUserName, Instructor.InstructorName,ClassId])
+            db.commit()
+        except sqlite3.IntegrityError as e:
+            db.rollback()
+            raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
-                detail= 'Class Does Not Exist',
+                detail={"type": type(e).__name__, "msg": str(e)},
             )
-    # checking if instructor exist
-    # cur = db.execute("Select * from instructors where InstructorId = ?",[Instructor.InstructorId])
-    # entry = cur.fetchone()
-    # if(not entry):
-    #     raise HTTPException(
-    #             status_code=status.HTTP_404_NOT_FOUND,
-    #             detail= 'Instructor Does Not Exist',
-    #         )
-    try:
-        db.execute(
-            """
-            UPDATE Classes SET InstructorUserName = ?, InstructorName = ? where ClassId = ?
-            """,
-            [Instructor.InstructorUserName, Instructor.InstructorName,ClassId])
-        db.commit()
-    except sqlite3.IntegrityError as e:
-        db.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_40, 
-            detail={"type": type(e).__name__, "msg": str(e)},
-        )
+    await db.write(update)
     return {'status':"Instructor Changed Successfully"}
 
 # Freeze automatic enrollment from waiting lists
 @app.put("/classes/{ClassId}/freeze-enrollment",status_code=status.HTTP_200_OK)
-def freeze_enrollment(
-    ClassId:int, db: sqlite3.Connection = Depends(get_db)
+async def freeze_enrollment(
+    ClassId:int, db: Session = Depends(get_db)
 ):
-    # checking if class exist
-    cur = db.execute("Select * from classes where ClassId = ?",[ClassId])
-    entry = cur.fetchone()
-    if(not entry):
-        raise HTTPException(
+    def freeze(db):
+        # checking if class exist
+        cur = db.execute(CLASS_BY_ID,[ClassId])
+        entry = cur.fetchone()
+        if(not entry):
+            raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail= 'Class Does Not Exist',
+                )
+        if(entry['AutomaticEnrollmentFrozen'] == 1):
+            raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail= 'Automatic Enrollment Frozen is already ON',
+                ) 
+        try:
+            db.execute(FREEZE_CLASS, [ClassId])
+            db.commit()
+        except sqlite3.IntegrityError as e:
+            db.rollback()
+            raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
-                detail= 'Class Does Not Exist',
+                detail={"type": type(e).__name__, "msg": str(e)},
             )
-    if(entry['AutomaticEnrollmentFrozen'] == 1):
-        raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail= 'Automatic Enrollment Frozen is already ON',
-            ) 
-    try:
-        db.execute(
-            """
-            UPDATE Classes SET AutomaticEnrollmentFrozen = 1 where ClassId = ?
-            """,
-            [ClassId])
-        db.commit()
-    except sqlite3.IntegrityError as e:
-        db.rollback()
+    await db.write(freeze)
+    change_bus.publish(ClassId)
+    return {'status':"Successfully turned on automatic enrollment frozen"}
+
+# Change the capacity of a section and fill new seats from the waiting list
+@app.put("/classes/{ClassId}/max-enrollment",status_code=status.HTTP_200_OK)
+async def change_max_enrollment(
+    ClassId:int, capacity:UpdateCapacity, engine: AsyncEnrollmentEngine = Depends(get_engine)
+):
+    if capacity.MaxEnrollment < 0:
         raise HTTPException(
-            status_code=status.HTTP_40, 
-            detail={"type": type(e).__name__, "msg": str(e)},
-        )
-    return {'status':"Successfully turned on automatic enrollment frozen"}
\ No newline at end of file
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail= 'MaxEnrollment must not be negative',
+            )
+    promoted = await engine.set_capacity(ClassId, capacity.MaxEnrollment)
+    change_bus.publish(ClassId)
+    return {'status':"Max Enrollment Changed Successfully", 'promoted': [p._asdict() for p in promoted]}
+
+# Unfreeze automatic enrollment and fill open seats from the waiting list
+@app.put("/classes/{ClassId}/unfreeze-enrollment",status_code=status.HTTP_200_OK)
+async def unfreeze_enrollment(
+    ClassId:int, engine: AsyncEnrollmentEngine = Depends(get_engine)
+):
+    promoted = await engine.unfreeze(ClassId)
+    change_bus.publish(ClassId)
+    return {'status':"Successfully turned off automatic enrollment frozen", 'promoted': [p._asdict() for p in promoted]}
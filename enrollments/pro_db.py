@@ -1,9 +1,10 @@
 import sqlite3
+import sys
 import datetime
+from migrations import migrate
 
-def create_database():
-    conn = sqlite3.connect("pro1.db")  
-    cursor = conn.cursor()
+def create_database(database="pro1.db"):
+    conn = sqlite3.connect(database)
 
     # cursor.execute('''
     #     CREATE TABLE IF NOT EXISTS Instructors (
@@ -18,20 +19,9 @@ def create_database():
     # conn.execute("insert into Instructors(FirstName,LastName,Email) values('Prof','Avery','profavery@gmail.com');")
 
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Classes (
-            ClassId INTEGER PRIMARY KEY,
-            InstructorName Text,
-            InstructorUserName ,
-            Department TEXT,
-            CourseCode TEXT,
-            SectionNumber INTEGER,
-            ClassName TEXT,
-            CurrentEnrollment INTEGER,
-            MaxEnrollment INTEGER,
-            AutomaticEnrollmentFrozen INTEGER DEFAULT 0
-        )
-    ''')
+    # Tables and indexes are owned by the versioned migrations
+    migrate(conn)
+
     conn.execute("insert into Classes(Department,CourseCode,SectionNumber,ClassName,InstructorName,\
                  CurrentEnrollment,MaxEnrollment) values('Computer Science','CPSC449',1,\
                  'Web-backend Engineering','ins1',38,40);")
@@ -63,29 +53,9 @@ def create_database():
     # conn.execute("insert into Students(FirstName,LastName,Email) values('Student10','Doe10','xyz10@gmail.com');")
 
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Enrollments (
-            EnrollmentId INTEGER PRIMARY KEY,
-            ClassId INT REFERENCES Classes(ClassId),
-            StudentName TEXT,
-            StudentUserName TEXT,
-            EnrollmentDate TEXT,
-            Dropped INT DEFAULT 0
-        )
-    ''')
     
     # conn.execute("insert into Enrollments(StudentID,ClassID,EnrollmentDate) values(1,1,datetime('now'));",)
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS WaitingLists (
-            WaitListId INTEGER PRIMARY KEY,
-            ClassId INT REFERENCES Classes(ClassId),
-            StudentName TEXT,
-            StudentUserName TEXT,
-            WaitingListPos INT,
-            DateAdded TEXT
-        )
-    ''')
     
     # conn.execute("insert into waitingLists(StudentID,ClassID,WaitingListPos,DateAdded) values(1,1,1,datetime('now'));",)
 
@@ -94,4 +64,6 @@ def create_database():
     conn.commit()
     conn.close()
 
-create_database()
\ No newline at end of file
+# Pass the path of the LiteFS primary mount to seed a replicated setup
+if __name__ == "__main__":
+    create_database(*sys.argv[1:2])
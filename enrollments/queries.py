@@ -0,0 +1,121 @@
+"""
+SQL of the enrollments endpoints.
+
+The statements live here rather than inline in enrollments.pro, so that
+enrollments.query_plans checks exactly what the endpoints run without
+importing the app.
+"""
+
+# Change counters maintained by triggers, read before any row so an unchanged view answers 304
+CLASSES_GENERATION = "SELECT Generation FROM CacheGenerations WHERE Name = 'classes'"
+CLASS_GENERATION = """
+    SELECT ClassId, (SELECT Generation FROM ClassGenerations WHERE ClassId = Classes.ClassId) AS Generation
+    FROM Classes WHERE ClassId = ?"""
+
+CLASS_BY_ID = "Select * from classes where ClassId = ?"
+CLASS_BY_NAME_SECTION = "Select * from classes where ClassName = ? and SectionNumber = ?"
+
+# Optional /classes filters and their columns, each matched by a partial index of migration 4
+CLASS_FILTERS = (("department", "Department"), ("course_code", "CourseCode"), ("instructor", "InstructorUserName"))
+
+
+def available_classes(after=None, **filters):
+    """The /classes query for ``filters`` (see CLASS_FILTERS) and its parameters."""
+    # The conditions match the partial indexes created by migration 4
+    conditions, params = ["CurrentEnrollment < MaxEnrollment", "AutomaticEnrollmentFrozen = 0"], []
+    for name, column in CLASS_FILTERS:
+        if filters.get(name) is not None:
+            conditions.append(f"{column} = ?")
+            params.append(filters[name])
+    if after is not None:
+        conditions.append("ClassId > ?")
+        params.append(after)
+    sql = f"""
+        SELECT
+        ClassId,
+        CourseCode,
+        SectionNumber,
+        ClassName,
+        InstructorName,
+        CurrentEnrollment,
+        MaxEnrollment
+        FROM classes
+        WHERE {" AND ".join(conditions)}
+        ORDER BY ClassId"""
+    return sql, params
+
+
+STUDENT_SCHEDULE_VERSION = "SELECT Version FROM StudentScheduleVersions WHERE StudentUserName = ?"
+# Served from the StudentSchedules summary the triggers of migration 5 maintain
+STUDENT_SCHEDULE = """
+    SELECT
+    ClassId,
+    Status,
+    CourseCode,
+    SectionNumber,
+    ClassName,
+    Department,
+    InstructorName,
+    CASE WHEN Status = 'waitlisted' THEN
+        (SELECT COUNT(*) FROM WaitingLists
+         WHERE WaitingLists.ClassId = StudentSchedules.ClassId
+         AND WaitingLists.WaitingListPos <= StudentSchedules.WaitingListPos)
+    END as waiting_list_position
+    FROM StudentSchedules
+    WHERE StudentUserName = ?
+    ORDER BY ClassId"""
+
+WAITLIST_POSITION = """SELECT
+    WaitingLists.StudentName as student_name,
+    Classes.CourseCode || ' - ' || Classes.SectionNumber as class_section,
+    Classes.ClassName as class_name,
+    (SELECT COUNT(*) FROM WaitingLists AS Ahead
+     WHERE Ahead.ClassId = WaitingLists.ClassId
+     AND Ahead.WaitingListPos <= WaitingLists.WaitingListPos) as waiting_list_position
+
+    FROM WaitingLists
+
+    JOIN Classes
+    ON WaitingLists.ClassId = Classes.ClassId
+
+    WHERE WaitingLists.StudentUserName = ?
+    and WaitingLists.ClassId= ?"""
+
+INSTRUCTOR_CLASSES = "SELECT ClassId,classname,currentenrollment FROM Classes WHERE InstructorUserName = ? AND ClassId > ? ORDER BY ClassId"
+
+# Ranks are counted over the whole class so they stay correct across pages
+CLASS_WAITLIST = """SELECT
+    WaitListId,
+    StudentName as student_name,
+    ClassId,
+    (SELECT COUNT(*) FROM WaitingLists AS Ahead
+     WHERE Ahead.ClassId = WaitingLists.ClassId
+     AND Ahead.WaitingListPos <= WaitingLists.WaitingListPos) as WaitingListPos,
+    WaitingListPos as WaitingListSeq,
+    DateAdded
+    FROM WaitingLists
+    WHERE ClassId = ? AND WaitingListPos > ?
+    ORDER BY WaitingLists.WaitingListPos"""
+CLASS_WAITLIST_SIZE = "SELECT COUNT(*) FROM WaitingLists WHERE ClassId = ?"
+
+DROPPED_STUDENTS = """
+    SELECT
+    EnrollmentId,
+    StudentName as student_name
+    FROM Enrollments
+    WHERE ClassId = ?
+    AND Dropped = 1
+    AND EnrollmentId > ?
+    ORDER BY EnrollmentId
+    """
+
+INSERT_CLASS = """
+    INSERT INTO Classes(InstructorUserName, InstructorName,Department,CourseCode,SectionNumber,
+    ClassName,CurrentEnrollment,MaxEnrollment,AutomaticEnrollmentFrozen)
+    VALUES(?,?, ?, ? , ?, ?, 0, ?, ?)
+    """
+UPDATE_INSTRUCTOR = "UPDATE Classes SET InstructorUserName = ?, InstructorName = ? where ClassId = ?"
+FREEZE_CLASS = "UPDATE Classes SET AutomaticEnrollmentFrozen = 1 where ClassId = ?"
+DELETE_CLASS = "DELETE FROM Classes WHERE ClassId = ?"
+DELETE_CLASS_ENROLLMENTS = "DELETE FROM Enrollments WHERE ClassId = ?"
+DELETE_CLASS_WAITLIST = "DELETE FROM WaitingLists WHERE ClassId = ?"
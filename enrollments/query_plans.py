@@ -0,0 +1,116 @@
+"""
+EXPLAIN QUERY PLAN check for the queries behind the enrollments endpoints.
+
+Run it after changing a query or a migration:
+
+    python -m enrollments.query_plans [database]
+
+It migrates a scratch copy of the database (an empty one by default), so the
+database passed in is left untouched, and exits non-zero if any query falls
+back to a full table scan.
+"""
+
+import contextlib
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+from enrollments import engine, queries
+from enrollments.cache import GENERATION
+from enrollments.changes import CLASS_SNAPSHOTS, WATCHED_GENERATIONS
+from enrollments.migrations import migrate
+
+# (label, sql, parameters) for every query issued on a request path, imported
+# from the modules that run them so the check cannot drift from the endpoints
+HOT_QUERIES = [
+    ("available_classes", *queries.available_classes()),
+    ("available_classes_page", *queries.available_classes(after=0)),
+    ("available_classes_by_department", *queries.available_classes(after=0, department="x")),
+    ("available_classes_by_course", *queries.available_classes(course_code="x")),
+    ("available_classes_by_instructor", *queries.available_classes(instructor="x")),
+    ("cache_generation", GENERATION, ["classes"]),
+    ("classes_generation", queries.CLASSES_GENERATION, []),
+    ("class_generation", queries.CLASS_GENERATION, [1]),
+    ("class_by_id", queries.CLASS_BY_ID, [1]),
+    ("class_by_name_section", queries.CLASS_BY_NAME_SECTION, ["x", 1]),
+    ("student_schedule_version", queries.STUDENT_SCHEDULE_VERSION, ["x"]),
+    ("student_schedule", queries.STUDENT_SCHEDULE, ["x"]),
+    ("waitlist_position", queries.WAITLIST_POSITION, ["x", 1]),
+    ("instructor_classes", queries.INSTRUCTOR_CLASSES, ["x", -1]),
+    ("class_waitlist", queries.CLASS_WAITLIST, [1, -1]),
+    ("class_waitlist_size", queries.CLASS_WAITLIST_SIZE, [1]),
+    ("dropped_students", queries.DROPPED_STUDENTS, [1, -1]),
+    ("insert_class", queries.INSERT_CLASS, ["x", "x", "x", "x", 1, "x", 40, 0]),
+    ("update_instructor", queries.UPDATE_INSTRUCTOR, ["x", "x", 1]),
+    ("freeze_class", queries.FREEZE_CLASS, [1]),
+    ("delete_class", queries.DELETE_CLASS, [1]),
+    ("delete_class_enrollments", queries.DELETE_CLASS_ENROLLMENTS, [1]),
+    ("delete_class_waitlist", queries.DELETE_CLASS_WAITLIST, [1]),
+    ("claim_seat", engine.CLAIM_SEAT, [1, "x"]),
+    ("reenroll", engine.REENROLL, [1, "x"]),
+    ("insert_enrollment", engine.INSERT_ENROLLMENT, ["x", "x", 1]),
+    ("enroll_diagnosis", engine.ENROLL_DIAGNOSIS, ["x", "x", "x", 1]),
+    ("insert_waitlist", engine.INSERT_WAITLIST, ["x", "x", 1, 1]),
+    ("add_seats", engine.ADD_SEATS, [1, 1]),
+    ("class_instructor", engine.CLASS_INSTRUCTOR, [1]),
+    ("drop_enrollment", engine.DROP_ENROLLMENT, [1, "x"]),
+    ("release_seat", engine.RELEASE_SEAT, [1]),
+    ("leave_waitlist", engine.LEAVE_WAITLIST, ["x", 1]),
+    ("class_enrollment", engine.CLASS_ENROLLMENT, [1]),
+    ("set_capacity", engine.SET_CAPACITY, [40, 1]),
+    ("class_frozen", engine.CLASS_FROZEN, [1]),
+    ("unfreeze_class", engine.UNFREEZE_CLASS, [1]),
+    ("open_seats", engine.OPEN_SEATS, [1]),
+    ("dequeue_enrolled", engine.DEQUEUE_ENROLLED, [1]),
+    ("promote_reenroll", engine.PROMOTE_REENROLL, [1, 1, 1]),
+    ("promote_insert", engine.PROMOTE_INSERT, [1, 1]),
+    ("promote_dequeue", engine.PROMOTE_DEQUEUE, [1, 1]),
+    ("batch_classes", engine.BATCH_CLASSES, ["[1, 2]"]),
+    ("batch_pairs", engine.BATCH_PAIRS, ['[[1, "x"], [2, "y"]]']),
+    ("batch_student_waitlists", engine.BATCH_STUDENT_WAITLISTS, ['["x", "y"]']),
+    ("batch_insert_enrollments", engine.BATCH_INSERT_ENROLLMENTS, ['[[1, "x", "x"]]']),
+    ("batch_insert_waitlists", engine.BATCH_INSERT_WAITLISTS, ['[[1, "x", "x", 1]]']),
+    ("watched_generations", WATCHED_GENERATIONS, ["[1, 2]"]),
+    ("class_snapshots", CLASS_SNAPSHOTS, ["[1, 2]"]),
+    # Run by the triggers of migration 5 when a section's display columns change
+    ("class_schedules", "SELECT DISTINCT StudentUserName FROM StudentSchedules WHERE ClassId = ?", [1]),
+]
+
+# "SCAN Classes" is a full table scan, "SCAN Classes USING INDEX ..." walks an index
+FULL_SCAN = re.compile(r"^SCAN (TABLE )?\w+( AS \w+)?$")
+
+
+def full_scans(db):
+    failures = []
+    for label, sql, params in HOT_QUERIES:
+        for row in db.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row[-1]
+            if FULL_SCAN.match(detail):
+                failures.append((label, detail))
+    return failures
+
+
+def check(database=None):
+    """Plans on a migrated scratch copy of ``database``, or of an empty schema."""
+    with tempfile.TemporaryDirectory() as directory:
+        db = sqlite3.connect(os.path.join(directory, "plans.db"))
+        try:
+            if database is not None:
+                # The migrations must not touch the database being checked
+                with contextlib.closing(sqlite3.connect(database)) as source:
+                    source.backup(db)
+            migrate(db)
+            return full_scans(db)
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    failures = check(sys.argv[1] if len(sys.argv) > 1 else None)
+    for label, detail in failures:
+        print(f"FULL SCAN in {label}: {detail}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+    print(f"{len(HOT_QUERIES)} queries checked, no full table scans")
@@ -0,0 +1,40 @@
+import sqlite3
+
+import pytest
+
+from enrollments.migrations import migrate
+from enrollments.queries import INSERT_CLASS
+
+
+def connect(path):
+    db = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    return db
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Path of a fully migrated, empty enrollments database in WAL mode."""
+    path = str(tmp_path / "enrollments.db")
+    db = connect(path)
+    db.execute("PRAGMA journal_mode = WAL")
+    migrate(db)
+    db.close()
+    return path
+
+
+@pytest.fixture
+def db(database):
+    conn = connect(database)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def add_class(db):
+    """Create a section, returns its ClassId."""
+    def add(max_enrollment, frozen=0, name="Class", instructor="ins1"):
+        cur = db.execute(INSERT_CLASS, [instructor, instructor, "Computer Science", name, 1, name, max_enrollment, frozen])
+        db.commit()
+        return cur.lastrowid
+    return add
@@ -0,0 +1,121 @@
+import random
+import sqlite3
+
+import pytest
+
+from common.tokens import role_list
+from enrollments.engine import ENROLLED, REENROLLED, WAITLISTED, EnrollmentEngine, EnrollmentError
+
+STATE = (
+    "SELECT ClassId, CurrentEnrollment, MaxEnrollment FROM Classes ORDER BY ClassId",
+    "SELECT ClassId, StudentUserName, StudentName, Dropped FROM Enrollments ORDER BY ClassId, StudentUserName",
+    "SELECT ClassId, StudentUserName, WaitingListPos FROM WaitingLists ORDER BY ClassId, WaitingListPos",
+)
+
+
+def state(db):
+    return [[tuple(row) for row in db.execute(sql)] for sql in STATE]
+
+
+def outcome(result):
+    if isinstance(result, EnrollmentError):
+        return result.status_code, result.detail
+    return result.status, result.position
+
+
+def copy(db):
+    clone = sqlite3.connect(":memory:")
+    clone.row_factory = sqlite3.Row
+    db.backup(clone)
+    return clone
+
+
+def test_per_item_batch_applies_what_succeeds(db, add_class):
+    open_class, full_class = add_class(2), add_class(1)
+    engine = EnrollmentEngine(db)
+    engine.enroll(full_class, "student1", "Student 1")
+
+    results = engine.enroll_many([
+        (open_class, "student1", "Student 1"),
+        (full_class, "student2", "Student 2"),
+        (full_class + 1, "student1", "Student 1"),
+        (open_class, "student1", "Student 1"),
+    ])
+
+    assert results[0].status == ENROLLED and results[0].id is not None
+    assert (results[1].status, results[1].position) == (WAITLISTED, 1)
+    assert outcome(results[2]) == (404, "Class Does Not Exist")
+    assert outcome(results[3]) == (409, "You are already enrolled")
+    assert db.execute("SELECT CurrentEnrollment FROM Classes WHERE ClassId = ?", [open_class]).fetchone()[0] == 1
+    assert [row[0] for row in db.execute("SELECT StudentUserName FROM WaitingLists WHERE ClassId = ?", [full_class])] == ["student2"]
+
+
+def test_atomic_batch_writes_nothing_when_an_item_fails(db, add_class):
+    open_class, frozen_class = add_class(2), add_class(5, frozen=1)
+    before = state(db)
+
+    results = EnrollmentEngine(db).enroll_many([
+        (open_class, "student1", "Student 1"),
+        (frozen_class, "student1", "Student 1"),
+    ], atomic=True)
+
+    # Every item still reports what it would have done
+    assert results[0].status == ENROLLED
+    assert outcome(results[1]) == (409, "Enrollment is closed")
+    assert state(db) == before
+
+
+def test_atomic_batch_writes_everything_when_all_succeed(db, add_class):
+    class_id = add_class(2)
+    engine = EnrollmentEngine(db)
+    engine.enroll(class_id, "student1", "Student 1")
+    engine.drop(class_id, "student1")
+
+    results = engine.enroll_many([(class_id, "student1", "Student 1"), (class_id, "student2", "Student 2")], atomic=True)
+
+    assert [result.status for result in results] == [REENROLLED, ENROLLED]
+    assert db.execute("SELECT CurrentEnrollment FROM Classes WHERE ClassId = ?", [class_id]).fetchone()[0] == 2
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_batch_matches_enrolling_one_by_one(db, add_class, seed):
+    rng = random.Random(seed)
+    class_ids = [add_class(rng.randint(0, 4), frozen=int(rng.random() < 0.15)) for _ in range(rng.randint(1, 5))]
+    students = [f"student{n}" for n in range(rng.randint(1, 20))]
+    engine = EnrollmentEngine(db)
+    for _ in range(rng.randint(0, 30)):
+        try:
+            if rng.random() < 0.8:
+                engine.enroll(rng.choice(class_ids), rng.choice(students), "x")
+            else:
+                engine.drop(rng.choice(class_ids), rng.choice(students))
+        except EnrollmentError:
+            pass
+    items = [(rng.choice(class_ids + [0]), rng.choice(students), "y") for _ in range(rng.randint(1, 25))]
+    one_by_one = EnrollmentEngine(copy(db))
+
+    expected = []
+    for item in items:
+        try:
+            expected.append(one_by_one.enroll(*item))
+        except EnrollmentError as e:
+            expected.append(e)
+    results = engine.enroll_many(items)
+
+    assert [outcome(result) for result in results] == [outcome(result) for result in expected]
+    assert state(db) == state(one_by_one.db)
+
+
+@pytest.mark.parametrize("roles, expected", [
+    ("registrar", ["registrar"]),
+    ("student,registrar", ["student", "registrar"]),
+    ("student registrar", ["student", "registrar"]),
+    (["instructor"], ["instructor"]),
+    (None, []),
+])
+def test_role_list(roles, expected):
+    assert role_list(roles) == expected
+
+
+def test_role_list_is_not_a_substring_match():
+    assert "registrar" not in role_list("registrars")
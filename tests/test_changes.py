@@ -0,0 +1,28 @@
+from enrollments.changes import read_snapshots
+from enrollments.engine import EnrollmentEngine
+
+INSERT_WAITLIST = "INSERT INTO WaitingLists(StudentUserName, StudentName, ClassId, WaitingListPos) VALUES(?, ?, ?, ?)"
+
+
+def test_snapshot_waitlist_follows_positions(db, add_class):
+    class_id = add_class(0)
+    # Inserted out of position order, so the rowid order differs from the waitlist order
+    for username, position in (("student3", 3), ("student1", 1), ("student4", 4), ("student2", 2)):
+        db.execute(INSERT_WAITLIST, [username, username, class_id, position])
+    db.commit()
+
+    snapshot = read_snapshots(db, [class_id])[class_id]
+
+    assert snapshot["Waitlist"] == ["student1", "student2", "student3", "student4"]
+
+
+def test_snapshots_only_for_changed_classes(db, add_class):
+    changed, unchanged = add_class(1), add_class(1)
+    generations = {class_id: snapshot["Generation"] for class_id, snapshot in read_snapshots(db, [changed, unchanged]).items()}
+
+    EnrollmentEngine(db).enroll(changed, "student1", "Student 1")
+    snapshots = read_snapshots(db, [changed, unchanged], generations)
+
+    assert list(snapshots) == [changed]
+    assert snapshots[changed]["CurrentEnrollment"] == 1
+    assert read_snapshots(db, [changed + unchanged + 1])[changed + unchanged + 1]["removed"]
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from common.aio import AsyncDatabase, Session
+from common.pool import ConnectionPool, WRITER_PRAGMAS
+from enrollments.engine import ENROLLED, MAX_WAITLIST_SIZE, WAITLISTED, AsyncEnrollmentEngine, EnrollmentEngine, EnrollmentError
+
+
+def worker(path, group_commit):
+    """An AsyncDatabase wired like one enrollments worker, with its own writer connection."""
+    pool = ConnectionPool(path, size=3, pragmas=WRITER_PRAGMAS)
+    writer = ConnectionPool(path, size=1, pragmas=WRITER_PRAGMAS)
+    database = AsyncDatabase(writer.connection, pool.connection, readers=3, group_commit=group_commit)
+    return database, (pool, writer)
+
+
+def close(database, pools):
+    database.close()
+    for pool in pools:
+        pool.close()
+
+
+@pytest.mark.parametrize("group_commit", [0.0, 0.005])
+def test_concurrent_enrolls_never_exceed_capacity(database, db, add_class, group_commit):
+    class_id = add_class(5)
+    # Two workers, each serializing its own writes, racing for the write lock of one file
+    workers = [worker(database, group_commit) for _ in range(2)]
+    students = [f"student{n}" for n in range(40)]
+
+    async def enroll(n, username):
+        engine = AsyncEnrollmentEngine(Session(workers[n % 2][0], primary=True))
+        try:
+            return (await engine.enroll(class_id, username, username)).status
+        except EnrollmentError as e:
+            return e.status_code
+
+    async def main():
+        return await asyncio.gather(*(enroll(n, username) for n, username in enumerate(students)))
+
+    try:
+        outcomes = asyncio.run(main())
+    finally:
+        for database_, pools in workers:
+            close(database_, pools)
+
+    assert outcomes.count(ENROLLED) == 5
+    assert outcomes.count(WAITLISTED) == MAX_WAITLIST_SIZE
+    assert outcomes.count(403) == len(students) - 5 - MAX_WAITLIST_SIZE
+    entry = db.execute("SELECT CurrentEnrollment, MaxEnrollment FROM Classes WHERE ClassId = ?", [class_id]).fetchone()
+    assert entry["CurrentEnrollment"] == entry["MaxEnrollment"] == 5
+    assert db.execute("SELECT COUNT(*) FROM Enrollments WHERE ClassId = ? AND Dropped = 0", [class_id]).fetchone()[0] == 5
+    assert db.execute("SELECT COUNT(*) FROM WaitingLists WHERE ClassId = ?", [class_id]).fetchone()[0] == MAX_WAITLIST_SIZE
+
+
+def test_failing_unit_rolls_back_alone(database, db, add_class):
+    class_id = add_class(2)
+    # A window wide enough for all the units below to share one commit
+    database_, pools = worker(database, 0.2)
+
+    def enroll(username, target=class_id):
+        return lambda conn: EnrollmentEngine(conn).enroll(target, username, username)
+
+    def half_done(conn):
+        EnrollmentEngine(conn).enroll(class_id, "student3", "student3")
+        raise RuntimeError("failed after writing")
+
+    async def main():
+        units = [enroll("student1"), half_done, enroll("student2"), enroll("student4", target=class_id + 1)]
+        return await asyncio.gather(*(database_.write(unit, batch=True) for unit in units), return_exceptions=True)
+
+    try:
+        first, failed, second, missing = asyncio.run(main())
+        stats = database_.stats()["writer"]
+    finally:
+        close(database_, pools)
+
+    assert stats["batches"] == 1 and stats["batched_units"] == 4
+    assert first.status == second.status == ENROLLED
+    assert isinstance(failed, RuntimeError)
+    assert isinstance(missing, EnrollmentError) and missing.status_code == 404
+    enrolled = [row[0] for row in db.execute("SELECT StudentUserName FROM Enrollments WHERE ClassId = ? ORDER BY StudentUserName", [class_id])]
+    assert enrolled == ["student1", "student2"]
+    assert db.execute("SELECT CurrentEnrollment FROM Classes WHERE ClassId = ?", [class_id]).fetchone()[0] == 2
+
+
+def test_failed_commit_fails_every_unit(database, db, add_class):
+    class_id = add_class(5)
+    database_, pools = worker(database, 0.2)
+
+    def enroll(username):
+        return lambda conn: EnrollmentEngine(conn).enroll(class_id, username, username)
+
+    def break_commit(conn):
+        # Leaves the batch's transaction so its COMMIT has nothing to commit and its RELEASE fails
+        conn.execute("ROLLBACK")
+
+    async def main():
+        units = [enroll("student1"), break_commit, enroll("student2")]
+        return await asyncio.gather(*(database_.write(unit, batch=True) for unit in units), return_exceptions=True)
+
+    try:
+        outcomes = asyncio.run(main())
+        stats = database_.stats()["writer"]
+    finally:
+        close(database_, pools)
+
+    assert all(isinstance(outcome, Exception) for outcome in outcomes)
+    assert stats["batch_failures"] == 1
+    assert db.execute("SELECT COUNT(*) FROM Enrollments").fetchone()[0] == 0
@@ -0,0 +1,41 @@
+from enrollments.engine import EnrollmentEngine, Promotion
+
+WAITLIST = "SELECT StudentUserName FROM WaitingLists WHERE ClassId = ? ORDER BY WaitingListPos"
+
+
+def waitlist(db, class_id):
+    return [row[0] for row in db.execute(WAITLIST, [class_id])]
+
+
+def test_promotion_fills_freed_seats_in_waitlist_order(db, add_class):
+    class_id = add_class(1)
+    engine = EnrollmentEngine(db)
+    for n in range(1, 5):
+        engine.enroll(class_id, f"student{n}", f"Student {n}")
+
+    engine.set_capacity(class_id, 3)
+
+    assert waitlist(db, class_id) == ["student4"]
+    assert db.execute("SELECT CurrentEnrollment FROM Classes WHERE ClassId = ?", [class_id]).fetchone()[0] == 3
+
+
+def test_enrolled_waitlister_takes_no_seat(db, add_class):
+    class_id = add_class(2)
+    engine = EnrollmentEngine(db)
+    engine.enroll(class_id, "student1", "Student 1")
+    engine.enroll(class_id, "student2", "Student 2")
+    engine.enroll(class_id, "student3", "Student 3")
+    # Inconsistent data: student1 holds a seat and also heads the waitlist
+    db.execute("UPDATE WaitingLists SET WaitingListPos = WaitingListPos + 1 WHERE ClassId = ?", [class_id])
+    db.execute("INSERT INTO WaitingLists(StudentUserName, StudentName, ClassId, WaitingListPos) VALUES('student1', 'Student 1', ?, 1)", [class_id])
+    db.commit()
+
+    promoted = engine.drop(class_id, "student2")
+
+    assert promoted == [Promotion("student3", "Student 3")]
+    assert waitlist(db, class_id) == []
+    entry = db.execute("SELECT CurrentEnrollment, MaxEnrollment FROM Classes WHERE ClassId = ?", [class_id]).fetchone()
+    assert entry["CurrentEnrollment"] == entry["MaxEnrollment"] == 2
+    active = [row[0] for row in db.execute(
+        "SELECT StudentUserName FROM Enrollments WHERE ClassId = ? AND Dropped = 0 ORDER BY StudentUserName", [class_id])]
+    assert active == ["student1", "student3"]
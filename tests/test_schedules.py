@@ -0,0 +1,112 @@
+import random
+
+import pytest
+
+from enrollments.engine import EnrollmentEngine, EnrollmentError
+from enrollments.queries import (
+    DELETE_CLASS, DELETE_CLASS_ENROLLMENTS, DELETE_CLASS_WAITLIST, FREEZE_CLASS, STUDENT_SCHEDULE_VERSION, UPDATE_INSTRUCTOR,
+)
+
+# StudentSchedules as it would be rebuilt from scratch
+RECOMPUTED = """
+    SELECT StudentUserName, Enrollments.ClassId, CASE WHEN Dropped = 1 THEN 'dropped' ELSE 'enrolled' END, NULL,
+    Department, CourseCode, SectionNumber, ClassName, InstructorName
+    FROM Enrollments JOIN Classes ON Classes.ClassId = Enrollments.ClassId
+    UNION ALL
+    SELECT StudentUserName, WaitingLists.ClassId, 'waitlisted', WaitingListPos,
+    Department, CourseCode, SectionNumber, ClassName, InstructorName
+    FROM WaitingLists JOIN Classes ON Classes.ClassId = WaitingLists.ClassId
+"""
+MAINTAINED = """
+    SELECT StudentUserName, ClassId, Status, WaitingListPos, Department, CourseCode, SectionNumber, ClassName, InstructorName
+    FROM StudentSchedules
+"""
+
+
+def assert_consistent(db):
+    assert sorted(map(tuple, db.execute(MAINTAINED))) == sorted(map(tuple, db.execute(RECOMPUTED)))
+
+
+def schedule(db, username):
+    return sorted(tuple(row) for row in db.execute(MAINTAINED + " WHERE StudentUserName = ?", [username]))
+
+
+def version(db, username):
+    entry = db.execute(STUDENT_SCHEDULE_VERSION, [username]).fetchone()
+    return entry and entry[0]
+
+
+def test_schedule_follows_enroll_waitlist_drop_and_promote(db, add_class):
+    class_id = add_class(1)
+    engine = EnrollmentEngine(db)
+
+    engine.enroll(class_id, "student1", "Student 1")
+    engine.enroll(class_id, "student2", "Student 2")
+    assert [row[2] for row in schedule(db, "student1")] == ["enrolled"]
+    assert [row[2] for row in schedule(db, "student2")] == ["waitlisted"]
+    assert_consistent(db)
+
+    waitlisted = version(db, "student2")
+    # Dropping student1 promotes student2 into the freed seat
+    engine.drop(class_id, "student1")
+    assert [row[2] for row in schedule(db, "student1")] == ["dropped"]
+    assert [row[2] for row in schedule(db, "student2")] == ["enrolled"]
+    assert version(db, "student2") != waitlisted
+    assert_consistent(db)
+
+
+def test_schedule_follows_section_changes(db, add_class):
+    class_id = add_class(1)
+    engine = EnrollmentEngine(db)
+    engine.enroll(class_id, "student1", "Student 1")
+    engine.enroll(class_id, "student2", "Student 2")
+
+    before = version(db, "student1")
+    db.execute(UPDATE_INSTRUCTOR, ["ins2", "Instructor 2", class_id])
+    db.commit()
+    assert version(db, "student1") != before
+    assert_consistent(db)
+
+    for sql in (DELETE_CLASS, DELETE_CLASS_ENROLLMENTS, DELETE_CLASS_WAITLIST):
+        db.execute(sql, [class_id])
+    db.commit()
+    assert schedule(db, "student1") == schedule(db, "student2") == []
+    assert_consistent(db)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_schedule_matches_recomputation(db, add_class, seed):
+    rng = random.Random(seed)
+    class_ids = [add_class(rng.randint(0, 4)) for _ in range(rng.randint(1, 5))]
+    students = [f"student{n}" for n in range(rng.randint(2, 15))]
+    engine = EnrollmentEngine(db)
+
+    for _ in range(80):
+        class_id, username, step = rng.choice(class_ids), rng.choice(students), rng.random()
+        before = {student: (version(db, student), schedule(db, student)) for student in students}
+        try:
+            if step < 0.4:
+                engine.enroll(class_id, username, username)
+            elif step < 0.55:
+                engine.drop(class_id, username)
+            elif step < 0.65:
+                engine.leave_waitlist(class_id, username)
+            elif step < 0.75:
+                engine.set_capacity(class_id, rng.randint(0, 6))
+            elif step < 0.8:
+                db.execute(FREEZE_CLASS, [class_id])
+                db.commit()
+            elif step < 0.85:
+                engine.unfreeze(class_id)
+            elif step < 0.95:
+                engine.enroll_many([(rng.choice(class_ids), rng.choice(students), "y") for _ in range(rng.randint(1, 5))])
+            else:
+                engine.promote(class_id)
+        except EnrollmentError:
+            pass
+
+        assert_consistent(db)
+        # A schedule never changes without its version, so its ETag never goes stale
+        for student, (old_version, old_schedule) in before.items():
+            if schedule(db, student) != old_schedule:
+                assert version(db, student) != old_version
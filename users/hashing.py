@@ -0,0 +1,191 @@
+"""
+Bounded worker pool for password hashing.
+
+PBKDF2 with a few hundred thousand iterations is ~100 ms of CPU. Running it
+inside an ``async def`` endpoint stalls the event loop for every other
+request on the worker. hashlib releases the GIL while it hashes, so a small
+thread pool runs several hashes in parallel and keeps the loop free.
+
+At most ``workers + queue_depth`` hashes are admitted at once. Past that the
+caller gets HashPoolFull immediately instead of queueing without bound.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+
+from common.metrics import Histogram
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_QUEUE_DEPTH = 32
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 300.0
+
+
+HASH_SECONDS = Histogram("password_hash_seconds", "Time to compute one PBKDF2 hash", ("pool",),
+                         buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+HASH_QUEUE_SECONDS = Histogram("password_hash_queue_seconds", "Time a hash waited for a pool thread", ("pool",))
+
+
+class HashPoolFull(Exception):
+    pass
+
+
+class HashPool:
+    COUNTERS = ("submitted", "rejected", "completed", "queue_wait_total", "hash_time_total")
+
+    def __init__(self, workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH, name="hash"):
+        if workers < 1:
+            raise ValueError("hash pool needs at least one worker")
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.max_pending = workers + queue_depth
+        self.name = name
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "queue_wait_total": 0.0,
+            "queue_wait_max": 0.0,
+            "hash_time_total": 0.0,
+            "hash_time_max": 0.0,
+        }
+
+    def _get_executor(self):
+        # Created on first use so a forked worker never inherits the threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix=self.name
+                )
+            return self._executor
+
+    def _timed(self, submitted_at, fn, args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            finished = time.perf_counter()
+            wait, elapsed = started - submitted_at, finished - started
+            HASH_SECONDS.observe(elapsed, self.name)
+            HASH_QUEUE_SECONDS.observe(wait, self.name)
+            with self._lock:
+                self._stats["completed"] += 1
+                self._stats["queue_wait_total"] += wait
+                self._stats["queue_wait_max"] = max(self._stats["queue_wait_max"], wait)
+                self._stats["hash_time_total"] += elapsed
+                self._stats["hash_time_max"] = max(self._stats["hash_time_max"], elapsed)
+
+    async def run(self, fn, *args):
+        """Run ``fn(*args)`` on a pool thread, or raise HashPoolFull."""
+        executor = self._get_executor()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._stats["rejected"] += 1
+                raise HashPoolFull(f"{self.name} pool is saturated ({self._pending} hashes pending)")
+            self._pending += 1
+            self._stats["submitted"] += 1
+        try:
+            future = executor.submit(self._timed, time.perf_counter(), fn, args)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+        # Also runs when a cancelled request drops a hash that never started
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = self._pending
+        completed = stats["completed"]
+        stats["queue_wait_avg"] = stats["queue_wait_total"] / completed if completed else 0.0
+        stats["hash_time_avg"] = stats["hash_time_total"] / completed if completed else 0.0
+        stats.update(workers=self.workers, max_pending=self.max_pending)
+        return stats
+
+
+class VerifiedCache:
+    """LRU set of recently verified (username, password, stored hash) triples.
+
+    Entries are HMAC-SHA256 digests under a per-process random key, so the
+    cache never holds a password or anything that can be brute-forced offline
+    faster than the stored hash itself. The stored hash is part of the key:
+    once a password changes or is rehashed, old entries can no longer match
+    and simply age out.
+    """
+
+    COUNTERS = ("hits", "misses", "expired", "evicted")
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._key = secrets.token_bytes(32)
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # digest -> verified_at
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    def _digest(self, username, password, password_hash):
+        message = "\0".join((username, password, password_hash)).encode("utf-8")
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def check(self, username, password, password_hash):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return False
+        digest = self._digest(username, password, password_hash)
+        now = time.monotonic()
+        with self._lock:
+            verified_at = self._entries.get(digest)
+            if verified_at is not None and now - verified_at < self.ttl:
+                self._entries.move_to_end(digest)
+                self._stats["hits"] += 1
+                return True
+            if verified_at is not None:
+                del self._entries[digest]
+                self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            return False
+
+    def add(self, username, password, password_hash):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        digest = self._digest(username, password, password_hash)
+        with self._lock:
+            self._entries[digest] = time.monotonic()
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats["evicted"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
@@ -1,7 +1,8 @@
 import sqlite3
+import sys
 
-def create_database():
-    conn = sqlite3.connect("../var/primary/fuse/users.db")  
+def create_database(database="../var/primary/fuse/users.db"):
+    conn = sqlite3.connect(database)
     cursor = conn.cursor()
 
     cursor.execute('''
@@ -17,4 +18,6 @@ def create_database():
     conn.commit()
     conn.close()
 
-create_database()
+# Pass another path (e.g. a scratch copy for benchmarks) to create the table there
+if __name__ == "__main__":
+    create_database(*sys.argv[1:2])
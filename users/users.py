@@ -1,12 +1,12 @@
 import collections
-import contextlib
 import logging.config
+import os
 import sqlite3
 import datetime
 import typing
 from typing import Optional
-from fastapi import FastAPI, Depends, Response, HTTPException, status
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, Depends, Response, HTTPException, status, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, RedirectResponse
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 import base64
@@ -15,42 +15,138 @@ import secrets
 import json
 import datetime
 import jwt
-import itertools
+from common.aio import AsyncDatabase, Session, Writer
+from common.logs import sql_tracer
+from common.metrics import CONTENT_TYPE, REGISTRY, MetricsMiddleware, StatsCollector, endpoint_label
+from common.pool import ConnectionPool, PoolTimeout
+from common.replicas import DEFAULT_MAX_LAG, DEFAULT_PIN_SECONDS, Node, ReadPositionMiddleware, ReplicaRouter, read_key
+from common.tokens import DEFAULT_CACHE_SIZE as DEFAULT_TOKEN_CACHE_SIZE, KeySet, TokenVerifier, bearer_token, role_list
+from users.hashing import (
+    DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, DEFAULT_QUEUE_DEPTH, DEFAULT_WORKERS,
+    HashPool, HashPoolFull, VerifiedCache,
+)
 
 # ------------- Constants -------------
-PRIMARY_DATABASE='users/var/primary/fuse/users.db'
+PRIMARY_DATABASE=os.environ.get('USERS_DATABASE', 'users/var/primary/fuse/users.db')
 SECONDARY_1_DATABASE='users/var/secondary_1/fuse/users.db'
 SECONDARY_2_DATABASE='users/var/secondary_2/fuse/users.db'
-SECONDARY_DATABASE=[SECONDARY_1_DATABASE,SECONDARY_2_DATABASE]
-LOGGING_CONFIG='users/etc/logging.ini'
+# Comma-separated, empty to read from the primary only
+SECONDARY_DATABASE=[path for path in os.environ.get('USERS_REPLICAS', f'{SECONDARY_1_DATABASE},{SECONDARY_2_DATABASE}').split(',') if path]
+LOGGING_CONFIG=os.environ.get('USERS_LOGGING_CONFIG', 'users/etc/logging.ini')
+SQL_TRACE_SAMPLE_RATE=float(os.environ.get('USERS_SQL_TRACE_SAMPLE_RATE', 0.0))
 ALGORITHM = "pbkdf2_sha256"
+# Target PBKDF2 cost. Stored hashes with a different count are upgraded on the next login
+HASH_ITERATIONS=int(os.environ.get('USERS_HASH_ITERATIONS', 260000))
+POOL_SIZE=int(os.environ.get('USERS_POOL_SIZE', 5))
+POOL_TIMEOUT=float(os.environ.get('USERS_POOL_TIMEOUT', 5.0))
+# Reader threads, by default one per replica connection
+READ_THREADS=int(os.environ.get('USERS_READ_THREADS', POOL_SIZE * max(len(SECONDARY_DATABASE), 1)))
+# How many transactions a replica may be behind the primary and still serve reads
+REPLICA_MAX_LAG=int(os.environ.get('USERS_REPLICA_MAX_LAG', DEFAULT_MAX_LAG))
+# How long a new user's reads stay on the primary
+READ_YOUR_WRITES_SECONDS=float(os.environ.get('USERS_READ_YOUR_WRITES_SECONDS', DEFAULT_PIN_SECONDS))
+HASH_WORKERS=int(os.environ.get('USERS_HASH_WORKERS', DEFAULT_WORKERS))
+HASH_QUEUE_DEPTH=int(os.environ.get('USERS_HASH_QUEUE_DEPTH', DEFAULT_QUEUE_DEPTH))
+CREDENTIAL_CACHE_SIZE=int(os.environ.get('USERS_CREDENTIAL_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+CREDENTIAL_CACHE_TTL=float(os.environ.get('USERS_CREDENTIAL_CACHE_TTL', DEFAULT_CACHE_TTL))
+ACCESS_TOKEN_MINUTES=20
+REFRESH_TOKEN_DAYS=int(os.environ.get('USERS_REFRESH_TOKEN_DAYS', 7))
+# The JWK set KrakenD signs and validates with
+JWK_PATH=os.environ.get('USERS_JWK_PATH', 'users/share/symmetric.json')
+TOKEN_CACHE_SIZE=int(os.environ.get('USERS_TOKEN_CACHE_SIZE', DEFAULT_TOKEN_CACHE_SIZE))
 
-# Create an infinite cycle to loop through the secondary databases
-db_cycle = itertools.cycle(SECONDARY_DATABASE)
+# Issued refresh tokens, so they can be revoked before they expire
+REFRESH_TOKENS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS RefreshTokens (
+    Jti TEXT PRIMARY KEY,
+    UserId INTEGER NOT NULL REFERENCES Users(UserId),
+    ExpiresAt INTEGER NOT NULL,
+    Revoked INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS refresh_tokens_user_idx ON RefreshTokens(UserId);
+"""
+
+# LiteFS manages the journal itself and its FUSE mount does not support mmap,
+# so only the page cache is tuned here. Replicas are read-only.
+PRIMARY_PRAGMAS = {"cache_size": -8000}
+SECONDARY_PRAGMAS = {"cache_size": -8000, "query_only": 1}
+
+primary_pool = ConnectionPool(PRIMARY_DATABASE, size=POOL_SIZE, timeout=POOL_TIMEOUT, pragmas=PRIMARY_PRAGMAS, name="primary")
+# The writer thread's own connection, so busy readers never hold up a write
+writer_pool = ConnectionPool(PRIMARY_DATABASE, size=1, timeout=POOL_TIMEOUT, pragmas=PRIMARY_PRAGMAS, name="primary-writer")
+secondary_pools = [
+    ConnectionPool(db_url, size=POOL_SIZE, timeout=POOL_TIMEOUT, pragmas=SECONDARY_PRAGMAS, name=db_url)
+    for db_url in SECONDARY_DATABASE
+]
+
+# PBKDF2 runs here instead of on the event loop
+hash_pool = HashPool(workers=HASH_WORKERS, queue_depth=HASH_QUEUE_DEPTH, name="pbkdf2")
+# Lets a client that logs in again within the TTL skip PBKDF2
+verified_cache = VerifiedCache(maxsize=CREDENTIAL_CACHE_SIZE, ttl=CREDENTIAL_CACHE_TTL)
+# Checks refresh tokens against the gateway's keys, each token once until it expires
+token_verifier = TokenVerifier(KeySet(JWK_PATH), maxsize=TOKEN_CACHE_SIZE)
+
+# Route reads to a fresh, healthy replica, or to the primary
+replica_router = ReplicaRouter(primary_pool, secondary_pools, max_lag=REPLICA_MAX_LAG, pin_seconds=READ_YOUR_WRITES_SECONDS)
+
+# Writes are serialized on one thread, reads fan out over the replicas
+database = AsyncDatabase(writer_pool.connection, replica_router.connection, readers=READ_THREADS, name="users")
 
 def get_logger():
     return logging.getLogger(__name__)
 
-def get_primary_db(logger: logging.Logger = Depends(get_logger)):
-    with contextlib.closing(sqlite3.connect(PRIMARY_DATABASE,check_same_thread=False)) as db:
-        db.row_factory = sqlite3.Row
-        db.set_trace_callback(logger.debug)
-        yield db
+def get_primary_db(request: Request, logger: logging.Logger = Depends(get_logger)):
+    return Session(database, trace=sql_tracer(logger, request, SQL_TRACE_SAMPLE_RATE), primary=True, label=endpoint_label(request))
+
+def secondary_db(request: Request, logger: logging.Logger, key=None):
+    # key is pinned to the primary for a while after that user's data was written
+    return Session(database, key=read_key(request, key), trace=sql_tracer(logger, request, SQL_TRACE_SAMPLE_RATE), label=endpoint_label(request))
 
-def get_secondary_db(logger: logging.Logger = Depends(get_logger)):
-    db_url = next(db_cycle)
-    with contextlib.closing(sqlite3.connect(db_url,check_same_thread=False)) as db:
-        db.row_factory = sqlite3.Row
-        db.set_trace_callback(logger.debug)
-        
-        print(db_url)
-        yield db
 
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(MetricsMiddleware, service="users")
+# Read-your-writes across workers: writes answer with the primary position to send back
+app.add_middleware(ReadPositionMiddleware, router=replica_router)
 
-app = FastAPI()
+# The same numbers as /stats, read when /metrics is scraped
+StatsCollector("sqlite_pool", "Connection pool usage",
+               lambda: [({"pool": pool.name}, pool.stats()) for pool in (primary_pool, writer_pool, *secondary_pools)], ConnectionPool.COUNTERS)
+StatsCollector("sqlite_replica", "Replica routing",
+               lambda: [({"node": node["name"]}, node) for node in replica_router.stats()["nodes"]], Node.COUNTERS)
+StatsCollector("sqlite_writer", "Writer thread and group commits",
+               lambda: [({"database": database.name}, stats) for stats in [database.stats()["writer"]] if stats], Writer.COUNTERS)
+StatsCollector("password_hash_pool", "Password hashing pool",
+               lambda: [({"pool": hash_pool.name}, hash_pool.stats())], HashPool.COUNTERS)
+StatsCollector("credential_cache", "Verified credential cache",
+               lambda: [({"cache": "verified"}, verified_cache.stats())], VerifiedCache.COUNTERS)
+StatsCollector("token_cache", "Verified token cache", lambda: [({"service": "users"}, token_verifier.stats())], TokenVerifier.COUNTERS)
+StatsCollector("token_keys", "JWK set", lambda: [({"service": "users"}, token_verifier.keys.stats())], KeySet.COUNTERS)
 
 logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
 
+@app.exception_handler(PoolTimeout)
+def pool_timeout_handler(request, exc):
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+@app.exception_handler(HashPoolFull)
+def hash_pool_full_handler(request, exc):
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+@app.on_event("startup")
+def create_refresh_tokens_table():
+    # Only the primary is writable, the replicas receive the table through LiteFS
+    with primary_pool.connection() as db:
+        db.executescript(REFRESH_TOKENS_SCHEMA)
+
+@app.on_event("shutdown")
+def close_db_pools():
+    database.close()
+    writer_pool.close()
+    primary_pool.close()
+    for pool in secondary_pools:
+        pool.close()
+    hash_pool.close()
+
 # Pydantic model for user registration
 class UserRegistration(BaseModel):
     username: str
@@ -58,6 +154,18 @@ class UserRegistration(BaseModel):
     fullname: str
     roles: str
 
+# Claims of the refresh token sent back by the gateway
+async def get_refresh_claims(request: Request):
+    # Checked here too, the workers' ports are reachable without going through KrakenD
+    token = bearer_token(request)
+    try:
+        claims = token_verifier.verify(token) if token else None
+    except jwt.PyJWTError:
+        claims = None
+    if not claims or claims.get("typ") != "refresh" or "jti" not in claims:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    return claims
+
 # Pydantic model for user login
 class UserLogin(BaseModel):
     username: str
@@ -68,9 +176,11 @@ Helper Functions
 """
 
 # Function to hash a password
-def hash_password(password, salt=None, iterations=260000):
+def hash_password(password, salt=None, iterations=None):
     if salt is None:
         salt = secrets.token_hex(16)
+    if iterations is None:
+        iterations = HASH_ITERATIONS
     assert salt and isinstance(salt, str) and "$" not in salt
     assert isinstance(password, str)
     pw_hash = hashlib.pbkdf2_hmac(
@@ -89,10 +199,20 @@ def verify_password(password, password_hash):
     compare_hash = hash_password(password, salt, iterations)
     return secrets.compare_digest(password_hash, compare_hash)
 
+# Function to check whether a stored hash uses outdated parameters
+def needs_rehash(password_hash):
+    algorithm, iterations, _, _ = password_hash.split("$", 3)
+    return algorithm != ALGORITHM or int(iterations) != HASH_ITERATIONS
+
+# Function to upgrade a stored hash, unless the password changed in the meantime
+def rehash_password(db: sqlite3.Connection, user_id, old_hash, new_hash):
+    db.execute("UPDATE users SET password = ? WHERE userid = ? AND password = ?", (new_hash, user_id, old_hash))
+    db.commit()
+
 # Function to create a new user
-def create_user(user: UserRegistration, db: sqlite3.Connection):
+def create_user(db: sqlite3.Connection, user: UserRegistration, password_hash):
     try:
-        db.execute("INSERT INTO users (username, password, fullname, roles) VALUES (?, ?, ?, ?)", (user.username, hash_password(user.password),user.fullname, user.roles))
+        db.execute("INSERT INTO users (username, password, fullname, roles) VALUES (?, ?, ?, ?)", (user.username, password_hash, user.fullname, user.roles))
         db.commit()
     except sqlite3.IntegrityError as e:
         db.rollback()
@@ -106,33 +226,74 @@ def expiration_in(minutes):
     expiration = creation + datetime.timedelta(minutes=minutes)
     return creation, expiration
 
-# Function to generate JWT claims (Token)
-def generate_claims(username, user_id, fullName, roles):
-    _, exp = expiration_in(20)
+# Function to generate the claims of a short-lived access token
+def access_claims(username, user_id, fullName, roles):
+    _, exp = expiration_in(ACCESS_TOKEN_MINUTES)
 
-    claims = {
+    return {
         "aud": "krakend.local.gd",
         "iss": "auth.local.gd",
         "sub": username,
         "jti": str(user_id),
-        "roles": roles,
+        # Roles is one string in the users table, KrakenD and the services test membership in a list
+        "roles": role_list(roles),
         "name" : fullName,
         "exp": int(exp.timestamp()),
     }
 
-    token = {
-        "access_token": claims,
-        "refresh_token": claims,
+# Function to issue a refresh token. It carries no roles, so the role-checked endpoints reject it
+def issue_refresh_claims(db: sqlite3.Connection, username, user_id):
+    creation, exp = expiration_in(REFRESH_TOKEN_DAYS * 24 * 60)
+    jti = secrets.token_urlsafe(16)
+    # Expired tokens of the user are pruned here so the table stays small
+    db.execute("DELETE FROM RefreshTokens WHERE UserId = ? AND ExpiresAt <= ?", (user_id, int(creation.timestamp())))
+    db.execute("INSERT INTO RefreshTokens (Jti, UserId, ExpiresAt) VALUES (?, ?, ?)", (jti, user_id, int(exp.timestamp())))
+    db.commit()
+
+    return {
+        "aud": "krakend.local.gd",
+        "iss": "auth.local.gd",
+        "sub": username,
+        "jti": jti,
+        "typ": "refresh",
         "exp": int(exp.timestamp()),
     }
 
+# Function to generate JWT claims (Token)
+async def generate_claims(username, user_id, fullName, roles):
+    access = access_claims(username, user_id, fullName, roles)
+    refresh = await database.write(issue_refresh_claims, username, user_id)
+
+    token = {
+        "access_token": access,
+        "refresh_token": refresh,
+        "exp": access["exp"],
+    }
+
     return token
 
+# Verify a password, consulting the verified-credential cache first
+async def check_password(user_id, username, password, password_hash):
+    if verified_cache.check(username, password, password_hash):
+        return True
+    if not await hash_pool.run(verify_password, password, password_hash):
+        return False
+    verified_cache.add(username, password, password_hash)
+    if needs_rehash(password_hash):
+        # Best effort, the login succeeds even if the upgrade has to wait for the next one
+        try:
+            new_hash = await hash_pool.run(hash_password, password)
+            await database.write(rehash_password, user_id, password_hash, new_hash)
+        except (HashPoolFull, PoolTimeout, sqlite3.Error) as e:
+            get_logger().warning("could not rehash password of %s: %s", username, e)
+    return True
+
 # Authentication using JWT
-def authenticate_user(user: UserLogin, db: sqlite3.Connection):
-    user_data = db.execute("SELECT userid, username, password, fullName, roles FROM users WHERE username=?", [user.username]).fetchone()
-    if user_data and verify_password(user.password, user_data[2]): # hashed_password = user_data[2]
-        return generate_claims(user.username,user_data[0],user_data[3],user_data[4])
+async def authenticate_user(user: UserLogin, request: Request, logger: logging.Logger):
+    db = secondary_db(request, logger, key=user.username)
+    user_data = await db.fetchone("SELECT userid, username, password, fullName, roles FROM users WHERE username=?", [user.username])
+    if user_data and await check_password(user_data[0], user.username, user.password, user_data[2]): # hashed_password = user_data[2]
+        return await generate_claims(user.username,user_data[0],user_data[3],user_data[4])
     raise HTTPException(status_code=401, detail="Authentication failed")
 
 
@@ -146,14 +307,67 @@ def default():
     url_list = list(filter(lambda x: x["path"] not in hidden_paths, [{"path" : route.path, "name": route.name} for route in app.routes]))
     return {"routes" : url_list, "message" : f'{len(url_list)} routes found'}
 
+@app.get("/stats",status_code=status.HTTP_200_OK)
+def stats():
+    return {
+        "primary_pool": primary_pool.stats(),
+        "writer_pool": writer_pool.stats(),
+        "secondary_pools": [pool.stats() for pool in secondary_pools],
+        "replicas": replica_router.stats(),
+        "hash_pool": hash_pool.stats(),
+        "verified_cache": verified_cache.stats(),
+        "token_cache": token_verifier.stats(),
+    }
+
+# Prometheus metrics of this worker
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(REGISTRY.expose(), media_type=CONTENT_TYPE)
+
 # Endpoint for user registration
 @app.post("/register")
-async def register_user(user: UserRegistration, db: sqlite3.Connection = Depends(get_primary_db)):
-    create_user(user,db)
+async def register_user(user: UserRegistration, db: Session = Depends(get_primary_db)):
+    password_hash = await hash_pool.run(hash_password, user.password)
+    await db.write(create_user, user, password_hash)
+    # Read-your-writes: the replicas may not have the new user yet
+    replica_router.pin(user.username)
     return {"message": "User registered successfully"}
 
 # Endpoint for user authentication
 @app.post("/login")
-async def login_user(user: UserLogin, db: sqlite3.Connection = Depends(get_secondary_db)):
-    claims = authenticate_user(user,db)
-    return claims
\ No newline at end of file
+async def login_user(user: UserLogin, request: Request, logger: logging.Logger = Depends(get_logger)):
+    claims = await authenticate_user(user, request, logger)
+    return claims
+
+# Endpoint to get a new access token without logging in again
+@app.post("/token/refresh")
+async def refresh_token(claims: dict = Depends(get_refresh_claims), db: Session = Depends(get_primary_db)):
+    # Read from the primary so a revocation takes effect immediately
+    user_data = await db.fetchone(
+        """
+        SELECT Users.UserId, Username, FullName, Roles
+        FROM RefreshTokens
+        JOIN Users ON Users.UserId = RefreshTokens.UserId
+        WHERE Jti = ? AND Revoked = 0 AND ExpiresAt > ?
+        """,
+        (claims["jti"], int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp())),
+    )
+    if not user_data:
+        raise HTTPException(status_code=401, detail="Refresh token is expired or revoked")
+    access = access_claims(user_data[1], user_data[0], user_data[2], user_data[3])
+    return {"access_token": access, "exp": access["exp"]}
+
+# Endpoint to revoke a refresh token, or every refresh token of its user
+@app.post("/token/revoke")
+async def revoke_token(all: bool = False, claims: dict = Depends(get_refresh_claims), db: Session = Depends(get_primary_db)):
+    def revoke(db):
+        if all:
+            cur = db.execute(
+                "UPDATE RefreshTokens SET Revoked = 1 WHERE Revoked = 0 AND UserId = (SELECT UserId FROM RefreshTokens WHERE Jti = ?)",
+                (claims["jti"],),
+            )
+        else:
+            cur = db.execute("UPDATE RefreshTokens SET Revoked = 1 WHERE Jti = ? AND Revoked = 0", (claims["jti"],))
+        db.commit()
+        return cur.rowcount
+    return {"revoked": await db.write(revoke)}
\ No newline at end of file